@@ -76,6 +76,21 @@ String UNIT;
 bool SEND_DATA = false;
 String message;
 
+// ค่าที่ส่งไม่ผ่าน (429 / 503 + retry_after, ต่อไม่ได้, 5xx) เก็บไว้ยิงซ้ำด้วย timestamp เดิม
+// ring buffer: ยิงค่าเก่าสุดก่อน ไม่ทิ้งเองจนกว่าจะเต็ม (เต็ม ⇒ ทิ้งค่าเก่าสุด + นับ retryDropped)
+struct PendingReading {
+  unsigned long epoch;
+  float temp, humid, hic;
+  String flag;
+};
+const int RETRY_QUEUE_SIZE = 36;     // 6 ชม. ที่ 10 นาที/ค่า
+PendingReading retryQueue[RETRY_QUEUE_SIZE];
+int retryHead = 0;                   // index ของค่าเก่าสุด
+int retryLen = 0;
+unsigned long retryAtMs = 0;
+unsigned long retryDropped = 0;
+long lastRetryAfterSec = 0;
+
 WiFiUDP ntpUDP;
 Adafruit_ST7789 tft = Adafruit_ST7789(TFT_CS, TFT_DC, TFT_RST);
 DHT dht(DHTPIN, DHTTYPE);
@@ -154,7 +169,7 @@ void read_config_from_api() {
 // --------------------------------------------------
 // POST /history ไปที่ FastAPI
 // --------------------------------------------------
-int post_history_api(String device_id, float temp, float humid, float hic, String flag_lower) {
+int post_history_api(String device_id, float temp, float humid, float hic, String flag_lower, unsigned long epoch) {
   std::unique_ptr<BearSSL::WiFiClientSecure> client(new BearSSL::WiFiClientSecure);
   client->setInsecure();
   HTTPClient https;
@@ -164,8 +179,6 @@ int post_history_api(String device_id, float temp, float humid, float hic, Strin
 
   if (https.begin(*client, url)) {
     // ใช้ epoch จาก NTP เป็น timestamp (ฝั่ง FastAPI รองรับเลข timestamp อยู่แล้ว)
-    unsigned long epoch = timeClient.getEpochTime();
-
     String p = "{";
     p += "\"id\":\"" + device_id + "\",";
     p += "\"temp\":" + String(temp, 2) + ",";
@@ -176,6 +189,8 @@ int post_history_api(String device_id, float temp, float humid, float hic, Strin
     p += "}";
 
     https.addHeader("Content-Type", "application/json");
+    const char* headerKeys[] = {"Retry-After"};
+    https.collectHeaders(headerKeys, 1);
     int httpResponseCode = https.POST(p);
     String content = https.getString();
 
@@ -184,6 +199,18 @@ int post_history_api(String device_id, float temp, float humid, float hic, Strin
     Serial.print("content: ");
     Serial.println(content);
 
+    // server รับไม่ไหว ⇒ ส่ง retry_after (วินาที) มาให้
+    lastRetryAfterSec = 0;
+    if (httpResponseCode == 429 || httpResponseCode == 503) {
+      StaticJsonDocument<256> doc;
+      if (!deserializeJson(doc, content)) {
+        lastRetryAfterSec = doc["retry_after"] | 0L;
+      }
+      if (lastRetryAfterSec <= 0) {
+        lastRetryAfterSec = https.header("Retry-After").toInt();
+      }
+    }
+
     https.end();
     return httpResponseCode;
   } else {
@@ -192,6 +219,56 @@ int post_history_api(String device_id, float temp, float humid, float hic, Strin
   }
 }
 
+// --------------------------------------------------
+// คิวค่าที่รอยิงซ้ำ
+// --------------------------------------------------
+bool shouldRetry(int httpResponseCode) {
+  // 4xx อื่น (ข้อมูลผิด) ยิงซ้ำก็ไม่ผ่าน
+  return httpResponseCode <= 0 || httpResponseCode == 429 || httpResponseCode >= 500;
+}
+
+unsigned long retryDelayMs() {
+  return (unsigned long)(lastRetryAfterSec > 0 ? lastRetryAfterSec : 30) * 1000UL;
+}
+
+void queueReading(unsigned long epoch, float temp, float humid, float hic, String flag_lower) {
+  if (retryLen == RETRY_QUEUE_SIZE) {
+    retryHead = (retryHead + 1) % RETRY_QUEUE_SIZE;
+    retryLen--;
+    retryDropped++;
+    Serial.print("retry queue full, dropped oldest (total dropped: ");
+    Serial.print(retryDropped);
+    Serial.println(")");
+    status = "severfail";
+  }
+  PendingReading &r = retryQueue[(retryHead + retryLen) % RETRY_QUEUE_SIZE];
+  r.epoch = epoch;
+  r.temp = temp;
+  r.humid = humid;
+  r.hic = hic;
+  r.flag = flag_lower;
+  retryLen++;
+}
+
+// ยิงค่าเก่าสุดในคิว (ถึงเวลาแล้ว) ผ่าน ⇒ ค่าถัดไปยิงรอบ loop หน้าเลย
+void flushRetryQueue() {
+  if (retryLen == 0 || (long)(millis() - retryAtMs) < 0) {
+    return;
+  }
+  PendingReading &r = retryQueue[retryHead];
+  int httpResponseCode = post_history_api(DEVICE_ID, r.temp, r.humid, r.hic, r.flag, r.epoch);
+  if (httpResponseCode == 200 || httpResponseCode == 201 || !shouldRetry(httpResponseCode)) {
+    if (httpResponseCode != 200 && httpResponseCode != 201) {
+      status = "severfail";  // ข้อมูลผิด server ไม่รับ ⇒ ทิ้งค่านี้
+    }
+    retryHead = (retryHead + 1) % RETRY_QUEUE_SIZE;
+    retryLen--;
+    retryAtMs = millis();
+  } else {
+    retryAtMs = millis() + retryDelayMs();
+  }
+}
+
 // --------------------------------------------------
 // ฟังก์ชันวาดค่าบนหน้าจอ
 // --------------------------------------------------
@@ -440,13 +517,26 @@ void loop() {
       String flag_lower = flag;
       flag_lower.toLowerCase();
 
-      int httpResponseCode = post_history_api(DEVICE_ID, temp, humid, hic, flag_lower);
-      if (httpResponseCode <= 0 || (httpResponseCode != 200 && httpResponseCode != 201)) {
-        status = "severfail";  // ตัวสะกดเดิมในโค้ด :)
+      unsigned long epoch = timeClient.getEpochTime();
+      if (retryLen > 0) {
+        // ยังมีค่าค้าง (server ยังรับไม่ไหว) ⇒ ต่อท้ายคิว ไม่ยิงแซง
+        queueReading(epoch, temp, humid, hic, flag_lower);
+      } else {
+        int httpResponseCode = post_history_api(DEVICE_ID, temp, humid, hic, flag_lower, epoch);
+        if (shouldRetry(httpResponseCode)) {
+          // จำค่าชุดนี้ไว้ ยิงใหม่ตามเวลาที่ server บอก (timestamp เดิม)
+          queueReading(epoch, temp, humid, hic, flag_lower);
+          retryAtMs = millis() + retryDelayMs();
+        } else if (httpResponseCode != 200 && httpResponseCode != 201) {
+          status = "severfail";  // ตัวสะกดเดิมในโค้ด :)
+        }
       }
       SEND_DATA = true;
     }
 
+    // ยิงซ้ำค่าที่ค้างอยู่ เมื่อถึงเวลาที่ server บอก
+    flushRetryQueue();
+
     // ถ้านาทีไม่ใช่เลขหาร 10 ลงตัวแล้ว → reset ให้สามารถยิงรอบถัดไปได้
     if (timeClient.getMinutes() % 10 != 0) {
       SEND_DATA = false;
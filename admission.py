@@ -0,0 +1,216 @@
+"""
+Admission control ของ POST /history
+
+ทุกเครื่องยิงตอน getMinutes() % 10 == 0 พร้อมกัน ⇒ ถ้าส่งต่อไป GAS ตรง ๆ จะเกิน quota
+- token bucket ต่อ device (กันเครื่องเดียวยิงรัว ๆ)
+- token bucket รวมทั้งระบบ (หลาย worker ⇒ ใช้ bucket ร่วมใน shared.py ไม่งั้นได้ N เท่า)
+- queue ในหน่วยความจำแบบจำกัดขนาด ให้ worker ค่อย ๆ ระบายไป GAS / LINE ตาม drain rate
+- ถ้ารับไม่ไหว ⇒ คืน retry_after (วินาที) ให้ firmware ยิงใหม่ ไม่ทิ้งข้อมูลเงียบ ๆ
+"""
+import asyncio
+import random
+import threading
+import time
+from typing import Any, Callable, Dict, NamedTuple, Optional
+
+
+class TokenBucket:
+    """
+    token bucket แบบง่าย (rate = token ต่อวินาที, capacity = burst สูงสุด)
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def try_take(self, n: float = 1.0, now: Optional[float] = None) -> float:
+        """
+        หยิบ token n อัน ถ้าได้คืน 0.0
+        ถ้าไม่พอ ⇒ ไม่หยิบ และคืนจำนวนวินาทีที่ต้องรอจนกว่าจะพอ
+        """
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= n:
+            self.tokens -= n
+            return 0.0
+        if self.rate <= 0:
+            return float("inf")
+        return (n - self.tokens) / self.rate
+
+    def reserve(self, n: float = 1.0, now: Optional[float] = None) -> float:
+        """
+        จอง token ล่วงหน้า (ติดลบได้) คืนจำนวนวินาทีที่ต้องรอก่อนใช้ token นี้
+        ใช้ฝั่ง worker เพื่อกระจายงานให้สม่ำเสมอตาม rate
+        """
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        self.tokens -= n
+        if self.tokens >= 0 or self.rate <= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def refund(self, n: float = 1.0):
+        self.tokens = min(self.capacity, self.tokens + n)
+
+    def is_full(self, now: Optional[float] = None) -> bool:
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class AdmitResult(NamedTuple):
+    accepted: bool
+    reason: str            # "ok" | "device_rate" | "global_rate" | "queue_full"
+    retry_after: float     # วินาที (0 ถ้า accepted)
+    queue_depth: int
+
+
+class IngestAdmission:
+    """
+    ด่านหน้า ingest: ตรวจ token bucket แล้วใส่ queue
+
+    - admit() เรียกจาก request handler (event loop เดียวกับ worker)
+    - worker เรียก next_item() → รอตาม drain rate → ทำงาน → task_done()
+    - shared_bucket(name, rate, burst) ⇒ bucket รวม / drain ใช้ร่วมกับ process อื่น (เช่น shared.SharedTokenBucket)
+      bucket ต่อ device กับ queue ยังอยู่ใน process นี้
+    """
+
+    def __init__(
+        self,
+        queue_max: int = 5000,
+        device_rate: float = 1.0 / 60.0,
+        device_burst: float = 3.0,
+        global_rate: float = 50.0,
+        global_burst: float = 1000.0,
+        drain_rate: float = 5.0,
+        drain_burst: float = 5.0,
+        max_retry_after: float = 600.0,
+        shared_bucket: Optional[Callable[[str, float, float], Any]] = None,
+    ):
+        self.queue_max = queue_max
+        self.device_rate = device_rate
+        self.device_burst = device_burst
+        if shared_bucket is not None:
+            self.global_bucket = shared_bucket("ingest_global", global_rate, global_burst)
+            self.drain_bucket = shared_bucket("ingest_drain", drain_rate, drain_burst)
+        else:
+            self.global_bucket = TokenBucket(global_rate, global_burst)
+            self.drain_bucket = TokenBucket(drain_rate, drain_burst)
+        self.drain_rate = drain_rate
+        self.max_retry_after = max_retry_after
+
+        self.devices: Dict[str, TokenBucket] = {}
+        self.queue: Optional[asyncio.Queue] = None
+        self.lock = threading.Lock()
+
+        self.stats: Dict[str, int] = {
+            "accepted": 0,
+            "processed": 0,
+            "retried": 0,
+            "rejected_device_rate": 0,
+            "rejected_global_rate": 0,
+            "rejected_queue_full": 0,
+        }
+        self.max_depth = 0
+        self._admits_since_prune = 0
+
+    # ---------- queue ----------
+
+    def _q(self) -> asyncio.Queue:
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=self.queue_max)
+        return self.queue
+
+    def depth(self) -> int:
+        return self.queue.qsize() if self.queue is not None else 0
+
+    def _jittered(self, sec: float) -> float:
+        # กระจายเวลา retry ไม่ให้กลับมาพร้อมกันอีกรอบ
+        sec = max(1.0, sec)
+        sec = sec + random.uniform(0, sec * 0.5)
+        return round(min(sec, self.max_retry_after), 1)
+
+    # ---------- admission ----------
+
+    def _device_bucket(self, device_id: str) -> TokenBucket:
+        b = self.devices.get(device_id)
+        if b is None:
+            b = self.devices[device_id] = TokenBucket(self.device_rate, self.device_burst)
+        return b
+
+    def _prune(self, now: float):
+        # bucket ที่เต็มแล้ว = เหมือนเครื่องใหม่ ⇒ ลบทิ้งได้ ไม่ให้ dict โตไม่จำกัด
+        self._admits_since_prune += 1
+        if self._admits_since_prune < 1000:
+            return
+        self._admits_since_prune = 0
+        for did in [d for d, b in self.devices.items() if b.is_full(now)]:
+            del self.devices[did]
+
+    def admit(self, device_id: str, item: Any) -> AdmitResult:
+        q = self._q()
+        now = time.monotonic()
+        with self.lock:
+            self._prune(now)
+            depth = q.qsize()
+
+            if depth >= self.queue_max:
+                self.stats["rejected_queue_full"] += 1
+                wait = depth / self.drain_rate if self.drain_rate > 0 else self.max_retry_after
+                return AdmitResult(False, "queue_full", self._jittered(wait), depth)
+
+            dev = self._device_bucket(device_id)
+            wait = dev.try_take(now=now)
+            if wait > 0:
+                self.stats["rejected_device_rate"] += 1
+                return AdmitResult(False, "device_rate", self._jittered(wait), depth)
+
+            wait = self.global_bucket.try_take(now=now)
+            if wait > 0:
+                dev.refund()
+                self.stats["rejected_global_rate"] += 1
+                return AdmitResult(False, "global_rate", self._jittered(wait), depth)
+
+            q.put_nowait(item)
+            self.stats["accepted"] += 1
+            depth += 1
+            self.max_depth = max(self.max_depth, depth)
+            return AdmitResult(True, "ok", 0.0, depth)
+
+    # ---------- worker side ----------
+
+    async def next_item(self) -> Any:
+        item = await self._q().get()
+        with self.lock:
+            wait = self.drain_bucket.reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return item
+
+    def task_done(self):
+        with self.lock:
+            self.stats["processed"] += 1
+        self._q().task_done()
+
+    def note_retry(self):
+        with self.lock:
+            self.stats["retried"] += 1
+
+    def snapshot(self, reset_peak: bool = False) -> dict:
+        with self.lock:
+            snap = dict(self.stats)
+            snap["depth"] = self.depth()
+            snap["max_depth"] = self.max_depth
+            snap["capacity"] = self.queue_max
+            snap["drain_rate"] = self.drain_rate
+            snap["tracked_devices"] = len(self.devices)
+            if reset_peak:
+                self.max_depth = snap["depth"]
+            return snap
@@ -0,0 +1,250 @@
+"""
+Alert engine: ประเมินทุกค่าที่เข้ามา (HistoryIn) แบบ incremental
+
+- เก็บ state ต่อ device (ค่าก่อนหน้า + state ต่อ rule) ⇒ O(1) ต่อ reading
+- rule ที่รองรับ
+    flag_rise  : ธงสีขยับขึ้นถึง/เกิน min_flag (เช่น เหลือง → ดำ)
+    hic_above  : hic >= threshold ติดกัน consecutive ครั้ง
+    hic_rate   : hic ขึ้นเร็วกว่า max_rise °C ต่อ 10 นาที
+- hysteresis: จะ "ปลด" alert ได้ก็ต่อเมื่อค่าลงต่ำกว่าเกณฑ์ - hysteresis (กันสลับไปมา)
+- cooldown: rule เดียวกันของ device เดียวกันจะไม่ยิงซ้ำภายใน cooldown_sec
+- rule ผูกกับ device_id / line_id ได้ (ไม่ใส่ = ใช้กับทุก device / ทุกห้อง)
+
+rule อ่านจากไฟล์ JSON (HT_ALERT_RULES) ถ้าไม่มีใช้ DEFAULT_RULES
+"""
+import json
+import logging
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from heat_index import FLAG_NAMES, HIC_THRESHOLDS
+from notify import FLAG_TH, TH_TZ
+
+logger = logging.getLogger("uvicorn.error")
+
+FLAG_LEVELS = {name: i for i, name in enumerate(FLAG_NAMES)}
+LEVEL_FLAGS = {v: k for k, v in FLAG_LEVELS.items()}
+# ขอบล่างของ hic แต่ละธง (ladder เดียวกับ HT-2025.ino)
+FLAG_LOWER_HIC = dict(zip(FLAG_NAMES, (float("-inf"),) + HIC_THRESHOLDS))
+
+DEFAULT_RULES = [
+    {"name": "flag_rise", "kind": "flag_rise", "min_flag": "yellow", "hysteresis": 1.0, "cooldown_sec": 1800},
+    {"name": "hic_danger", "kind": "hic_above", "threshold": 41.0, "consecutive": 2, "hysteresis": 1.5,
+     "cooldown_sec": 3600},
+    {"name": "hic_fast_rise", "kind": "hic_rate", "max_rise": 4.0, "cooldown_sec": 3600},
+]
+
+
+def reading_epoch(ts, default: Optional[float] = None) -> float:
+    """
+    timestamp จาก device → epoch วินาที
+    - firmware ส่งเป็นเลข epoch (string) ⇒ ใช้ตรง ๆ
+    - ISO string ไม่มี timezone ⇒ ถือเป็นเวลาไทย (+7) ให้ตรงกับ format_ts_th
+    """
+    if ts in (None, ""):
+        return time.time() if default is None else default
+    try:
+        return float(ts)
+    except (TypeError, ValueError):
+        pass
+    try:
+        s = str(ts)
+        if s.endswith("Z"):
+            s = s.replace("Z", "+00:00")
+        dt = datetime.fromisoformat(s)
+        if dt.tzinfo is None:
+            dt = dt.replace(tzinfo=TH_TZ)
+        return dt.timestamp()
+    except ValueError:
+        return time.time() if default is None else default
+
+
+class AlertRule:
+    def __init__(self, name: str, kind: str, device_id: Optional[str] = None, line_id: Optional[str] = None,
+                 cooldown_sec: float = 1800.0, hysteresis: float = 1.0, **params):
+        if kind not in ("flag_rise", "hic_above", "hic_rate"):
+            raise ValueError(f"unknown alert rule kind: {kind}")
+        self.name = name
+        self.kind = kind
+        self.device_id = device_id
+        self.line_id = line_id
+        self.cooldown_sec = float(cooldown_sec)
+        self.hysteresis = float(hysteresis)
+        self.min_flag = str(params.get("min_flag", "yellow")).lower()
+        self.threshold = float(params.get("threshold", 41.0))
+        self.consecutive = max(1, int(params.get("consecutive", 1)))
+        self.max_rise = float(params.get("max_rise", 4.0))
+
+    def applies_to(self, device_id: str) -> bool:
+        return self.device_id in (None, "", device_id)
+
+
+class Alert:
+    def __init__(self, rule: AlertRule, device_id: str, reading: dict, detail: str):
+        self.rule = rule
+        self.device_id = device_id
+        self.reading = reading
+        self.detail = detail
+
+    def message(self, unit_name: str) -> str:
+        return "\n".join([
+            f"⚠️ แจ้งเตือน หน่วย: {unit_name}",
+            self.detail,
+            f"🌡อุณหภูมิ: {float(self.reading.get('temp', 0.0)):.1f} °C",
+            f"💧ความชื้น: {float(self.reading.get('humid', 0.0)):.1f} %RH",
+            f"-รู้สึกเหมือน: {float(self.reading.get('hic', 0.0)):.1f} °C",
+        ])
+
+
+class _RuleState:
+    __slots__ = ("active", "count", "last_fired", "level", "fired_level")
+
+    def __init__(self):
+        self.active = False      # อยู่ในสถานะแจ้งเตือนแล้ว (รอปลดด้วย hysteresis)
+        self.count = 0           # จำนวนครั้งติดกันที่เกิน threshold
+        self.last_fired = 0.0
+        self.level = -1          # flag_rise: ระดับธงที่แจ้งไปล่าสุด
+        self.fired_level = -1    # flag_rise: ระดับธงตอนยิง alert ครั้งล่าสุด
+
+
+class _DeviceState:
+    __slots__ = ("last_hic", "last_ts", "last_flag", "rules")
+
+    def __init__(self):
+        self.last_hic: Optional[float] = None
+        self.last_ts: Optional[float] = None
+        self.last_flag: Optional[str] = None
+        self.rules: Dict[str, _RuleState] = {}
+
+
+class AlertEngine:
+    def __init__(self, rules: List[AlertRule]):
+        self.rules = rules
+        self.devices: Dict[str, _DeviceState] = {}
+        self.stats = {"evaluated": 0, "fired": 0, "suppressed_cooldown": 0}
+
+    @classmethod
+    def from_config(cls, path: Optional[str] = None) -> "AlertEngine":
+        raw = DEFAULT_RULES
+        if path:
+            try:
+                with open(path, encoding="utf-8") as f:
+                    raw = json.load(f)
+            except (OSError, ValueError):
+                logger.exception(f"Cannot load alert rules from {path}; using defaults")
+                raw = DEFAULT_RULES
+        return cls([AlertRule(**r) for r in raw])
+
+    def evaluate(self, device_id: str, reading: dict, now: Optional[float] = None) -> List[Alert]:
+        """
+        ประเมินค่าใหม่ 1 ชุดของ device คืน list ของ Alert ที่ต้องส่ง
+        """
+        now = time.time() if now is None else now
+        st = self.devices.get(device_id)
+        if st is None:
+            st = self.devices[device_id] = _DeviceState()
+
+        hic = float(reading.get("hic", 0.0))
+        flag = str(reading.get("flag") or "").lower()
+        ts = reading_epoch(reading.get("timestamp"), default=now)
+        self.stats["evaluated"] += 1
+
+        # ค่าเก่ากว่าที่เคยเห็น (เช่น retry ที่มาช้า) ⇒ ไม่เอามาคิด transition
+        if st.last_ts is not None and ts <= st.last_ts:
+            return []
+
+        fired: List[Alert] = []
+        for rule in self.rules:
+            if not rule.applies_to(device_id):
+                continue
+            rs = st.rules.get(rule.name)
+            if rs is None:
+                rs = st.rules[rule.name] = _RuleState()
+
+            detail = None
+            if rule.kind == "flag_rise":
+                detail = self._flag_rise(rule, rs, st, flag, hic)
+            elif rule.kind == "hic_above":
+                detail = self._hic_above(rule, rs, hic)
+            elif rule.kind == "hic_rate":
+                detail = self._hic_rate(rule, rs, st, hic, ts)
+
+            if detail is None:
+                continue
+            # ธงขึ้นสูงกว่าที่เพิ่งแจ้งไป (เช่น เหลือง → ดำ) ⇒ ไม่ติด cooldown
+            escalated = rule.kind == "flag_rise" and rs.level > rs.fired_level
+            if now - rs.last_fired < rule.cooldown_sec and not escalated:
+                self.stats["suppressed_cooldown"] += 1
+                continue
+            rs.last_fired = now
+            rs.fired_level = rs.level
+            self.stats["fired"] += 1
+            fired.append(Alert(rule, device_id, reading, detail))
+
+        st.last_hic = hic
+        st.last_ts = ts
+        st.last_flag = flag or st.last_flag
+        return fired
+
+    # ---------- rule kinds ----------
+
+    @staticmethod
+    def _flag_rise(rule: AlertRule, rs: _RuleState, st: _DeviceState, flag: str, hic: float) -> Optional[str]:
+        level = FLAG_LEVELS.get(flag)
+        if level is None:
+            return None
+        # ปลดระดับลงเมื่อ hic ต่ำกว่าขอบล่างของธงที่แจ้งไป - hysteresis เท่านั้น
+        if rs.level >= 0:
+            if hic < FLAG_LOWER_HIC[LEVEL_FLAGS[rs.level]] - rule.hysteresis:
+                rs.level = level
+        min_level = FLAG_LEVELS.get(rule.min_flag, 2)
+        prev_flag = st.last_flag
+        if level >= min_level and level > rs.level:
+            first = rs.level < 0
+            rs.level = level
+            if first and prev_flag is None:
+                # ค่าแรกหลัง start ⇒ จำไว้เฉย ๆ ไม่ถือเป็นการเปลี่ยนธง
+                return None
+            prev_txt = FLAG_TH.get(prev_flag or "", prev_flag or "-")
+            return f"-ธงสีเปลี่ยน: {prev_txt} → {FLAG_TH.get(flag, flag)}"
+        if rs.level < 0:
+            rs.level = level
+        return None
+
+    @staticmethod
+    def _hic_above(rule: AlertRule, rs: _RuleState, hic: float) -> Optional[str]:
+        if hic >= rule.threshold:
+            rs.count += 1
+            if not rs.active and rs.count >= rule.consecutive:
+                rs.active = True
+                return f"-รู้สึกเหมือน ≥ {rule.threshold:.1f} °C ติดกัน {rs.count} ครั้ง"
+            return None
+        rs.count = 0
+        if rs.active and hic < rule.threshold - rule.hysteresis:
+            rs.active = False
+        return None
+
+    @staticmethod
+    def _hic_rate(rule: AlertRule, rs: _RuleState, st: _DeviceState, hic: float, ts: float) -> Optional[str]:
+        if st.last_hic is None or st.last_ts is None:
+            return None
+        dt = ts - st.last_ts
+        # ห่างเกิน 30 นาที (เครื่องหลุดไป) ⇒ ไม่คิด rate
+        if dt <= 0 or dt > 30 * 60:
+            return None
+        rise_per_10min = (hic - st.last_hic) / (dt / 600.0)
+        if rise_per_10min >= rule.max_rise:
+            if not rs.active:
+                rs.active = True
+                return f"-รู้สึกเหมือนขึ้นเร็ว: +{rise_per_10min:.1f} °C / 10 นาที"
+            return None
+        if rs.active and rise_per_10min < rule.max_rise - rule.hysteresis:
+            rs.active = False
+        return None
+
+    def snapshot(self) -> dict:
+        snap = dict(self.stats)
+        snap["devices"] = len(self.devices)
+        snap["rules"] = [r.name for r in self.rules]
+        return snap
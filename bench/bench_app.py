@@ -0,0 +1,154 @@
+"""
+Benchmark ของ POST /history (ingest), GET /status และ GET /history
+
+- start fake GAS + fake LINE API (bench/fake_gas.py) ใน process นี้
+- start `uvicorn main:app` เป็น subprocess ชี้ HT_GAS_URL / HT_LINE_API_URL มาที่ fake
+- วัด p50 / p90 / p99 latency และ throughput ของแต่ละ scenario
+- เขียนผลเป็น JSON (default: bench_results.json) ไว้เทียบกับรอบก่อนด้วย --compare
+
+ตัวอย่าง:
+    python bench/bench_app.py --devices 20 --rows 2000 --latency-ms 300 --out bench_results.json
+    python bench/bench_app.py --compare bench_results_prev.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from typing import List, Optional
+
+from common import AppProcess, compare_results, result_meta, run_load, write_results
+from fake_gas import DEFAULT_LINE_ID, FakeGasData, serve_in_thread
+
+SCENARIOS = ("ingest", "status", "history")
+
+
+def bench_ingest(base_url: str, device_ids: List[str], total: int, concurrency: int) -> dict:
+    rng = random.Random(1)
+    ts = int(time.time())
+
+    def call(sess, i):
+        temp = round(rng.uniform(25, 38), 2)
+        humid = round(rng.uniform(40, 90), 2)
+        return sess.post(
+            f"{base_url}/history",
+            json={
+                "id": device_ids[i % len(device_ids)],
+                "temp": temp,
+                "humid": humid,
+                "hic": round(temp + (humid - 40) * 0.12, 2),
+                "flag": "yellow",
+                "timestamp": str(ts),
+            },
+            timeout=60,
+        )
+
+    return run_load(call, total, concurrency)
+
+
+def bench_status(base_url: str, line_id: str, total: int, concurrency: int) -> dict:
+    def call(sess, i):
+        return sess.get(f"{base_url}/status", params={"line_id": line_id}, timeout=60)
+
+    return run_load(call, total, concurrency)
+
+
+def bench_history(base_url: str, line_id: str, device_ids: List[str], total: int, concurrency: int) -> dict:
+    def call(sess, i):
+        return sess.get(
+            f"{base_url}/history",
+            params={"line_id": line_id, "device_id": device_ids[i % len(device_ids)]},
+            timeout=60,
+        )
+
+    return run_load(call, total, concurrency)
+
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="HT-2025 ingest / status / history benchmark")
+    ap.add_argument("--devices", type=int, default=10, help="N devices in the chat (/status)")
+    ap.add_argument("--rows", type=int, default=1000, help="M history rows per device (/history)")
+    ap.add_argument("--latency-ms", type=float, default=0.0, help="fake GAS latency per call")
+    ap.add_argument("--jitter-ms", type=float, default=0.0)
+    ap.add_argument("--line-latency-ms", type=float, default=0.0)
+    ap.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    ap.add_argument("--concurrency", type=int, default=10)
+    ap.add_argument("--warmup", type=int, default=5)
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS))
+    ap.add_argument("--workers", type=int, default=1, help="uvicorn --workers")
+    ap.add_argument("--out", default="bench_results.json")
+    ap.add_argument("--compare", default=None, help="previous results file to diff against")
+    args = ap.parse_args(argv)
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        ap.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    data = FakeGasData(
+        devices=args.devices,
+        rows=args.rows,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        line_latency_ms=args.line_latency_ms,
+    )
+    fake = serve_in_thread(data)
+    fake_base = f"http://127.0.0.1:{fake.server_address[1]}"
+    device_ids = list(data.config.keys())
+    line_id = DEFAULT_LINE_ID
+
+    env = {
+        "HT_GAS_URL": f"{fake_base}/exec",
+        "HT_LINE_API_URL": fake_base,
+        # benchmark วัดความเร็ว ไม่ได้วัด rate limit ⇒ เปิด bucket ให้กว้างพอ
+        "HT_INGEST_DEVICE_BURST": str(args.requests + args.warmup),
+        "HT_INGEST_GLOBAL_BURST": str(args.requests + args.warmup),
+    }
+
+    results = {}
+    with AppProcess(env, workers=args.workers) as app_proc:
+        base = app_proc.base_url
+        for name in scenarios:
+            if args.warmup:
+                if name == "ingest":
+                    bench_ingest(base, device_ids, args.warmup, 1)
+                elif name == "status":
+                    bench_status(base, line_id, args.warmup, 1)
+                else:
+                    bench_history(base, line_id, device_ids, args.warmup, 1)
+            data.reset_stats()
+
+            if name == "ingest":
+                res = bench_ingest(base, device_ids, args.requests, args.concurrency)
+            elif name == "status":
+                res = bench_status(base, line_id, args.requests, args.concurrency)
+            else:
+                res = bench_history(base, line_id, device_ids, args.requests, args.concurrency)
+
+            res["upstream"] = data.snapshot_stats()
+            results[name] = res
+            print(f"{name:<8} p50={res['p50_ms']}ms p99={res['p99_ms']}ms "
+                  f"rps={res['throughput_rps']} errors={res['errors']}")
+
+    fake.shutdown()
+
+    out = {
+        "meta": result_meta({k: v for k, v in vars(args).items() if k not in ("out", "compare")}),
+        "results": results,
+    }
+    write_results(args.out, out)
+    print(f"results → {args.out}")
+
+    if args.compare:
+        if not os.path.exists(args.compare):
+            print(f"compare file not found: {args.compare}", file=sys.stderr)
+        else:
+            with open(args.compare, encoding="utf-8") as f:
+                prev = json.load(f)
+            for line in compare_results(prev, out):
+                print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Benchmark /history แบบขอทั้งห้อง vs ส่งเงื่อนไขไปให้ Apps Script กรอง (pushdown ดู gas_query.py)
+
+mode:
+- full      : HT_HISTORY_PAGE_QUERY=0 ดึง history(line_id) ทั้งห้องแล้วกรองใน Python (แบบเดิม)
+- pushdown  : ขอเฉพาะ device + หน้าที่แสดง fake GAS รองรับ param
+- fallback  : ขอแบบ pushdown แต่ fake GAS ไม่รองรับ (Apps Script ตัวเก่า) ⇒ กรองเองระหว่าง stream
+
+ทุก mode ปิด gas_cache (HT_GAS_CACHE_*=0) ⇒ ทุก view ยิง GAS จริง
+วัด bytes ที่ GAS ส่งออก (action=history) + latency ต่อ view
+
+ตัวอย่าง:
+    python bench/bench_pushdown.py --devices 20 --rows 4320 --views 10 --out bench_results_pushdown.json
+    python bench/bench_pushdown.py --compare bench_results_pushdown.json --out bench_results_pushdown_new.json
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from typing import List, Optional
+
+import requests
+
+from common import AppProcess, compare_results, percentile, result_meta, write_results
+from fake_gas import DEFAULT_LINE_ID, FakeGasData, serve_in_thread
+
+MODES = {
+    "full": ({"HT_HISTORY_PAGE_QUERY": "0"}, True),
+    "pushdown": ({"HT_HISTORY_PAGE_QUERY": "1"}, True),
+    "fallback": ({"HT_HISTORY_PAGE_QUERY": "1"}, False),
+}
+
+
+def bench_mode(name: str, args) -> dict:
+    extra_env, pushdown_support = MODES[name]
+    data = FakeGasData(devices=args.devices, rows=args.rows, latency_ms=args.latency_ms,
+                       pushdown_support=pushdown_support)
+    fake = serve_in_thread(data)
+    fake_base = f"http://127.0.0.1:{fake.server_address[1]}"
+    env = dict(os.environ)
+    env.update({
+        "HT_GAS_URL": f"{fake_base}/exec",
+        "HT_LINE_API_URL": fake_base,
+        "HT_SNAPSHOT_PATH": "",
+        "HT_GAS_CACHE_FRESH_SEC": "0",
+        "HT_GAS_CACHE_STALE_SEC": "0",
+    })
+    env.update(extra_env)
+
+    device_ids = list(data.config)
+    latencies: List[float] = []
+    nbytes: List[int] = []
+    with AppProcess(env) as app:
+        for i in range(args.views):
+            params = {
+                "line_id": DEFAULT_LINE_ID,
+                "device_id": device_ids[i % len(device_ids)],
+                "page": 1 + (i % 3),
+            }
+            requests.get(f"{fake_base}/__reset", timeout=10)
+            t0 = time.perf_counter()
+            requests.get(f"{app.base_url}/history", params=params, timeout=120).raise_for_status()
+            latencies.append(time.perf_counter() - t0)
+            st = requests.get(f"{fake_base}/__stats", timeout=10).json()["gas"].get("history", {})
+            nbytes.append(st.get("bytes_out", 0))
+    fake.shutdown()
+
+    lat = sorted(latencies)
+    return {
+        "views": len(lat),
+        "p50_ms": round(percentile(lat, 50) * 1000, 2),
+        "max_ms": round(lat[-1] * 1000, 2) if lat else 0.0,
+        "gas_kb_per_view": round(sum(nbytes) / max(1, len(nbytes)) / 1024, 1),
+        "gas_kb_first_view": round(nbytes[0] / 1024, 1) if nbytes else 0.0,
+    }
+
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="HT-2025 /history pushdown benchmark")
+    ap.add_argument("--devices", type=int, default=20)
+    ap.add_argument("--rows", type=int, default=4320, help="history rows per device (4320 = 30 days)")
+    ap.add_argument("--views", type=int, default=10, help="/history page views per mode")
+    ap.add_argument("--latency-ms", type=float, default=0.0, help="fake GAS latency per call")
+    ap.add_argument("--modes", default=",".join(MODES))
+    ap.add_argument("--out", default="bench_results_pushdown.json")
+    ap.add_argument("--compare", default=None, help="previous results file to diff against")
+    args = ap.parse_args(argv)
+
+    results = {}
+    for name in args.modes.split(","):
+        r = bench_mode(name, args)
+        results[name] = r
+        print(f"{name:<9} p50={r['p50_ms']}ms max={r['max_ms']}ms "
+              f"gas={r['gas_kb_per_view']}KB/view (first {r['gas_kb_first_view']}KB)")
+
+    out = {
+        "meta": result_meta({k: v for k, v in vars(args).items() if k not in ("out", "compare")}),
+        "results": results,
+    }
+    write_results(args.out, out)
+    print(f"results → {args.out}")
+
+    if args.compare:
+        if not os.path.exists(args.compare):
+            print(f"compare file not found: {args.compare}", file=sys.stderr)
+        else:
+            with open(args.compare, encoding="utf-8") as f:
+                prev = json.load(f)
+            for line in compare_results(prev, out, keys=("p50_ms", "gas_kb_per_view")):
+                print(line)
+
+
+if __name__ == "__main__":
+    main()
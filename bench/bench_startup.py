@@ -0,0 +1,154 @@
+"""
+Benchmark เวลา import main.py และเวลา start ของ server (cold start)
+
+- import : รัน `python -X importtime -c "import main"` ใน process ใหม่หลายรอบ
+           วัดเวลารวม + module ที่กินเวลามากสุด (รวมตาม package ชั้นบน)
+- startup: spawn `uvicorn main:app` → ตอบ request แรกได้ (ready_sec)
+           แล้ววัด request แรกของ /config, /status, /history (ชี้ไปที่ fake GAS)
+
+ตัวอย่าง:
+    python bench/bench_startup.py --runs 5 --out bench_results_startup.json
+    python bench/bench_startup.py --compare bench_results_startup.json --out bench_results_startup_new.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+import requests
+
+from common import REPO_ROOT, AppProcess, compare_results, percentile, result_meta, write_results
+from fake_gas import DEFAULT_LINE_ID, FakeGasData, serve_in_thread
+
+
+def _stats_ms(values: List[float]) -> dict:
+    v = sorted(values)
+    return {
+        "runs": len(v),
+        "p50_ms": round(percentile(v, 50) * 1000, 2),
+        "min_ms": round(v[0] * 1000, 2) if v else 0.0,
+        "max_ms": round(v[-1] * 1000, 2) if v else 0.0,
+    }
+
+
+def import_once(env: Dict[str, str]) -> dict:
+    """
+    import main ใน process ใหม่ 1 ครั้ง คืน {total_sec, packages: {pkg: self_sec}}
+    """
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=REPO_ROOT, env=env, capture_output=True, text=True, check=True,
+    )
+    packages: Dict[str, float] = {}
+    total = 0.0
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        try:
+            self_us = int(parts[0])
+            cum_us = int(parts[1])
+        except ValueError:
+            continue  # header
+        name = parts[2].strip()
+        pkg = name.split(".")[0]
+        packages[pkg] = packages.get(pkg, 0.0) + self_us / 1e6
+        if name == "main":
+            total = cum_us / 1e6
+    return {"total_sec": total, "packages": packages}
+
+
+def bench_import(env: Dict[str, str], runs: int, top: int) -> dict:
+    totals = []
+    pkg_sum: Dict[str, float] = {}
+    for _ in range(runs):
+        r = import_once(env)
+        totals.append(r["total_sec"])
+        for k, v in r["packages"].items():
+            pkg_sum[k] = pkg_sum.get(k, 0.0) + v
+    res = _stats_ms(totals)
+    res["top_packages_ms"] = {
+        k: round(v / runs * 1000, 2)
+        for k, v in sorted(pkg_sum.items(), key=lambda kv: kv[1], reverse=True)[:top]
+    }
+    res["linebot_on_import"] = "linebot" in pkg_sum
+    return res
+
+
+def bench_startup(env: Dict[str, str], device_id: str, line_id: str, runs: int) -> dict:
+    ready: List[float] = []
+    first: Dict[str, List[float]] = {"config": [], "status": [], "history": []}
+    for _ in range(runs):
+        with AppProcess(env, poll_interval=0.01) as app:
+            ready.append(app.ready_sec)
+            for name, path, params in (
+                ("config", "/config", {"id": device_id}),
+                ("status", "/status", {"line_id": line_id}),
+                ("history", "/history", {"line_id": line_id, "device_id": device_id}),
+            ):
+                t0 = time.perf_counter()
+                requests.get(f"{app.base_url}{path}", params=params, timeout=60).raise_for_status()
+                first[name].append(time.perf_counter() - t0)
+    res = {"ready": _stats_ms(ready)}
+    for name, values in first.items():
+        res[f"first_{name}"] = _stats_ms(values)
+    return res
+
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="HT-2025 import / startup benchmark")
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--top", type=int, default=10, help="show N slowest packages on import")
+    ap.add_argument("--devices", type=int, default=10)
+    ap.add_argument("--rows", type=int, default=1000)
+    ap.add_argument("--latency-ms", type=float, default=0.0, help="fake GAS latency per call")
+    ap.add_argument("--out", default="bench_results_startup.json")
+    ap.add_argument("--compare", default=None, help="previous results file to diff against")
+    args = ap.parse_args(argv)
+
+    data = FakeGasData(devices=args.devices, rows=args.rows, latency_ms=args.latency_ms)
+    fake = serve_in_thread(data)
+    fake_base = f"http://127.0.0.1:{fake.server_address[1]}"
+    env = dict(os.environ)
+    env.update({
+        "HT_GAS_URL": f"{fake_base}/exec",
+        "HT_LINE_API_URL": fake_base,
+        "HT_SNAPSHOT_PATH": "",   # วัด cold start จริง ไม่ใช้ snapshot
+    })
+
+    imp = bench_import(env, args.runs, args.top)
+    print(f"import   p50={imp['p50_ms']}ms min={imp['min_ms']}ms linebot_on_import={imp['linebot_on_import']}")
+    for pkg, ms in imp["top_packages_ms"].items():
+        print(f"    {pkg:<20} {ms} ms")
+
+    st = bench_startup(env, next(iter(data.config)), DEFAULT_LINE_ID, args.runs)
+    for name, r in st.items():
+        print(f"{name:<14} p50={r['p50_ms']}ms max={r['max_ms']}ms")
+
+    fake.shutdown()
+
+    flat = {"import": {k: v for k, v in imp.items() if k != "top_packages_ms"}}
+    flat.update(st)
+    out = {
+        "meta": result_meta({k: v for k, v in vars(args).items() if k not in ("out", "compare")}),
+        "results": flat,
+        "import_top_packages_ms": imp["top_packages_ms"],
+    }
+    write_results(args.out, out)
+    print(f"results → {args.out}")
+
+    if args.compare:
+        if not os.path.exists(args.compare):
+            print(f"compare file not found: {args.compare}", file=sys.stderr)
+        else:
+            with open(args.compare, encoding="utf-8") as f:
+                prev = json.load(f)
+            for line in compare_results(prev, out, keys=("p50_ms", "max_ms")):
+                print(line)
+
+
+if __name__ == "__main__":
+    main()
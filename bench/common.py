@@ -0,0 +1,201 @@
+"""
+ของที่ใช้ร่วมกันระหว่างสคริปต์ benchmark / load test
+- start uvicorn (main:app) เป็น subprocess ชี้ไปที่ fake GAS
+- สรุป latency เป็น p50 / p99 / throughput
+- เขียน / เปรียบเทียบผลลัพธ์เป็นไฟล์ JSON
+"""
+import json
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+
+import requests
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """
+    nearest-rank percentile (values ต้อง sort มาแล้ว)
+    """
+    if not sorted_values:
+        return 0.0
+    k = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[k]
+
+
+def summarize(latencies: List[float], errors: int, wall_sec: float) -> dict:
+    lat = sorted(latencies)
+    n = len(lat)
+    return {
+        "requests": n + errors,
+        "ok": n,
+        "errors": errors,
+        "error_rate": round(errors / (n + errors), 4) if (n + errors) else 0.0,
+        "wall_sec": round(wall_sec, 3),
+        "throughput_rps": round(n / wall_sec, 2) if wall_sec > 0 else 0.0,
+        "p50_ms": round(percentile(lat, 50) * 1000, 2),
+        "p90_ms": round(percentile(lat, 90) * 1000, 2),
+        "p99_ms": round(percentile(lat, 99) * 1000, 2),
+        "max_ms": round(lat[-1] * 1000, 2) if lat else 0.0,
+    }
+
+
+def run_load(call: Callable[[requests.Session, int], requests.Response], total: int, concurrency: int) -> dict:
+    """
+    ยิง call(session, i) ทั้งหมด total ครั้ง ด้วย thread concurrency ตัว
+    นับเป็น error ถ้า exception หรือ status >= 400
+    """
+    latencies: List[float] = []
+    errors = 0
+    lock = threading.Lock()
+    local = threading.local()
+
+    def one(i: int):
+        nonlocal errors
+        sess = getattr(local, "session", None)
+        if sess is None:
+            sess = local.session = requests.Session()
+        t0 = time.perf_counter()
+        try:
+            resp = call(sess, i)
+            ok = resp.status_code < 400
+            resp.content  # อ่าน body ให้ครบก่อนจับเวลา
+        except Exception:
+            ok = False
+        dt = time.perf_counter() - t0
+        with lock:
+            if ok:
+                latencies.append(dt)
+            else:
+                errors += 1
+
+    t_start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as ex:
+        list(ex.map(one, range(total)))
+    wall = time.perf_counter() - t_start
+    return summarize(latencies, errors, wall)
+
+
+class AppProcess:
+    """
+    รัน `uvicorn main:app` เป็น subprocess (ใช้เป็น context manager)
+    """
+
+    def __init__(self, env: Dict[str, str], port: Optional[int] = None, workers: int = 1, log_level: str = "warning",
+                 poll_interval: float = 0.2):
+        self.port = port or free_port()
+        self.env = dict(os.environ)
+        self.env.update(env)
+        self.workers = workers
+        self.log_level = log_level
+        self.poll_interval = poll_interval
+        self.proc: Optional[subprocess.Popen] = None
+        self.ready_sec: Optional[float] = None   # spawn → ตอบ request แรกได้
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def __enter__(self) -> "AppProcess":
+        cmd = [
+            sys.executable, "-m", "uvicorn", "main:app",
+            "--host", "127.0.0.1",
+            "--port", str(self.port),
+            "--log-level", self.log_level,
+            "--no-access-log",
+        ]
+        if self.workers > 1:
+            cmd += ["--workers", str(self.workers)]
+        self._t_spawn = time.perf_counter()
+        self.proc = subprocess.Popen(
+            cmd,
+            cwd=REPO_ROOT,
+            env=self.env,
+            stdout=subprocess.DEVNULL,
+        )
+        self.wait_ready()
+        return self
+
+    def wait_ready(self, timeout: float = 30.0):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.proc and self.proc.poll() is not None:
+                raise RuntimeError(f"uvicorn exited early with code {self.proc.returncode}")
+            try:
+                # /status ที่ไม่มี line_id ไม่ต้องเรียก GAS → ใช้เช็คว่า server ขึ้นแล้ว
+                requests.get(f"{self.base_url}/status", timeout=1)
+                self.ready_sec = time.perf_counter() - self._t_spawn
+                return
+            except requests.RequestException:
+                time.sleep(self.poll_interval)
+        raise RuntimeError("uvicorn did not become ready in time")
+
+    def __exit__(self, *exc):
+        if self.proc and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+
+
+def git_rev() -> str:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return "unknown"
+
+
+def result_meta(params: dict) -> dict:
+    return {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "git_rev": git_rev(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": params,
+    }
+
+
+def write_results(path: str, obj: dict):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(obj, f, ensure_ascii=False, indent=2)
+
+
+def compare_results(old: dict, new: dict, keys=("p50_ms", "p99_ms", "throughput_rps")) -> List[str]:
+    """
+    เทียบผลสองไฟล์ คืนบรรทัดข้อความสรุป (ใช้ print)
+    """
+    lines = []
+    old_res = old.get("results", {})
+    for name, cur in new.get("results", {}).items():
+        prev = old_res.get(name)
+        if not isinstance(prev, dict) or not isinstance(cur, dict):
+            continue
+        parts = []
+        for k in keys:
+            a, b = prev.get(k), cur.get(k)
+            if not isinstance(a, (int, float)) or not isinstance(b, (int, float)):
+                continue
+            delta = ((b - a) / a * 100.0) if a else 0.0
+            parts.append(f"{k} {a} → {b} ({delta:+.1f}%)")
+        if parts:
+            lines.append(f"{name:<10} " + " | ".join(parts))
+    return lines
@@ -0,0 +1,398 @@
+"""
+Fake Google Apps Script (GAS) + LINE Messaging API สำหรับ benchmark / load test
+
+- จำลอง action ที่ main.py เรียกทั้งหมด (config / subs / history / current_status)
+- ปรับ latency และขนาด dataset ได้ (จำนวน device, จำนวนแถว history ต่อ device)
+- LINE API ตอบ 200 เฉย ๆ แต่นับจำนวน push / reply ไว้ดูทีหลัง
+- GET /__stats คืนจำนวน call + bytes ที่ส่งออกของแต่ละ action
+
+ใช้แบบ standalone:
+    python bench/fake_gas.py --port 8765 --devices 20 --rows 2000 --latency-ms 300
+
+แล้วรัน server ด้วย
+    HT_GAS_URL=http://127.0.0.1:8765/exec HT_LINE_API_URL=http://127.0.0.1:8765 uvicorn main:app
+"""
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+DEFAULT_LINE_ID = "Cbench0000000000000000000000000000"
+READING_INTERVAL_SEC = 10 * 60
+
+
+def _iso_z(dt: datetime) -> str:
+    # GAS ส่ง Date ออกมาเป็นแบบ JSON.stringify → 2025-11-18T05:20:00.000Z
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def _flag_for_hic(hic: float) -> str:
+    # ladder เดียวกับ HT-2025.ino
+    if hic < 27:
+        return "white"
+    if hic < 32:
+        return "green"
+    if hic < 41:
+        return "yellow"
+    if hic < 55:
+        return "red"
+    return "black"
+
+
+class FakeGasData:
+    """
+    dataset ในหน่วยความจำ + handler ของแต่ละ action
+    """
+
+    def __init__(
+        self,
+        devices: int = 10,
+        rows: int = 1000,
+        line_id: str = DEFAULT_LINE_ID,
+        latency_ms: float = 0.0,
+        jitter_ms: float = 0.0,
+        line_latency_ms: float = 0.0,
+        seed: int = 2025,
+        since_support: bool = True,
+        pushdown_support: bool = True,
+    ):
+        self.latency_ms = latency_ms
+        self.since_support = since_support   # False = จำลอง Apps Script ตัวเก่าที่ไม่รู้จัก since
+        self.pushdown_support = pushdown_support  # id / start / end / order / offset / limit / columns (ดู gas_query.py)
+        self.jitter_ms = jitter_ms
+        self.line_latency_ms = line_latency_ms
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+        self.config: Dict[str, dict] = {}
+        self.subs: List[dict] = []
+        self.history: Dict[str, List[dict]] = {}  # id -> rows (เก่า → ใหม่)
+        self.append_keys: set = set()              # key ของ appendHistory ที่เขียนแล้ว
+
+        self.stats: Dict[str, Dict[str, int]] = {}
+        self.line_stats: Dict[str, int] = {"push": 0, "reply": 0, "multicast": 0, "messages": 0}
+
+        now = datetime.now(timezone.utc).replace(second=0, microsecond=0)
+        now -= timedelta(minutes=now.minute % 10)
+        for i in range(devices):
+            did = f"dev{i + 1:04d}"
+            self.config[did] = {"id": did, "unit": f"Unit {i + 1}", "adj_temp": 0.0, "adj_humid": 0.0}
+            self.subs.append({"id": did, "line_id": line_id, "created_at": _iso_z(now)})
+            dev_rows = []
+            for k in range(rows):
+                ts = now - timedelta(seconds=READING_INTERVAL_SEC * (rows - 1 - k))
+                temp = round(self.rng.uniform(24.0, 38.0), 2)
+                humid = round(self.rng.uniform(40.0, 90.0), 2)
+                hic = round(temp + (humid - 40.0) * 0.12, 2)
+                dev_rows.append({
+                    "id": did,
+                    "timestamp": _iso_z(ts),
+                    "temp": temp,
+                    "humid": humid,
+                    "hic": hic,
+                    "flag": _flag_for_hic(hic),
+                })
+            self.history[did] = dev_rows
+
+    # ---------- helpers ----------
+
+    def _sleep(self):
+        if self.latency_ms or self.jitter_ms:
+            time.sleep((self.latency_ms + self.rng.uniform(0, self.jitter_ms)) / 1000.0)
+
+    def _count(self, action: str, nbytes: int):
+        with self.lock:
+            st = self.stats.setdefault(action, {"calls": 0, "bytes_out": 0})
+            st["calls"] += 1
+            st["bytes_out"] += nbytes
+
+    def _ids_for_line(self, line_id: str) -> List[str]:
+        return list(dict.fromkeys(s["id"] for s in self.subs if s["line_id"] == line_id))
+
+    def _since(self, rows: List[dict], since: Optional[str]) -> List[dict]:
+        # timestamp เป็น ISO แบบเดียวกันหมด ⇒ เทียบ string ได้เลย
+        if not since or not self.since_support:
+            return list(rows)
+        return [r for r in rows if str(r["timestamp"]) > since]
+
+    @staticmethod
+    def _pushdown(rows: List[dict], params: Dict[str, str]) -> dict:
+        # rows เรียงใหม่ → เก่าแล้ว
+        if params.get("id"):
+            rows = [r for r in rows if r["id"] == params["id"]]
+        if params.get("start"):
+            rows = [r for r in rows if str(r["timestamp"]) >= params["start"]]
+        if params.get("end"):
+            rows = [r for r in rows if str(r["timestamp"]) < params["end"]]
+        if params.get("order") == "asc":
+            rows = rows[::-1]
+        total = len(rows)
+        offset = int(params.get("offset") or 0)
+        limit = int(params["limit"]) if params.get("limit") else None
+        rows = rows[offset:None if limit is None else offset + limit]
+        if params.get("columns"):
+            cols = params["columns"].split(",")
+            rows = [{k: r[k] for k in cols if k in r} for r in rows]
+        return {"success": True, "total": total, "count": len(rows), "data": rows}
+
+    @staticmethod
+    def _ok(data) -> dict:
+        if isinstance(data, list):
+            return {"success": True, "count": len(data), "data": data}
+        return {"success": True, "data": data}
+
+    # ---------- GET ----------
+
+    def handle_get(self, params: Dict[str, str]) -> dict:
+        action = params.get("action", "")
+        did = params.get("id", "")
+        line_id = params.get("line_id", "")
+
+        with self.lock:
+            if action == "getConfigById":
+                row = self.config.get(did)
+                return self._ok([dict(row)] if row else [])
+
+            if action == "listDevices":
+                return self._ok(list(self.config.keys()))
+
+            if action == "getSubscriptionsById":
+                return self._ok([dict(s) for s in self.subs if s["id"] == did])
+
+            if action == "getHistoryByIdSorted":
+                return self._ok(self._since(self.history.get(did, []), params.get("since")))
+
+            if action == "current_status":
+                data = []
+                for dev in self._ids_for_line(line_id):
+                    rows = self.history.get(dev, [])
+                    last = rows[-1] if rows else {}
+                    data.append({
+                        "id": dev,
+                        "unit": self.config.get(dev, {}).get("unit", dev),
+                        "lastupdate": last.get("timestamp", "-"),
+                        "temp": last.get("temp", ""),
+                        "humid": last.get("humid", ""),
+                        "hic": last.get("hic", ""),
+                        "flag": last.get("flag", ""),
+                        "status": "online",
+                    })
+                return self._ok(data)
+
+            if action == "history":
+                rows = []
+                for dev in self._ids_for_line(line_id):
+                    rows.extend(self._since(self.history.get(dev, []), params.get("since")))
+                rows.sort(key=lambda r: r["timestamp"], reverse=True)
+                if self.pushdown_support:
+                    return self._pushdown(rows, params)
+                return self._ok(rows)
+
+        return {"success": False, "message": f"unknown action: {action}"}
+
+    # ---------- POST ----------
+
+    def handle_post(self, payload: dict) -> dict:
+        action = payload.get("action", "")
+        did = str(payload.get("id", ""))
+
+        with self.lock:
+            if action == "writeConfig":
+                self.config[did] = {
+                    "id": did,
+                    "unit": payload.get("unit", ""),
+                    "adj_temp": payload.get("adj_temp", 0.0),
+                    "adj_humid": payload.get("adj_humid", 0.0),
+                }
+                return {"success": True, "message": "config saved"}
+
+            if action == "addSubscription":
+                line_id = payload.get("line_id", "")
+                if not any(s["id"] == did and s["line_id"] == line_id for s in self.subs):
+                    self.subs.append({"id": did, "line_id": line_id, "created_at": _iso_z(datetime.now(timezone.utc))})
+                return {"success": True, "message": "subscribed"}
+
+            if action == "removeSubscription":
+                line_id = payload.get("line_id", "")
+                before = len(self.subs)
+                self.subs = [s for s in self.subs if not (s["id"] == did and s["line_id"] == line_id)]
+                return {"success": True, "deleted": before - len(self.subs)}
+
+            if action == "appendHistory":
+                key = payload.get("key")
+                if key and key in self.append_keys:
+                    return {"success": True, "message": "duplicate", "duplicate": True}
+                if key:
+                    self.append_keys.add(key)
+                ts = payload.get("timestamp")
+                try:
+                    ts = _iso_z(datetime.fromtimestamp(float(ts), tz=timezone.utc))
+                except (TypeError, ValueError):
+                    ts = ts or _iso_z(datetime.now(timezone.utc))
+                self.history.setdefault(did, []).append({
+                    "id": did,
+                    "timestamp": ts,
+                    "temp": payload.get("temp"),
+                    "humid": payload.get("humid"),
+                    "hic": payload.get("hic"),
+                    "flag": payload.get("flag", "OK"),
+                })
+                return {"success": True, "message": "history appended"}
+
+            if action == "updateHistory":
+                by_ts = {str(r.get("timestamp")): r for r in payload.get("rows") or []}
+                updated = 0
+                for row in self.history.get(did, []):
+                    new = by_ts.get(str(row["timestamp"]))
+                    if new is not None:
+                        for k in ("temp", "humid", "hic", "flag"):
+                            if k in new:
+                                row[k] = new[k]
+                        updated += 1
+                return {"success": True, "updated": updated}
+
+        return {"success": False, "message": f"unknown action: {action}"}
+
+    def snapshot_stats(self) -> dict:
+        with self.lock:
+            return {
+                "gas": {k: dict(v) for k, v in self.stats.items()},
+                "line": dict(self.line_stats),
+            }
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats.clear()
+            for k in self.line_stats:
+                self.line_stats[k] = 0
+
+
+def _make_handler(data: FakeGasData):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, fmt, *args):  # เงียบ ๆ ไม่ต้อง log ทุก request
+            pass
+
+        def _send_json(self, obj, status: int = 200) -> int:
+            body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return len(body)
+
+        def _read_json(self) -> dict:
+            length = int(self.headers.get("Content-Length") or 0)
+            raw = self.rfile.read(length) if length else b""
+            try:
+                return json.loads(raw.decode("utf-8") or "{}")
+            except ValueError:
+                return {}
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+            if url.path == "/__stats":
+                self._send_json(data.snapshot_stats())
+                return
+            if url.path == "/__reset":
+                data.reset_stats()
+                self._send_json({"success": True})
+                return
+
+            data._sleep()
+            nbytes = self._send_json(data.handle_get(params))
+            data._count(params.get("action", "?"), nbytes)
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            payload = self._read_json()
+
+            # ---------- LINE Messaging API ----------
+            if url.path.startswith("/v2/bot/message/"):
+                kind = url.path.rsplit("/", 1)[-1]
+                if data.line_latency_ms:
+                    time.sleep(data.line_latency_ms / 1000.0)
+                with data.lock:
+                    data.line_stats[kind] = data.line_stats.get(kind, 0) + 1
+                    data.line_stats["messages"] += len(payload.get("messages", []))
+                self._send_json({})
+                return
+
+            # ---------- GAS ----------
+            data._sleep()
+            nbytes = self._send_json(data.handle_post(payload))
+            data._count(payload.get("action", "?"), nbytes)
+
+    return Handler
+
+
+class _QuietServer(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # client (uvicorn) ถูกปิดกลางคันตอนจบ benchmark ⇒ ไม่ต้องพ่น traceback
+        exc = sys.exc_info()[1]
+        if isinstance(exc, (BrokenPipeError, ConnectionResetError)):
+            return
+        super().handle_error(request, client_address)
+
+
+def make_server(data: FakeGasData, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    server = _QuietServer((host, port), _make_handler(data))
+    server.daemon_threads = True
+    return server
+
+
+def serve_in_thread(data: FakeGasData, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """
+    start server ใน background thread แล้วคืน server (ดู port ได้จาก server.server_address)
+    """
+    server = make_server(data, host, port)
+    t = threading.Thread(target=server.serve_forever, name="fake-gas", daemon=True)
+    t.start()
+    return server
+
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Fake GAS + LINE API for HT-2025 benchmarks")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--devices", type=int, default=10)
+    ap.add_argument("--rows", type=int, default=1000, help="history rows per device")
+    ap.add_argument("--line-id", default=DEFAULT_LINE_ID)
+    ap.add_argument("--latency-ms", type=float, default=0.0)
+    ap.add_argument("--jitter-ms", type=float, default=0.0)
+    ap.add_argument("--line-latency-ms", type=float, default=0.0)
+    ap.add_argument("--no-since", action="store_true", help="ignore since= like an older Apps Script")
+    ap.add_argument("--no-pushdown", action="store_true", help="ignore id/start/end/order/offset/limit/columns on history")
+    args = ap.parse_args(argv)
+
+    data = FakeGasData(
+        devices=args.devices,
+        rows=args.rows,
+        line_id=args.line_id,
+        latency_ms=args.latency_ms,
+        jitter_ms=args.jitter_ms,
+        line_latency_ms=args.line_latency_ms,
+        since_support=not args.no_since,
+        pushdown_support=not args.no_pushdown,
+    )
+    server = make_server(data, args.host, args.port)
+    print(f"fake GAS on http://{args.host}:{server.server_address[1]}/exec "
+          f"(devices={args.devices}, rows={args.rows}, latency={args.latency_ms}ms)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
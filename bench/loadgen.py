@@ -0,0 +1,305 @@
+"""
+Fleet load generator: จำลองเครื่อง HT-2025 หลายพันเครื่องยิง POST /history พร้อมกัน
+
+firmware ยิงเมื่อ getMinutes() % 10 == 0 ⇒ ทุกเครื่องยิงในไม่กี่วินาทีแรกของนาทีเดียวกัน
+สคริปต์นี้จำลอง burst แบบนั้น:
+- clock skew ต่อเครื่อง (NTP ไม่ตรงกันเป๊ะ) + jitter จาก loop delay(5000) ของ firmware
+- retry เมื่อพลาด (exponential backoff, ถ้า server ส่ง Retry-After / retry_after มาก็ใช้ค่านั้น)
+- churn: เครื่อง offline / กลับมา online ระหว่าง burst
+- poll GET /metrics ของ server ระหว่าง burst เพื่อดู in-flight / queue depth ฝั่ง server
+
+ตัวอย่าง:
+    # spawn fake GAS + uvicorn เอง
+    python bench/loadgen.py --devices 2000 --bursts 3 --interval-sec 30 --latency-ms 200
+
+    # ยิงเข้า server ที่รันอยู่แล้ว
+    python bench/loadgen.py --target http://127.0.0.1:8000 --devices 500 --bursts 1
+"""
+import argparse
+import heapq
+import json
+import random
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import requests
+
+from common import AppProcess, percentile, result_meta, write_results
+from fake_gas import FakeGasData, serve_in_thread
+
+
+class BurstStats:
+    def __init__(self, index: int):
+        self.index = index
+        self.lock = threading.Lock()
+        self.latencies: List[float] = []
+        self.attempts = 0
+        self.ok = 0
+        self.errors = 0
+        self.retries = 0
+        self.throttled = 0
+        self.gave_up = 0
+        self.online = 0
+        self.offline = 0
+        self.client_in_flight = 0
+        self.client_max_in_flight = 0
+        self.first_send: Optional[float] = None
+        self.last_done: Optional[float] = None
+        self.server_samples: List[dict] = []
+
+    def report(self) -> dict:
+        lat = sorted(self.latencies)
+        samples = self.server_samples
+        ingest_samples = [s.get("ingest", {}) for s in samples]
+        queue_samples = [s.get("queue", {}) for s in samples if isinstance(s.get("queue"), dict)]
+        return {
+            "burst": self.index,
+            "devices_online": self.online,
+            "devices_offline": self.offline,
+            "attempts": self.attempts,
+            "ok": self.ok,
+            "errors": self.errors,
+            "error_rate": round(self.errors / self.attempts, 4) if self.attempts else 0.0,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "gave_up": self.gave_up,
+            "burst_duration_sec": round((self.last_done or 0) - (self.first_send or 0), 3),
+            "latency_p50_ms": round(percentile(lat, 50) * 1000, 2),
+            "latency_p99_ms": round(percentile(lat, 99) * 1000, 2),
+            "latency_max_ms": round(lat[-1] * 1000, 2) if lat else 0.0,
+            "client_max_in_flight": self.client_max_in_flight,
+            "server_max_in_flight": max((s.get("max_in_flight", 0) for s in ingest_samples), default=None),
+            "server_p99_ms": max((s.get("p99_ms", 0) for s in ingest_samples), default=None),
+            "server_max_queue_depth": max((q.get("depth", 0) for q in queue_samples), default=None),
+        }
+
+
+class Fleet:
+    def __init__(self, args, target: str):
+        self.args = args
+        self.target = target.rstrip("/")
+        self.rng = random.Random(args.seed)
+        self.device_ids = [f"{args.prefix}{i + 1:05d}" for i in range(args.devices)]
+        # clock skew ต่อเครื่อง (คงที่) ± skew_sec
+        self.skew = {d: self.rng.uniform(-args.skew_sec, args.skew_sec) for d in self.device_ids}
+        self.online = {d: True for d in self.device_ids}
+        self.local = threading.local()
+
+    def _session(self) -> requests.Session:
+        sess = getattr(self.local, "session", None)
+        if sess is None:
+            sess = self.local.session = requests.Session()
+        return sess
+
+    def churn(self):
+        a = self.args
+        for d in self.device_ids:
+            if self.online[d]:
+                if self.rng.random() < a.offline_prob:
+                    self.online[d] = False
+            elif self.rng.random() < a.online_prob:
+                self.online[d] = True
+
+    def _retry_delay(self, resp: Optional[requests.Response], attempt: int, rng: random.Random) -> float:
+        a = self.args
+        if resp is not None:
+            hint = resp.headers.get("Retry-After")
+            try:
+                body = resp.json()
+                if isinstance(body, dict) and body.get("retry_after") is not None:
+                    hint = body.get("retry_after")
+            except ValueError:
+                pass
+            if hint is not None:
+                try:
+                    return min(float(hint), a.max_backoff_sec)
+                except (TypeError, ValueError):
+                    pass
+        base = a.backoff_sec * (2 ** attempt)
+        return min(base + rng.uniform(0, base), a.max_backoff_sec)
+
+    def send(self, device_id: str, boundary_epoch: int, stats: BurstStats):
+        a = self.args
+        # hash() ของ str สุ่ม salt ต่อ process ⇒ ใช้ crc32 + --seed ให้รันซ้ำได้ค่าเดิม
+        rng = random.Random(zlib.crc32(f"{a.seed}:{device_id}:{boundary_epoch}".encode()))
+        temp = round(rng.uniform(25, 38), 2)
+        humid = round(rng.uniform(40, 90), 2)
+        payload = {
+            "id": device_id,
+            "temp": temp,
+            "humid": humid,
+            "hic": round(temp + (humid - 40) * 0.12, 2),
+            "flag": "yellow",
+            "timestamp": str(boundary_epoch),
+        }
+        sess = self._session()
+        with stats.lock:
+            stats.client_in_flight += 1
+            stats.client_max_in_flight = max(stats.client_max_in_flight, stats.client_in_flight)
+            now = time.time()
+            if stats.first_send is None or now < stats.first_send:
+                stats.first_send = now
+        try:
+            for attempt in range(a.retries + 1):
+                resp = None
+                t0 = time.perf_counter()
+                try:
+                    resp = sess.post(f"{self.target}/history", json=payload, timeout=a.timeout_sec)
+                    ok = resp.status_code in (200, 201)
+                    if ok:
+                        try:
+                            body = resp.json()
+                            ok = not (isinstance(body, dict) and body.get("status") == "error")
+                        except ValueError:
+                            ok = False
+                except requests.RequestException:
+                    ok = False
+                dt = time.perf_counter() - t0
+                with stats.lock:
+                    stats.attempts += 1
+                    stats.latencies.append(dt)
+                    if ok:
+                        stats.ok += 1
+                    else:
+                        stats.errors += 1
+                        if resp is not None and resp.status_code in (429, 503):
+                            stats.throttled += 1
+                if ok:
+                    return
+                if attempt < a.retries:
+                    with stats.lock:
+                        stats.retries += 1
+                    time.sleep(self._retry_delay(resp, attempt, rng))
+            with stats.lock:
+                stats.gave_up += 1
+        finally:
+            with stats.lock:
+                stats.client_in_flight -= 1
+                stats.last_done = max(stats.last_done or 0, time.time())
+
+    def poll_metrics(self, stats: BurstStats, stop: threading.Event):
+        sess = requests.Session()
+        while not stop.is_set():
+            try:
+                resp = sess.get(f"{self.target}/metrics", params={"reset_peak": "true"}, timeout=2)
+                if resp.status_code == 200:
+                    sample = resp.json()
+                    sample["t"] = time.time()
+                    stats.server_samples.append(sample)
+            except (requests.RequestException, ValueError):
+                pass
+            stop.wait(self.args.metrics_interval_sec)
+
+    def run_burst(self, index: int, boundary: float, pool: ThreadPoolExecutor) -> dict:
+        a = self.args
+        stats = BurstStats(index)
+        self.churn()
+        active = [d for d in self.device_ids if self.online[d]]
+        stats.online = len(active)
+        stats.offline = len(self.device_ids) - len(active)
+
+        # schedule: เวลา fire = boundary + skew + jitter
+        schedule = [
+            (boundary + self.skew[d] + self.rng.uniform(0, a.jitter_sec), d)
+            for d in active
+        ]
+        heapq.heapify(schedule)
+
+        stop = threading.Event()
+        poller = threading.Thread(target=self.poll_metrics, args=(stats, stop), daemon=True)
+        poller.start()
+
+        futures = []
+        boundary_epoch = int(boundary)
+        while schedule:
+            fire_at, dev = heapq.heappop(schedule)
+            delay = fire_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            futures.append(pool.submit(self.send, dev, boundary_epoch, stats))
+        for f in futures:
+            f.result()
+
+        # ให้ poller เก็บ sample หลัง burst อีกนิด (ดู queue ระบายออก)
+        time.sleep(a.drain_watch_sec)
+        stop.set()
+        poller.join(timeout=5)
+        return stats.report()
+
+
+def main(argv: Optional[List[str]] = None):
+    ap = argparse.ArgumentParser(description="Simulate a fleet of HT-2025 devices hitting POST /history")
+    ap.add_argument("--target", default=None, help="existing server base URL (default: spawn local app + fake GAS)")
+    ap.add_argument("--devices", type=int, default=1000)
+    ap.add_argument("--prefix", default="sim")
+    ap.add_argument("--bursts", type=int, default=1)
+    ap.add_argument("--interval-sec", type=float, default=600.0, help="time between bursts (firmware: 600)")
+    ap.add_argument("--align", action="store_true", help="wait for the real wall-clock minute %% 10 == 0")
+    ap.add_argument("--lead-sec", type=float, default=2.0, help="first burst starts this many seconds from now")
+    ap.add_argument("--skew-sec", type=float, default=1.0, help="per-device clock skew ±")
+    ap.add_argument("--jitter-sec", type=float, default=6.0, help="per-send jitter (firmware loop ~5s)")
+    ap.add_argument("--retries", type=int, default=3)
+    ap.add_argument("--backoff-sec", type=float, default=1.0)
+    ap.add_argument("--max-backoff-sec", type=float, default=60.0)
+    ap.add_argument("--timeout-sec", type=float, default=30.0)
+    ap.add_argument("--offline-prob", type=float, default=0.02, help="chance an online device drops per burst")
+    ap.add_argument("--online-prob", type=float, default=0.5, help="chance an offline device returns per burst")
+    ap.add_argument("--max-inflight", type=int, default=1000, help="client threads (concurrent connections)")
+    ap.add_argument("--metrics-interval-sec", type=float, default=0.5)
+    ap.add_argument("--drain-watch-sec", type=float, default=2.0)
+    ap.add_argument("--seed", type=int, default=2025)
+    # ใช้เฉพาะตอน spawn fake GAS
+    ap.add_argument("--latency-ms", type=float, default=200.0)
+    ap.add_argument("--jitter-ms", type=float, default=100.0)
+    ap.add_argument("--workers", type=int, default=1)
+    ap.add_argument("--out", default="bench_results_loadgen.json")
+    args = ap.parse_args(argv)
+
+    fake = None
+    app_proc = None
+    if args.target:
+        target = args.target
+    else:
+        data = FakeGasData(devices=0, rows=0, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms)
+        fake = serve_in_thread(data)
+        fake_base = f"http://127.0.0.1:{fake.server_address[1]}"
+        app_proc = AppProcess({"HT_GAS_URL": f"{fake_base}/exec", "HT_LINE_API_URL": fake_base},
+                              workers=args.workers)
+        app_proc.__enter__()
+        target = app_proc.base_url
+
+    fleet = Fleet(args, target)
+    bursts: List[dict] = []
+    try:
+        start = time.time() + args.lead_sec
+        if args.align:
+            start = (int(time.time()) // 600 + 1) * 600
+            print(f"waiting {start - time.time():.0f}s for minute % 10 == 0 ...")
+        with ThreadPoolExecutor(max_workers=args.max_inflight) as pool:
+            for b in range(args.bursts):
+                boundary = start + b * args.interval_sec
+                wait = boundary - time.time() - args.skew_sec
+                if wait > 0:
+                    time.sleep(wait)
+                rep = fleet.run_burst(b, boundary, pool)
+                bursts.append(rep)
+                print(json.dumps(rep, ensure_ascii=False))
+    finally:
+        if app_proc:
+            app_proc.__exit__(None, None, None)
+        if fake:
+            fake.shutdown()
+
+    out = {
+        "meta": result_meta({k: v for k, v in vars(args).items() if k != "out"}),
+        "results": {f"burst_{r['burst']}": r for r in bursts},
+    }
+    write_results(args.out, out)
+    print(f"results → {args.out}")
+
+
+if __name__ == "__main__":
+    main()
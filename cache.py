@@ -0,0 +1,356 @@
+"""
+cache หน้าเว็บที่ render แล้ว (ตอนนี้ใช้กับ /status) แยกตาม line_id
++ SingleFlight สำหรับรวม call ที่เหมือนกันที่วิ่งอยู่พร้อมกัน (ใช้กับ GAS read)
++ SWRCache (stale-while-revalidate) สำหรับผล current_status / history
+
+หลังแจ้งเตือนรายชั่วโมง สมาชิกในกลุ่มกดลิงก์เดียวกันพร้อม ๆ กัน
+เดิมทุกคน = ยิง current_status ไป GAS 1 ครั้ง + render การ์ดใหม่ทั้งหมด
+
+- stream(key, render) ส่ง HTML เป็นชิ้น ๆ: มีใน cache ⇒ ทั้งหน้าชิ้นเดียว
+  miss ⇒ ส่งแต่ละส่วนที่ render ได้ออกไปเลย (ไม่ต้องรอทั้งหน้า) แล้วต่อกันเก็บลง cache ตอนจบ
+- miss พร้อมกันหลาย request ⇒ render แค่ตัวแรก (single-flight) ที่เหลือรอผลเดียวกัน
+- render คืน (ส่วนของ html, device_ids, cacheable) ⇒ จำว่าหน้านี้มี device ไหนบ้าง
+  invalidate_device(device_id) ล้างทุกหน้าที่มี device นั้น (ingest / config เปลี่ยน / offline)
+- ถูก invalidate ระหว่าง render ⇒ ผลรอบนั้นส่งให้คนที่รออยู่ แต่ไม่เก็บลง cache (generation)
+- max_age_sec กันกรณีข้อมูลใน Sheet ถูกแก้จากทางอื่น
+
+shared (SharedCache ดู shared.py) ⇒ cache ชั้นสองที่ใช้ร่วมกับ worker อื่น: miss ในตัวเองแล้วลองที่นั่นก่อนดึง / render เอง
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Set, Tuple
+
+logger = logging.getLogger("uvicorn.error")
+
+RenderResult = Tuple[Iterable[str], Iterable[str], bool]
+
+
+class _Flight:
+    __slots__ = ("event", "result", "error")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    do(key, fn): ถ้ามี call key เดียวกันกำลังทำอยู่ ⇒ รอผลของตัวนั้น (ไม่เรียก fn ซ้ำ)
+    ไม่ได้ cache: call เสร็จแล้ว call ถัดไปเรียก fn ใหม่
+    ผลลัพธ์ใช้ร่วมกันทุก caller ⇒ ห้ามแก้ object ที่ได้ (copy ก่อนถ้าจะแก้)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight: Dict[Hashable, _Flight] = {}
+        self.stats = {"calls": 0, "executed": 0, "coalesced": 0, "errors": 0}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self.lock:
+            self.stats["calls"] += 1
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = _Flight()
+                self.stats["executed"] += 1
+            else:
+                self.stats["coalesced"] += 1
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+
+        try:
+            flight.result = fn()
+            return flight.result
+        except BaseException as e:
+            flight.error = e
+            with self.lock:
+                self.stats["errors"] += 1
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+            flight.event.set()
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            snap = dict(self.stats)
+            snap["inflight"] = len(self.inflight)
+            return snap
+
+
+class PageCache:
+    def __init__(self, max_age_sec: float = 300.0, max_entries: int = 1000, shared=None):
+        self.max_age_sec = max_age_sec
+        self.max_entries = max_entries
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.entries: "OrderedDict[str, Tuple[float, str, Tuple[str, ...]]]" = OrderedDict()
+        self.by_device: Dict[str, Set[str]] = {}
+        self.generation: Dict[str, int] = {}
+        self.inflight: Dict[str, _Flight] = {}
+        self.stats = {"hits": 0, "misses": 0, "coalesced": 0, "renders": 0, "invalidations": 0, "shared_hits": 0}
+
+    def stream(self, key: str, render: Callable[[], RenderResult]) -> Iterator[str]:
+        with self.lock:
+            ent = self.entries.get(key)
+            if ent is not None and time.time() - ent[0] <= self.max_age_sec:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                hit = ent[1]
+            else:
+                hit = None
+                flight = self.inflight.get(key)
+                if flight is not None:
+                    self.stats["coalesced"] += 1
+                    leader = False
+                else:
+                    flight = self.inflight[key] = _Flight()
+                    self.stats["misses"] += 1
+                    leader = True
+                gen = self.generation.get(key, 0)
+        if hit is not None:
+            yield hit
+            return
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            yield flight.result
+            return
+
+        try:
+            got = self._from_shared(key, gen)
+            if got is not None:
+                flight.result = got
+                yield got
+                return
+            token = self.shared.token() if self.shared is not None else None
+            parts, device_ids, cacheable = render()
+            device_ids = tuple(device_ids)
+            out: List[str] = []
+            try:
+                for part in parts:
+                    out.append(part)
+                    yield part
+            except GeneratorExit:
+                # client ปิดกลางทาง ⇒ render ต่อให้จบ (request ที่รออยู่ / cache ยังต้องใช้)
+                out.extend(parts)
+                self._finish(key, gen, flight, "".join(out), device_ids, cacheable, token)
+                raise
+            self._finish(key, gen, flight, "".join(out), device_ids, cacheable, token)
+        except GeneratorExit:
+            raise
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+            flight.event.set()
+
+    def _finish(self, key: str, gen: int, flight: _Flight, html: str, device_ids: Tuple[str, ...], cacheable: bool,
+                token):
+        flight.result = html
+        with self.lock:
+            self.stats["renders"] += 1
+            stored = cacheable and self.generation.get(key, 0) == gen
+            if stored:
+                self._store_locked(key, html, device_ids)
+        if stored and self.shared is not None:
+            self.shared.put(key, (html, device_ids), time.time(), token, tags=[f"device:{d}" for d in device_ids])
+
+    def _from_shared(self, key: str, gen: int) -> Optional[str]:
+        """
+        หน้าที่ worker อื่น render ไว้ (ยังไม่เกิน max_age_sec) ⇒ เก็บเข้า cache ของตัวเองด้วย
+        """
+        if self.shared is None:
+            return None
+        got = self.shared.get(key)
+        if got is None or time.time() - got[1] > self.max_age_sec:
+            return None
+        (html, device_ids), rendered_at = got
+        with self.lock:
+            self.stats["shared_hits"] += 1
+            if self.generation.get(key, 0) == gen:
+                self._store_locked(key, html, tuple(device_ids), rendered_at)
+        return html
+
+    def _store_locked(self, key: str, html: str, device_ids: Tuple[str, ...], rendered_at: Optional[float] = None):
+        self._drop_locked(key)
+        self.entries[key] = (time.time() if rendered_at is None else rendered_at, html, device_ids)
+        for did in device_ids:
+            self.by_device.setdefault(did, set()).add(key)
+        while len(self.entries) > self.max_entries:
+            self._drop_locked(next(iter(self.entries)))
+
+    def _drop_locked(self, key: str):
+        ent = self.entries.pop(key, None)
+        if ent is None:
+            return
+        for did in ent[2]:
+            keys = self.by_device.get(did)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.by_device[did]
+
+    def invalidate(self, key: str):
+        with self.lock:
+            self.generation[key] = self.generation.get(key, 0) + 1
+            if key in self.entries:
+                self.stats["invalidations"] += 1
+            self._drop_locked(key)
+
+    def invalidate_device(self, device_id: str):
+        with self.lock:
+            keys = set(self.by_device.get(device_id, ()))
+            # หน้าที่กำลัง render อยู่ยังไม่รู้ว่ามี device ไหน ⇒ ไม่ให้เก็บผลรอบนั้น
+            keys.update(self.inflight)
+        for key in keys:
+            self.invalidate(key)
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            snap = dict(self.stats)
+            snap["entries"] = len(self.entries)
+            snap["inflight"] = len(self.inflight)
+            return snap
+
+
+class SWRCache:
+    """
+    stale-while-revalidate สำหรับผล GAS (current_status / history ต่อ line_id)
+
+    - อายุ <= fresh_sec           ⇒ คืนจาก cache
+    - fresh_sec < อายุ <= stale_sec ⇒ คืนจาก cache ทันที + refresh เบื้องหลัง 1 ตัวต่อ key
+    - ไม่มี / เกิน stale_sec       ⇒ fetch ตรงนั้น (ผ่าน gas_get ที่ coalesce อยู่แล้ว)
+    - expire(key) ⇒ ถือว่าไม่สดแล้ว (ยังเสิร์ฟของเดิมได้ระหว่าง refresh)
+    get() คืน (value, fetched_at) ไว้บอกผู้ใช้ว่าข้อมูลอายุเท่าไร
+    on_refresh(key) ถูกเรียกหลัง refresh เบื้องหลังสำเร็จ (เช่น ล้าง cache ของหน้าเว็บที่ใช้ข้อมูลนี้)
+    shared ⇒ miss / refresh ลองค่าที่ worker อื่นดึงไว้ก่อน, ดึงเองแล้วเก็บไว้ให้ worker อื่นด้วย
+    """
+
+    def __init__(self, fresh_sec: float = 60.0, stale_sec: float = 900.0, max_entries: int = 2000,
+                 on_refresh: Optional[Callable[[Hashable], None]] = None, shared=None):
+        self.fresh_sec = fresh_sec
+        self.stale_sec = max(stale_sec, fresh_sec)
+        self.max_entries = max_entries
+        self.on_refresh = on_refresh
+        self.shared = shared
+        self.lock = threading.Lock()
+        # key -> [fetched_at, value, expired]
+        self.entries: "OrderedDict[Hashable, list]" = OrderedDict()
+        self.refreshing: Set[Hashable] = set()
+        self.stats = {"fresh_hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, "refresh_errors": 0,
+                      "shared_hits": 0}
+
+    def get(self, key: Hashable, fetch: Callable[[], Any]) -> Tuple[Any, float]:
+        now = time.time()
+        with self.lock:
+            ent = self.entries.get(key)
+            if ent is not None:
+                age = now - ent[0]
+                if age <= self.fresh_sec and not ent[2]:
+                    self.entries.move_to_end(key)
+                    self.stats["fresh_hits"] += 1
+                    return ent[1], ent[0]
+                if age <= self.stale_sec:
+                    self.entries.move_to_end(key)
+                    self.stats["stale_hits"] += 1
+                    start = key not in self.refreshing
+                    if start:
+                        self.refreshing.add(key)
+                    value, fetched_at = ent[1], ent[0]
+                else:
+                    ent = None
+            if ent is None:
+                self.stats["misses"] += 1
+
+        if ent is None:
+            got = self.shared.get(key) if self.shared is not None else None
+            if got is not None and time.time() - got[1] <= self.stale_sec:
+                with self.lock:
+                    self.stats["shared_hits"] += 1
+                self.put(key, got[0], got[1])
+                return self.get(key, fetch)   # สด / stale ตามอายุของค่าที่ได้มา
+            token = self.shared.token() if self.shared is not None else None
+            value = fetch()
+            fetched_at = time.time()
+            self.put(key, value, fetched_at, token=token)
+            return value, fetched_at
+
+        if start:
+            threading.Thread(target=self._refresh, args=(key, fetch, fetched_at), daemon=True).start()
+        return value, fetched_at
+
+    def _refresh(self, key: Hashable, fetch: Callable[[], Any], since: float = 0.0):
+        try:
+            got = self.shared.get(key) if self.shared is not None else None
+            if got is not None and got[1] > since and time.time() - got[1] <= self.fresh_sec:
+                # worker อื่น refresh ไปแล้ว (หลัง invalidate ล่าสุด ไม่งั้นแถวถูกลบไปแล้ว)
+                self.put(key, got[0], got[1])
+                with self.lock:
+                    self.stats["shared_hits"] += 1
+            else:
+                token = self.shared.token() if self.shared is not None else None
+                value = fetch()
+                self.put(key, value, time.time(), token=token)
+                with self.lock:
+                    self.stats["refreshes"] += 1
+            if self.on_refresh is not None:
+                self.on_refresh(key)
+        except Exception:
+            logger.exception(f"background refresh of {key} failed")
+            with self.lock:
+                self.stats["refresh_errors"] += 1
+        finally:
+            with self.lock:
+                self.refreshing.discard(key)
+
+    def has(self, key: Hashable) -> bool:
+        """
+        มีค่าที่ get() คืนได้ทันที (สด หรือ stale ที่ยังไม่เกิน stale_sec)
+        """
+        with self.lock:
+            ent = self.entries.get(key)
+            return ent is not None and time.time() - ent[0] <= self.stale_sec
+
+    def put(self, key: Hashable, value: Any, fetched_at: Optional[float] = None, token: Optional[int] = None):
+        """
+        token (จาก shared.token() ก่อนเริ่ม fetch) ⇒ เก็บลง shared ด้วย
+        """
+        fetched_at = time.time() if fetched_at is None else fetched_at
+        with self.lock:
+            self.entries[key] = [fetched_at, value, False]
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        if token is not None and self.shared is not None:
+            self.shared.put(key, value, fetched_at, token)
+
+    def expire(self, key: Hashable):
+        with self.lock:
+            ent = self.entries.get(key)
+            if ent is not None:
+                ent[2] = True
+
+    def expire_if(self, pred: Callable[[Hashable], bool]):
+        with self.lock:
+            for key, ent in self.entries.items():
+                if pred(key):
+                    ent[2] = True
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            snap = dict(self.stats)
+            snap["entries"] = len(self.entries)
+            snap["refreshing"] = len(self.refreshing)
+            return snap
@@ -0,0 +1,215 @@
+"""
+history แบบ columnar (array ต่อ field) + join หลาย device ลง time grid เดียวกัน
+
+สร้างครั้งเดียวต่อผล history(line_id) (ดู fetch_history_by_line_id) แล้วใช้ร่วมกันทั้ง
+กราฟ / ตารางของ /history, /compare และ export CSV ไม่ต้องวน dict + _safe_float ซ้ำทุกหน้า
+- DeviceColumns: ts (int64) / temp / humid / hic (float64) / flag (uint8 + ตารางชื่อ) เรียงเก่า → ใหม่
+  ค่าที่ว่าง / แปลงไม่ได้ = NaN
+- bucket_join: ตัดเวลาเป็นช่องละ bucket_sec แล้วเฉลี่ยค่าของแต่ละ device ในช่อง
+  (ทุก device รวมเป็น bincount เดียว) ช่องที่ไม่มีค่า = NaN
+
+ts เป็น epoch จริง (gas_ts_key: timestamp ไม่มี Z = เวลาไทย ⇒ ลบ 7 ชม. แล้ว) ⇒ แถว Z / ไม่มี Z เรียง / ลง bucket ด้วยกันได้
+naive ใช้แค่ตอนแปลงกลับเป็น timestamp เดิม (timestamps)
+(import NumPy ตอนเรียกใช้ครั้งแรก เหมือน heat_index.py)
+"""
+import csv
+import io
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from heat_index import SENSOR_ERROR
+from snapshot import TH_OFFSET_SEC, gas_ts_format, gas_ts_parse
+
+FIELDS = ("temp", "humid", "hic")
+BUCKET_CHOICES_SEC = (600, 1800, 3600, 3 * 3600, 6 * 3600, 12 * 3600, 86400)
+CSV_HEADER = ("id", "timestamp", "temp", "humid", "hic", "flag")
+
+
+def _np():
+    import numpy as np
+    return np
+
+
+def _float_or_nan(v) -> float:
+    try:
+        if v is None or v == "":
+            return float("nan")
+        return float(v)
+    except (TypeError, ValueError):
+        return float("nan")
+
+
+class DeviceColumns:
+    __slots__ = ("device_id", "ts", "naive", "temp", "humid", "hic", "flag", "flag_names")
+
+    def __init__(self, device_id: str, ts, naive, temp, humid, hic, flag, flag_names: Tuple[str, ...]):
+        self.device_id = device_id
+        self.ts = ts                  # int64 epoch จริง (UTC)
+        self.naive = naive            # bool: timestamp เดิมไม่มี Z (เวลาไทย) ไว้แปลงกลับแบบเดิม
+        self.temp = temp
+        self.humid = humid
+        self.hic = hic
+        self.flag = flag              # uint8 index ใน flag_names
+        self.flag_names = flag_names
+
+    @classmethod
+    def from_rows(cls, device_id: str, rows: Iterable[dict]) -> "DeviceColumns":
+        """
+        rows ของ device เดียว (ลำดับไหนก็ได้) แถวที่ timestamp แปลงไม่ได้จะถูกข้าม
+        """
+        np = _np()
+        ts: List[float] = []
+        naive: List[bool] = []
+        cols: Dict[str, List[float]] = {f: [] for f in FIELDS}
+        flags: List[int] = []
+        names: Dict[str, int] = {}
+        for r in rows:
+            parsed = gas_ts_parse(r.get("timestamp"))
+            if parsed is None:
+                continue
+            ts.append(parsed[0])
+            naive.append(parsed[1])
+            for f in FIELDS:
+                cols[f].append(_float_or_nan(r.get(f)))
+            name = str(r.get("flag", "") or "")
+            code = names.get(name)
+            if code is None:
+                code = names[name] = len(names)
+            flags.append(code)
+        t = np.asarray(ts, dtype=np.float64).astype(np.int64)
+        order = np.argsort(t, kind="stable")
+        return cls(
+            device_id,
+            t[order],
+            np.asarray(naive, dtype=bool)[order],
+            *(np.asarray(cols[f], dtype=np.float64)[order] for f in FIELDS),
+            np.asarray(flags, dtype=np.uint8 if len(names) <= 256 else np.uint16)[order],
+            tuple(names),
+        )
+
+    @classmethod
+    def empty(cls, device_id: str) -> "DeviceColumns":
+        return cls.from_rows(device_id, ())
+
+    def __len__(self) -> int:
+        return len(self.ts)
+
+    def field(self, name: str):
+        if name not in FIELDS:
+            raise ValueError(f"unknown field: {name}")
+        return getattr(self, name)
+
+    def slice(self, lo: int, hi: int) -> "DeviceColumns":
+        """
+        แถว [lo, hi) (นับแบบเก่า → ใหม่) เป็น view ไม่ copy array
+        """
+        return DeviceColumns(self.device_id, self.ts[lo:hi], self.naive[lo:hi], self.temp[lo:hi],
+                             self.humid[lo:hi], self.hic[lo:hi], self.flag[lo:hi], self.flag_names)
+
+    def page_desc(self, page: int, per_page: int) -> "DeviceColumns":
+        """
+        หน้าที่ page (เริ่ม 1) เมื่อเรียงใหม่ → เก่า คืนเป็นช่วงเก่า → ใหม่ (แบบที่กราฟใช้)
+        """
+        n = len(self)
+        hi = max(0, n - (page - 1) * per_page)
+        return self.slice(max(0, hi - per_page), hi)
+
+    def labels(self) -> List[str]:
+        """
+        เวลาไทยแบบ format_ts_th (11/18/25-05:24)
+        """
+        epoch = datetime(1970, 1, 1, tzinfo=timezone.utc)
+        return [(epoch + timedelta(seconds=t + TH_OFFSET_SEC)).strftime("%m/%d/%y-%H:%M") for t in self.ts.tolist()]
+
+    def timestamps(self) -> List[str]:
+        """
+        timestamp แบบที่ GAS คืนมา (มี / ไม่มี Z ตามเดิม)
+        """
+        return [gas_ts_format(t, nv) for t, nv in zip(self.ts.tolist(), self.naive.tolist())]
+
+    def flags(self) -> List[str]:
+        names = self.flag_names
+        return [names[c] for c in self.flag.tolist()]
+
+    def values(self, name: str, nan: Optional[float] = None) -> List[float]:
+        """
+        field เป็น list ของ float (nan = ค่าแทน NaN, None = คง NaN ไว้)
+        """
+        arr = self.field(name)
+        if nan is not None:
+            arr = _np().nan_to_num(arr, nan=nan)
+        return arr.tolist()
+
+    def iter_csv(self) -> Iterator[str]:
+        """
+        CSV (เก่า → ใหม่) ทีละบรรทัด ค่าที่ไม่มี = ช่องว่าง
+        """
+        buf = io.StringIO()
+        w = csv.writer(buf)
+        did = self.device_id
+        for row in zip(self.timestamps(), self.values("temp"), self.values("humid"),
+                       self.values("hic"), self.flags()):
+            w.writerow((did, row[0], *("" if v != v else v for v in row[1:4]), row[4]))
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+
+
+def columns_by_device(rows: Iterable[dict], device_ids: Optional[Sequence[str]] = None) -> Dict[str, DeviceColumns]:
+    """
+    แถว history ของหลาย device (เช่นผล history(line_id)) → {device_id: DeviceColumns}
+    device_ids = เอาเฉพาะ device เหล่านี้ ตามลำดับนี้ (ไม่มีแถวก็ได้ columns ว่าง)
+    """
+    groups: Dict[str, List[dict]] = {}
+    for r in rows:
+        groups.setdefault(str(r.get("id", "")), []).append(r)
+    ids = list(device_ids) if device_ids is not None else list(groups)
+    return {did: DeviceColumns.from_rows(did, groups.get(did, ())) for did in ids}
+
+
+def pick_bucket_sec(span_sec: float, max_points: int = 400) -> int:
+    """
+    ช่องเวลาที่เล็กสุดที่ทำให้จำนวนจุดบนกราฟไม่เกิน max_points
+    """
+    for b in BUCKET_CHOICES_SEC:
+        if span_sec / b <= max_points:
+            return b
+    return BUCKET_CHOICES_SEC[-1]
+
+
+def bucket_join(columns: Sequence[DeviceColumns], field: str, bucket_sec: float,
+                start: Optional[float] = None, end: Optional[float] = None) -> Tuple[object, object]:
+    """
+    เฉลี่ย field ของทุก device ลงช่องเวลาเดียวกัน คืน (grid, matrix)
+    - grid: np.ndarray เวลาเริ่มของแต่ละช่อง (epoch จริงแบบ gas_ts_key) เก่า → ใหม่
+    - matrix: shape (len(columns), len(grid)) ช่องที่ device นั้นไม่มีค่า = NaN
+    start / end (ไม่รวม end) ไม่ใส่ = ตั้งแต่แถวแรก / ถึงแถวสุดท้ายของทุก device
+    """
+    np = _np()
+    n_dev = len(columns)
+    nonempty = [c for c in columns if len(c)]
+    if not nonempty:
+        return np.empty(0, dtype=np.float64), np.empty((n_dev, 0), dtype=np.float64)
+
+    if start is None:
+        start = min(float(c.ts[0]) for c in nonempty)
+    if end is None:
+        end = max(float(c.ts[-1]) for c in nonempty) + 1.0
+    t0 = np.floor(start / bucket_sec) * bucket_sec
+    n_buckets = max(0, int(np.ceil((end - t0) / bucket_sec)))
+    grid = t0 + np.arange(n_buckets, dtype=np.float64) * bucket_sec
+
+    # ทุก device ต่อกันเป็น array เดียว: ช่องรวม = dev * n_buckets + bucket
+    ts = np.concatenate([c.ts for c in columns])
+    vals = np.concatenate([c.field(field) for c in columns])
+    dev = np.repeat(np.arange(n_dev), [len(c) for c in columns])
+    keep = (ts >= start) & (ts < end) & ~np.isnan(vals) & (vals != SENSOR_ERROR)
+    bucket = ((ts[keep] - t0) // bucket_sec).astype(np.int64)
+    flat = dev[keep] * n_buckets + bucket
+
+    size = n_dev * n_buckets
+    sums = np.bincount(flat, weights=vals[keep], minlength=size)
+    counts = np.bincount(flat, minlength=size)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        matrix = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+    return grid, matrix.reshape(n_dev, n_buckets)
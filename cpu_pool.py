@@ -0,0 +1,155 @@
+"""
+process pool สำหรับงานที่กิน CPU (render หน้า /history /compare, export CSV, recompute ของ recalibrate)
+
+ทำใน thread ของ server ⇒ ถือ GIL ⇒ event loop (POST /history, /callback) ช้าตามไปด้วย
+ส่งไปทำใน process แยก (ProcessPoolExecutor แบบ spawn: server มี thread / mmap / sqlite เปิดค้าง fork ไม่ปลอดภัย)
+- งานค้าง (กำลังทำ + รอคิว) ครบ workers + queue_max ⇒ PoolBusy (หน้าเว็บตอบ 503 + Retry-After)
+- call() รอผลทีละช่วงสั้น ๆ ถ้า cancelled() คืน True (client หลุด) ⇒ ยกเลิกงานที่ยังไม่เริ่ม แล้วเลิกรอ (CallCancelled)
+  งานที่เริ่มไปแล้วหยุดกลางทางไม่ได้ ทำจนจบแล้วทิ้งผล
+- process ลูกตาย (BrokenProcessPool) ⇒ สร้าง pool ใหม่รอบหน้า งานนั้นตอบ PoolBusy (ไม่ทำแทนใน process ของ server:
+  งานที่ทำให้ลูกตาย (OOM / crash) จะทำให้ server ตายตาม)
+- process ลูก nice +nice ⇒ CPU ไม่พอ (เครื่องเล็ก / หลาย worker) OS ให้ process ของ server ก่อน
+- workers = 0 ⇒ ทำใน thread ที่เรียกเลย (แบบเดิม)
+
+fn ต้องเป็นฟังก์ชันระดับ module ที่ import ได้โดยไม่ import main (ดู render.py) args / ผลต้อง pickle ได้
+"""
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class PoolBusy(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"cpu pool busy, retry after {retry_after:g}s")
+        self.retry_after = retry_after
+
+
+class CallCancelled(Exception):
+    pass
+
+
+class CpuPool:
+    def __init__(self, workers: int, queue_max: int = 16, nice: int = 10, poll_sec: float = 0.1,
+                 retry_after_sec: float = 2.0):
+        self.workers = max(0, int(workers))
+        self.nice = nice
+        self.queue_max = max(0, int(queue_max))
+        self.poll_sec = poll_sec
+        self.retry_after_sec = retry_after_sec
+        self.lock = threading.Lock()
+        self.executor: Optional[ProcessPoolExecutor] = None
+        self.stopped = False
+        self.pending = 0
+        self.stats = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "cancelled": 0,
+                      "broken": 0, "abandoned": 0, "inline": 0, "max_pending": 0, "task_sec": 0.0}
+
+    def _executor(self) -> ProcessPoolExecutor:
+        with self.lock:
+            if self.stopped:
+                raise RuntimeError("cpu pool stopped")
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                                    initializer=os.nice, initargs=(self.nice,))
+            return self.executor
+
+    def start(self, warm: Optional[Callable[[], Any]] = None):
+        """
+        warm = งานเปล่า ๆ ส่งไปให้ process ลูก spawn + import ไว้ก่อน request แรก (ไม่รอผล)
+        """
+        if self.workers and warm is not None:
+            ex = self._executor()
+            for _ in range(self.workers):
+                ex.submit(warm)
+
+    def stop(self):
+        """
+        ทิ้งงานที่ยังไม่เริ่ม รองานที่ทำอยู่ให้จบแล้วปิด process ลูก
+        """
+        with self.lock:
+            self.stopped = True
+            ex, self.executor = self.executor, None
+        if ex is not None:
+            ex.shutdown(wait=True, cancel_futures=True)
+
+    def _admit(self, wait: bool, cancelled: Optional[Callable[[], bool]]):
+        while True:
+            with self.lock:
+                if self.pending < self.workers + self.queue_max:
+                    self.pending += 1
+                    self.stats["submitted"] += 1
+                    self.stats["max_pending"] = max(self.stats["max_pending"], self.pending)
+                    return
+                if not wait:
+                    self.stats["rejected"] += 1
+                    raise PoolBusy(self.retry_after_sec)
+            if cancelled is not None and cancelled():
+                raise CallCancelled()
+            time.sleep(self.poll_sec)
+
+    def _done(self, key: str, started: float):
+        with self.lock:
+            self.pending -= 1
+            self.stats[key] += 1
+            self.stats["task_sec"] += time.monotonic() - started
+
+    def _reset(self, ex: ProcessPoolExecutor):
+        with self.lock:
+            if self.executor is ex:
+                self.executor = None
+            self.stats["broken"] += 1
+        ex.shutdown(wait=False, cancel_futures=True)
+
+    def call(self, fn: Callable[..., Any], *args, cancelled: Optional[Callable[[], bool]] = None,
+             wait: bool = False) -> Any:
+        """
+        fn(*args) ใน process ลูก (sync รอผล เรียกจาก thread ไม่ใช่ event loop)
+        เต็ม ⇒ PoolBusy (wait=True ⇒ รอจนมีที่ว่าง เช่น chunk ถัดไปของ export ที่เริ่มส่งไปแล้ว)
+        cancelled() เป็น True ระหว่างรอ ⇒ CallCancelled
+        """
+        if not self.workers:
+            with self.lock:
+                self.stats["inline"] += 1
+            return fn(*args)
+
+        self._admit(wait, cancelled)
+        started = time.monotonic()
+        try:
+            ex = self._executor()
+            fut = ex.submit(fn, *args)
+        except (BrokenProcessPool, RuntimeError) as e:
+            # pool เพิ่งพัง / stop ไปแล้ว (กำลัง shutdown)
+            self._done("failed", started)
+            if isinstance(e, BrokenProcessPool):
+                self._reset(ex)
+            raise PoolBusy(self.retry_after_sec) from e
+        fut.add_done_callback(lambda f: self._done(
+            "cancelled" if f.cancelled() else "failed" if f.exception() is not None else "completed", started))
+
+        while True:
+            try:
+                return fut.result(timeout=self.poll_sec)
+            except concurrent.futures.TimeoutError:
+                if cancelled is not None and cancelled():
+                    if not fut.cancel():
+                        with self.lock:
+                            self.stats["abandoned"] += 1
+                    raise CallCancelled()
+            except BrokenProcessPool as e:
+                logger.warning("cpu pool: worker process died, restarting pool")
+                self._reset(ex)
+                raise PoolBusy(self.retry_after_sec) from e
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            snap = dict(self.stats)
+            snap["pending"] = self.pending
+        snap.update(workers=self.workers, queue_max=self.queue_max, task_sec=round(snap["task_sec"], 3))
+        return snap
@@ -0,0 +1,166 @@
+"""
+query history จาก GAS แบบส่งเงื่อนไขไปให้ Apps Script กรองเอง (pushdown)
+
+action=history&line_id=... รับ param เพิ่ม (Apps Script ตัวใหม่):
+- id       เฉพาะ device นี้
+- start / end   timestamp (แบบที่ GAS คืนมา) start <= ts < end
+- order    asc | desc (default desc เหมือนเดิม)
+- offset / limit   ช่วงแถวหลังกรอง + เรียงแล้ว
+- columns  ชื่อ field คั่นด้วย , (id / timestamp ติดมาเสมอ)
+แล้วคืน "total" = จำนวนแถวที่ตรงเงื่อนไขก่อน offset / limit
+
+Apps Script ตัวเก่าไม่รู้จัก param พวกนี้ ⇒ คืนทั้งห้อง (ใหม่ → เก่า) ไม่มี total
+⇒ กรองเองระหว่าง stream (keep) ผลลัพธ์เหมือนกัน แค่ไม่ประหยัด transfer
+ครั้งแรกยังไม่รู้ว่า script รองรับไหม ⇒ กรองแบบที่ถูกทั้งสองกรณี แล้วจำผลไว้ (PushdownProbe)
+"""
+import threading
+from typing import Callable, List, Optional, Sequence
+
+from snapshot import gas_ts_key
+
+ALWAYS_COLUMNS = ("id", "timestamp")
+
+
+class PushdownProbe:
+    """
+    จำว่า Apps Script รองรับ pushdown ไหม (None = ยังไม่รู้)
+    mode: "auto" = ดูจาก response, "1" = ถือว่ารองรับ, "0" = ไม่ส่ง param เลย
+    """
+
+    def __init__(self, mode: str = "auto"):
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.supported: Optional[bool] = {"1": True, "0": False}.get(mode)
+        self.stats = {"queries": 0, "pushed_down": 0, "local_fallback": 0}
+
+    def note(self, supported: bool):
+        with self.lock:
+            self.stats["queries"] += 1
+            self.stats["pushed_down" if supported else "local_fallback"] += 1
+            if self.mode == "auto":
+                self.supported = supported
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            snap = dict(self.stats)
+            snap["mode"] = self.mode
+            snap["supported"] = self.supported
+            return snap
+
+
+class HistoryQuery:
+    def __init__(self, line_id: str, device_id: Optional[str] = None,
+                 start: Optional[str] = None, end: Optional[str] = None,
+                 offset: int = 0, limit: Optional[int] = None, order: str = "desc",
+                 columns: Optional[Sequence[str]] = None):
+        if order not in ("asc", "desc"):
+            raise ValueError(f"order must be asc or desc: {order}")
+        self.line_id = line_id
+        self.device_id = device_id
+        self.start = start
+        self.end = end
+        self.offset = max(0, int(offset))
+        self.limit = limit
+        self.order = order
+        self.columns = tuple(dict.fromkeys(ALWAYS_COLUMNS + tuple(columns))) if columns else None
+        self._start_key = gas_ts_key(start) if start else None
+        self._end_key = gas_ts_key(end) if end else None
+
+    def params(self, pushdown: bool) -> dict:
+        params = {"action": "history", "line_id": self.line_id}
+        if not pushdown:
+            return params
+        if self.device_id:
+            params["id"] = self.device_id
+        if self.start:
+            params["start"] = self.start
+        if self.end:
+            params["end"] = self.end
+        if self.order != "desc":
+            params["order"] = self.order
+        if self.offset:
+            params["offset"] = self.offset
+        if self.limit is not None:
+            params["limit"] = self.limit
+        if self.columns:
+            params["columns"] = ",".join(self.columns)
+        return params
+
+    def matches(self, row: dict) -> bool:
+        if self.device_id and str(row.get("id", "")) != self.device_id:
+            return False
+        if self._start_key is None and self._end_key is None:
+            return True
+        key = gas_ts_key(row.get("timestamp"))
+        if key is None:
+            return False
+        if self._start_key is not None and key < self._start_key:
+            return False
+        if self._end_key is not None and key >= self._end_key:
+            return False
+        return True
+
+    def project(self, row: dict) -> dict:
+        if not self.columns:
+            return row
+        return {k: row[k] for k in self.columns if k in row}
+
+    def run(self, fetch_rows: Callable[..., dict], probe: PushdownProbe) -> dict:
+        """
+        fetch_rows(params, keep=...) แบบ gas_get_rows (ไม่ coalesce เอง: _Window เป็น state ของ call นี้
+        ⇒ ผู้เรียกรวม call ที่ซ้ำกันด้วย key())
+        คืน {"success", "total", "count", "data": [row ที่ project แล้ว]} เรียงตาม order
+        """
+        supported = probe.supported
+        window = _Window(self) if supported is False else None
+
+        def keep(row: dict) -> bool:
+            if not self.matches(row):
+                return False
+            return window.take() if window is not None else True
+
+        data = fetch_rows(self.params(supported is not False), keep=keep)
+        if not (isinstance(data, dict) and data.get("success")):
+            return data
+
+        rows: List[dict] = data.get("data", [])
+        pushed = supported is not False and "total" in data
+        probe.note(pushed)
+
+        if pushed:
+            total = int(data["total"])
+        else:
+            # Apps Script ไม่ได้กรอง ⇒ rows = แถวที่ตรงเงื่อนไข (ใหม่ → เก่า) ทั้งหมด / เฉพาะช่วงของ _Window
+            total = window.matched if window is not None else len(rows)
+            if self.order == "asc":
+                rows = rows[::-1]
+            if window is None or self.order == "asc":
+                hi = None if self.limit is None else self.offset + self.limit
+                rows = rows[self.offset:hi]
+        out = {k: v for k, v in data.items() if k not in ("data", "count", "total")}
+        out.update(success=True, total=total, count=len(rows), data=[self.project(r) for r in rows])
+        return out
+
+    def key(self) -> tuple:
+        return ("query", self.line_id, self.device_id, self.start, self.end,
+                self.offset, self.limit, self.order, self.columns)
+
+
+class _Window:
+    """
+    เก็บเฉพาะแถวที่อยู่ในช่วง offset / limit ตอน Apps Script ไม่รองรับ pushdown
+    (stream มาแบบใหม่ → เก่า; order=asc ⇒ นับช่วงจากท้ายไม่ได้จนกว่าจะรู้ total จึงเก็บทั้งหมด)
+    """
+
+    def __init__(self, q: HistoryQuery):
+        self.q = q
+        self.matched = 0
+
+    def take(self) -> bool:
+        i = self.matched
+        self.matched += 1
+        if self.q.order == "asc":
+            return True
+        if i < self.q.offset:
+            return False
+        return self.q.limit is None or i < self.q.offset + self.q.limit
@@ -0,0 +1,163 @@
+"""
+คำนวณ heat index (hic) + ธงสี ฝั่ง server
+
+สูตรเดียวกับ DHT.computeHeatIndex(temp, humid, false) ใน firmware (Rothfusz + ตัวปรับ)
+และ ladder ธงสีเดียวกับ HT-2025.ino: hic < 27 / 32 / 41 / 55
+
+- scalar (heat_index_c / flag_for_hic / check_reading) ใช้ตอน ingest ไม่ต้องมี NumPy
+- vectorised (*_array / recompute_arrays) ใช้ NumPy ไว้คำนวณย้อนหลังทีละหลายล้านแถว
+  (import NumPy ตอนเรียกใช้ครั้งแรก ไม่ให้ startup ช้า)
+"""
+import math
+from typing import List, Optional
+
+FLAG_NAMES = ("white", "green", "yellow", "red", "black")
+HIC_THRESHOLDS = (27.0, 32.0, 41.0, 55.0)   # ขอบล่างของ green / yellow / red / black
+FLAG_NONE = "none"                          # sensor อ่านไม่ได้ (firmware ส่ง -99)
+FLAG_CODE_NONE = -1
+SENSOR_ERROR = -99.0
+
+
+# ---------- scalar ----------
+
+def heat_index_c(temp_c: float, humid: float) -> float:
+    """
+    heat index (°C) จาก temp (°C) + humidity (%RH) แบบเดียวกับ DHT library
+    """
+    t = temp_c * 1.8 + 32.0
+    h = humid
+    hi = 0.5 * (t + 61.0 + ((t - 68.0) * 1.2) + (h * 0.094))
+
+    if hi > 79:
+        hi = (-42.379
+              + 2.04901523 * t
+              + 10.14333127 * h
+              - 0.22475541 * t * h
+              - 0.00683783 * t * t
+              - 0.05481717 * h * h
+              + 0.00122874 * t * t * h
+              + 0.00085282 * t * h * h
+              - 0.00000199 * t * t * h * h)
+
+        if h < 13 and 80.0 <= t <= 112.0:
+            hi -= ((13.0 - h) * 0.25) * math.sqrt((17.0 - abs(t - 95.0)) * 0.05882)
+        elif h > 85.0 and 80.0 <= t <= 87.0:
+            hi += ((h - 85.0) * 0.1) * ((87.0 - t) * 0.2)
+
+    return (hi - 32.0) * 0.55555
+
+
+def flag_for_hic(hic: float) -> str:
+    """
+    ธงสี (ตัวเล็ก แบบที่ firmware ส่งเข้า API) จาก hic
+    """
+    if hic == SENSOR_ERROR:
+        return FLAG_NONE
+    for name, upper in zip(FLAG_NAMES, HIC_THRESHOLDS):
+        if hic < upper:
+            return name
+    return FLAG_NAMES[-1]
+
+
+def compute_reading(temp_c: float, humid: float):
+    """
+    คืน (hic, flag) ของค่าที่ปรับ calibration แล้ว
+    """
+    if temp_c == SENSOR_ERROR or humid == SENSOR_ERROR:
+        return SENSOR_ERROR, FLAG_NONE
+    hic = heat_index_c(temp_c, humid)
+    return hic, flag_for_hic(hic)
+
+
+def check_reading(temp_c: float, humid: float, hic: float, flag: Optional[str], tolerance: float = 0.5) -> List[str]:
+    """
+    ตรวจค่า hic / flag ที่ device ส่งมาเทียบกับที่ server คำนวณเอง
+    คืน list ปัญหาที่เจอ (ว่าง = ตรงกัน)
+    """
+    issues: List[str] = []
+    exp_hic, exp_flag = compute_reading(temp_c, humid)
+    if exp_flag == FLAG_NONE:
+        if hic != SENSOR_ERROR:
+            issues.append(f"sensor error but hic={hic}")
+        return issues
+    if abs(exp_hic - hic) > tolerance:
+        issues.append(f"hic {hic:.2f} != expected {exp_hic:.2f}")
+    if flag is not None and str(flag).lower() != flag_for_hic(hic):
+        issues.append(f"flag {flag!r} != {flag_for_hic(hic)!r} for hic {hic:.2f}")
+    return issues
+
+
+# ---------- vectorised (NumPy) ----------
+
+def _np():
+    import numpy as np
+    return np
+
+
+def heat_index_c_array(temp_c, humid):
+    """
+    heat_index_c แบบ vectorised (รับ array / list คืน np.ndarray float64)
+    """
+    np = _np()
+    t = np.asarray(temp_c, dtype=np.float64) * 1.8 + 32.0
+    h = np.asarray(humid, dtype=np.float64)
+
+    simple = 0.5 * (t + 61.0 + ((t - 68.0) * 1.2) + (h * 0.094))
+
+    tt = t * t
+    hh = h * h
+    full = (-42.379
+            + 2.04901523 * t
+            + 10.14333127 * h
+            - 0.22475541 * t * h
+            - 0.00683783 * tt
+            - 0.05481717 * hh
+            + 0.00122874 * tt * h
+            + 0.00085282 * t * hh
+            - 0.00000199 * tt * hh)
+
+    in_t_dry = (h < 13) & (t >= 80.0) & (t <= 112.0)
+    dry = ((13.0 - h) * 0.25) * np.sqrt(np.clip((17.0 - np.abs(t - 95.0)) * 0.05882, 0.0, None))
+    wet_mask = (~in_t_dry) & (h > 85.0) & (t >= 80.0) & (t <= 87.0)
+    wet = ((h - 85.0) * 0.1) * ((87.0 - t) * 0.2)
+    full = full - np.where(in_t_dry, dry, 0.0) + np.where(wet_mask, wet, 0.0)
+
+    hi = np.where(simple > 79, full, simple)
+    return (hi - 32.0) * 0.55555
+
+
+def flag_codes_array(hic):
+    """
+    hic → รหัสธง int8 (index ใน FLAG_NAMES, FLAG_CODE_NONE = sensor error)
+    """
+    np = _np()
+    hic = np.asarray(hic, dtype=np.float64)
+    codes = np.searchsorted(np.asarray(HIC_THRESHOLDS), hic, side="right").astype(np.int8)
+    codes[hic == SENSOR_ERROR] = FLAG_CODE_NONE
+    return codes
+
+
+def flag_names_array(codes):
+    """
+    รหัสธง → ชื่อธง (np.ndarray ของ str)
+    """
+    np = _np()
+    names = np.asarray(FLAG_NAMES + (FLAG_NONE,))
+    return names[np.asarray(codes, dtype=np.int64)]   # -1 ⇒ ตัวสุดท้าย = "none"
+
+
+def recompute_arrays(temp_c, humid, delta_temp: float = 0.0, delta_humid: float = 0.0):
+    """
+    ปรับ calibration ย้อนหลัง: temp += delta_temp, humid += delta_humid แล้วคำนวณ hic / flag ใหม่
+    แถวที่เป็น sensor error (-99) คงค่าเดิม
+    คืน (temp, humid, hic, flag_codes)
+    """
+    np = _np()
+    t = np.asarray(temp_c, dtype=np.float64)
+    h = np.asarray(humid, dtype=np.float64)
+    bad = (t == SENSOR_ERROR) | (h == SENSOR_ERROR)
+
+    t2 = np.where(bad, t, t + delta_temp)
+    h2 = np.where(bad, h, np.clip(h + delta_humid, 0.0, 100.0))
+    hic = np.where(bad, SENSOR_ERROR, heat_index_c_array(t2, h2))
+    return t2, h2, hic, flag_codes_array(hic)
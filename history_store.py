@@ -0,0 +1,157 @@
+"""
+history ในเครื่อง + sync แบบ incremental จาก GAS
+
+เดิม history(line_id) / getHistoryByIdSorted คืนทั้งหมดทุกครั้ง ⇒ ยิ่งเก็บนาน ยิ่งช้า
+ตอนนี้:
+- จำ high-water mark (HWM) = timestamp ใหม่สุดที่มีแล้วของแต่ละ device
+- ขอ GAS เฉพาะแถวที่ timestamp > since (since = HWM - overlap_sec)
+  overlap กันแถวที่มาช้า (firmware ส่งซ้ำค่าเก่าตอน retry ⇒ timestamp เก่ากว่า HWM)
+- แถวที่ได้มา merge เข้า store (ตัดซ้ำด้วย timestamp) แล้วเลื่อน HWM
+- GAS ตัวเก่าที่ไม่รู้จัก since จะคืนทั้งหมด ⇒ ยังถูกต้อง (ตัดซ้ำ) แค่ไม่ประหยัด
+- full resync (reset) เฉพาะตอนสั่ง
+
+แถวใน store ใช้ร่วมกันหลาย request ⇒ ห้ามแก้ในที่ (แก้ผ่าน apply_updates)
+"""
+import bisect
+import threading
+from typing import Dict, Iterable, List, Optional
+
+from snapshot import gas_timestamp, gas_ts_key
+
+
+class _DeviceRows:
+    __slots__ = ("keys", "rows", "synced")
+
+    def __init__(self):
+        self.keys: List[float] = []   # timestamp (เรียงเก่า → ใหม่) คู่กับ rows
+        self.rows: List[dict] = []
+        self.synced = False           # เคย sync จาก GAS แล้ว (แม้ยังไม่มีแถวเลย)
+
+
+class HistoryStore:
+    def __init__(self, max_rows_per_device: int = 0, overlap_sec: float = 3600.0):
+        self.max_rows = max_rows_per_device   # 0 = ไม่จำกัด
+        self.overlap_sec = overlap_sec
+        self.lock = threading.Lock()
+        self.devices: Dict[str, _DeviceRows] = {}
+        self.stats = {"syncs": 0, "full_syncs": 0, "rows_fetched": 0, "rows_added": 0, "since_ignored": 0}
+
+    # ---------- HWM ----------
+
+    def hwm(self, device_id: str) -> Optional[float]:
+        with self.lock:
+            dev = self.devices.get(device_id)
+            return dev.keys[-1] if dev is not None and dev.keys else None
+
+    def since_for(self, device_ids: Iterable[str]) -> Optional[str]:
+        """
+        ค่า since สำหรับขอ GAS ของกลุ่ม device (เช่นทั้งห้อง) = HWM ต่ำสุด - overlap
+        None = ต้องดึงทั้งหมด (มี device ที่ยังไม่เคย sync)
+        """
+        marks = []
+        with self.lock:
+            for did in device_ids:
+                dev = self.devices.get(did)
+                if dev is None or not dev.synced:
+                    return None
+                if dev.keys:
+                    marks.append(dev.keys[-1])
+        if not marks:
+            return None
+        return gas_timestamp(min(marks) - self.overlap_sec)
+
+    # ---------- merge ----------
+
+    def merge(self, rows: List[dict], synced_ids: Iterable[str] = (), since: Optional[str] = None) -> int:
+        """
+        รวมแถวจาก GAS เข้า store คืนจำนวนแถวใหม่
+        synced_ids = device ที่ขอมาในรอบนี้ (ถือว่า sync แล้วแม้ไม่มีแถวกลับมา)
+        """
+        since_key = gas_ts_key(since) if since else None
+        keyed = []
+        for r in rows:
+            key = gas_ts_key(r.get("timestamp"))
+            if key is not None:
+                keyed.append((key, r))
+        keyed.sort(key=lambda kr: kr[0])   # GAS ส่ง history(line_id) มาแบบใหม่ → เก่า
+
+        added = 0
+        ignored = since_key is not None and bool(keyed) and keyed[0][0] <= since_key - self.overlap_sec
+        with self.lock:
+            for did in synced_ids:
+                self._dev(did).synced = True
+            for key, r in keyed:
+                dev = self._dev(str(r.get("id", "")))
+                dev.synced = True
+                if not dev.keys or key > dev.keys[-1]:
+                    dev.keys.append(key)
+                    dev.rows.append(dict(r))
+                else:
+                    i = bisect.bisect_left(dev.keys, key)
+                    if dev.keys[i] == key:
+                        continue
+                    dev.keys.insert(i, key)
+                    dev.rows.insert(i, dict(r))
+                added += 1
+                if self.max_rows and len(dev.rows) > self.max_rows:
+                    del dev.keys[0]
+                    del dev.rows[0]
+            self.stats["syncs"] += 1
+            if since is None:
+                self.stats["full_syncs"] += 1
+            if ignored:
+                self.stats["since_ignored"] += 1
+            self.stats["rows_fetched"] += len(rows)
+            self.stats["rows_added"] += added
+        return added
+
+    def _dev(self, device_id: str) -> _DeviceRows:
+        dev = self.devices.get(device_id)
+        if dev is None:
+            dev = self.devices[device_id] = _DeviceRows()
+        return dev
+
+    def apply_updates(self, device_id: str, rows: List[dict]):
+        """
+        เขียนทับค่าของแถวเดิม (key = timestamp) เช่นหลังปรับ calibration ย้อนหลัง
+        """
+        with self.lock:
+            dev = self.devices.get(device_id)
+            if dev is None:
+                return
+            for r in rows:
+                key = gas_ts_key(r.get("timestamp"))
+                i = bisect.bisect_left(dev.keys, key) if key is not None else len(dev.keys)
+                if i < len(dev.keys) and dev.keys[i] == key:
+                    dev.rows[i] = dict(dev.rows[i], **{k: v for k, v in r.items() if k != "timestamp"})
+
+    def reset(self, device_ids: Iterable[str]):
+        with self.lock:
+            for did in device_ids:
+                self.devices.pop(did, None)
+
+    # ---------- อ่าน ----------
+
+    def rows_desc(self, device_ids: Iterable[str]) -> List[dict]:
+        """
+        history ของหลาย device รวมกัน ใหม่ → เก่า (แบบเดียวกับ history(line_id) ของ GAS)
+        """
+        with self.lock:
+            parts = [(dev.keys, dev.rows) for dev in (self.devices.get(d) for d in device_ids) if dev is not None]
+        if len(parts) == 1:
+            return parts[0][1][::-1]
+        merged = [(k, r) for keys, rows in parts for k, r in zip(keys, rows)]
+        merged.sort(key=lambda kr: kr[0], reverse=True)
+        return [r for _, r in merged]
+
+    def rows_asc(self, device_id: str) -> List[dict]:
+        with self.lock:
+            dev = self.devices.get(device_id)
+            return list(dev.rows) if dev is not None else []
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            snap = dict(self.stats)
+            snap["devices"] = len(self.devices)
+            snap["rows"] = sum(len(d.rows) for d in self.devices.values())
+            return snap
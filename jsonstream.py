@@ -0,0 +1,105 @@
+"""
+อ่าน JSON response ของ GAS แบบ streaming (ไม่ต้องถือทั้ง document ไว้ใน memory)
+
+response ของ history เป็น {"success": true, "count": N, "data": [row, row, ...]}
+ห้องที่เก็บนาน ๆ data มีเป็นแสนแถว ⇒ resp.json() = ถือ text ทั้งก้อน + dict ทุกแถวพร้อมกัน
+
+iter_object(chunks, array_key) อ่าน object ชั้นบนทีละ key:
+- key ทั่วไป ⇒ yield (key, value)
+- key == array_key และเป็น array ⇒ yield (array_key, item) ทีละตัว (parse ด้วย raw_decode)
+ผู้เรียกทิ้งแถวที่ไม่ต้องการ / หยุดกลางทางได้ (break ⇒ ไม่อ่านส่วนที่เหลือ)
+"""
+import codecs
+import json
+from typing import Any, Iterable, Iterator, Tuple
+
+_WS = " \t\n\r"
+_COMPACT_AT = 1 << 16
+
+
+class _Reader:
+    def __init__(self, chunks: Iterable[bytes]):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.pos = 0
+        self.eof = False
+        self.json = json.JSONDecoder()
+
+    def fill(self) -> bool:
+        if self.eof:
+            return False
+        if self.pos > _COMPACT_AT:
+            self.text = self.text[self.pos:]
+            self.pos = 0
+        for chunk in self.chunks:
+            if chunk:
+                self.text += self.decoder.decode(chunk)
+                return True
+        self.text += self.decoder.decode(b"", final=True)
+        self.eof = True
+        return False
+
+    def peek(self) -> str:
+        """
+        ตัวอักษรถัดไปที่ไม่ใช่ whitespace ("" = จบ stream)
+        """
+        while True:
+            while self.pos < len(self.text) and self.text[self.pos] in _WS:
+                self.pos += 1
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                return ""
+
+    def expect(self, ch: str):
+        if self.peek() != ch:
+            raise ValueError(f"expected {ch!r} at offset {self.pos}, got {self.peek()!r}")
+        self.pos += 1
+
+    def value(self) -> Any:
+        """
+        JSON value ถัดไป (ยังมาไม่ครบ ⇒ อ่านเพิ่มแล้วลองใหม่)
+        """
+        self.peek()
+        while True:
+            try:
+                val, end = self.json.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if not self.fill():
+                    raise
+                continue
+            # ตัวเลข / true / false / null ที่ติดท้าย buffer อาจยังมาไม่ครบ
+            if end == len(self.text) and not self.eof and self.fill():
+                continue
+            self.pos = end
+            return val
+
+
+def iter_object(chunks: Iterable[bytes], array_key: str = "data") -> Iterator[Tuple[str, Any]]:
+    r = _Reader(chunks)
+    r.expect("{")
+    if r.peek() == "}":
+        return
+    while True:
+        key = r.value()
+        r.expect(":")
+        if key == array_key and r.peek() == "[":
+            r.expect("[")
+            if r.peek() == "]":
+                r.pos += 1
+            else:
+                while True:
+                    yield key, r.value()
+                    if r.peek() == ",":
+                        r.pos += 1
+                        continue
+                    r.expect("]")
+                    break
+        else:
+            yield key, r.value()
+        if r.peek() == ",":
+            r.pos += 1
+            continue
+        r.expect("}")
+        return
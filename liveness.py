@@ -0,0 +1,119 @@
+"""
+ตรวจจับ device ที่หายไป (offline) แบบ background
+
+เดิม online/offline คิดตอนเปิด /status หรือ /history เท่านั้น (calc_status_from_lastupdate)
+⇒ ไม่มีใครรู้ตอนเครื่องดับ
+
+ตอนนี้:
+- ทุก ingest ⇒ touch(device_id) บันทึกเวลาที่คาดว่าจะหมดอายุ (last_seen + window) ลง min-heap
+- sweep() pop เฉพาะตัวที่ถึงเวลาแล้ว ⇒ O(log n) ต่อ device ที่เปลี่ยนสถานะ
+- entry เก่าใน heap (device ส่งค่าใหม่มาแล้ว) ถูกข้ามตอน pop (lazy delete)
+- status(device_id) คืนสถานะที่รู้อยู่แล้ว ให้หน้าเว็บใช้ได้เลยไม่ต้อง parse timestamp ใหม่
+"""
+import heapq
+import threading
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from notify import TH_TZ
+
+
+class LivenessTracker:
+    def __init__(self, window_sec: float):
+        self.window_sec = float(window_sec)
+        self.lock = threading.Lock()
+        self.last_seen: Dict[str, float] = {}
+        self.deadline: Dict[str, float] = {}
+        self.state: Dict[str, str] = {}          # device_id -> "online" / "offline"
+        self.heap: List[Tuple[float, str]] = []
+
+    def touch(self, device_id: str, seen_at: Optional[float] = None) -> bool:
+        """
+        device ส่งค่ามา ⇒ online ต่ออีก window_sec
+        คืน True ถ้าเพิ่งกลับมา online (ก่อนหน้านี้ offline)
+        """
+        seen_at = time.time() if seen_at is None else seen_at
+        with self.lock:
+            prev = self.last_seen.get(device_id)
+            if prev is not None and seen_at < prev:
+                return False
+            self.last_seen[device_id] = seen_at
+            dl = seen_at + self.window_sec
+            self.deadline[device_id] = dl
+            heapq.heappush(self.heap, (dl, device_id))
+            came_back = self.state.get(device_id) == "offline"
+            self.state[device_id] = "online"
+            return came_back
+
+    def seed(self, device_id: str, seen_at: float, now: Optional[float] = None):
+        """
+        รู้จัก device จาก lastupdate ของ GAS (ตอนเปิดหน้าเว็บ) โดยไม่ถือเป็น transition
+        ใช้เฉพาะ device ที่ยังไม่เคยเห็นใน process นี้
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            if device_id in self.last_seen:
+                return
+            self.last_seen[device_id] = seen_at
+            dl = seen_at + self.window_sec
+            self.deadline[device_id] = dl
+            if dl > now:
+                self.state[device_id] = "online"
+                heapq.heappush(self.heap, (dl, device_id))
+            else:
+                self.state[device_id] = "offline"
+
+    def sweep(self, now: Optional[float] = None) -> List[Tuple[str, float]]:
+        """
+        คืน [(device_id, last_seen), ...] ที่เพิ่งเปลี่ยนเป็น offline รอบนี้
+        """
+        now = time.time() if now is None else now
+        gone: List[Tuple[str, float]] = []
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                dl, did = heapq.heappop(self.heap)
+                if self.deadline.get(did) != dl:
+                    continue  # มีค่าใหม่กว่ามาแล้ว
+                if self.state.get(did) == "online":
+                    self.state[did] = "offline"
+                    gone.append((did, self.last_seen.get(did, 0.0)))
+        return gone
+
+    def status(self, device_id: str) -> Optional[str]:
+        """
+        สถานะที่รู้ (online / offline) หรือ None ถ้ายังไม่เคยเห็น device นี้
+        เช็ค deadline ด้วย เผื่อ sweep ยังไม่ทันรอบ
+        """
+        with self.lock:
+            st = self.state.get(device_id)
+            if st == "online" and self.deadline.get(device_id, 0.0) <= time.time():
+                return "offline"
+            return st
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            online = sum(1 for v in self.state.values() if v == "online")
+            return {
+                "tracked": len(self.state),
+                "online": online,
+                "offline": len(self.state) - online,
+                "heap_size": len(self.heap),
+            }
+
+
+def build_offline_message(unit_name: str, device_id: str, last_seen: float, window_sec: float) -> str:
+    last_txt = datetime.fromtimestamp(last_seen, TH_TZ).strftime("%m/%d/%y-%H:%M") if last_seen else "-"
+    return "\n".join([
+        f"⚪️ อุปกรณ์ออฟไลน์ หน่วย: {unit_name}",
+        f"Device ID: {device_id}",
+        f"-ไม่มีข้อมูลเข้ามาเกิน {int(window_sec // 60)} นาที",
+        f"-อัปเดตล่าสุด: {last_txt}",
+    ])
+
+
+def build_online_message(unit_name: str, device_id: str) -> str:
+    return "\n".join([
+        f"🟢 อุปกรณ์กลับมาออนไลน์ หน่วย: {unit_name}",
+        f"Device ID: {device_id}",
+    ])
@@ -1,23 +1,112 @@
 from fastapi import FastAPI, Request, Form, Query
-from fastapi.responses import PlainTextResponse, HTMLResponse
-from linebot import LineBotApi, WebhookParser
-from linebot.exceptions import InvalidSignatureError
-from linebot.models import (
-    MessageEvent,
-    TextMessage,
-    TextSendMessage,
-    FlexSendMessage,
-)
+from fastapi.responses import PlainTextResponse, HTMLResponse, JSONResponse, StreamingResponse
+from anyio import from_thread
+import asyncio
 import logging
-import requests
+import math
+import multiprocessing
+import os
 import json
-from typing import Optional, List
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Iterator, Optional, List, Tuple
 from pydantic import BaseModel
 from datetime import datetime, timezone, timedelta
 
+import render
+from admission import IngestAdmission
+from cache import PageCache, SWRCache
+from columnar import BUCKET_CHOICES_SEC, CSV_HEADER, DeviceColumns, columns_by_device
+from cpu_pool import CallCancelled, CpuPool, PoolBusy
+from alerts import Alert, AlertEngine, reading_epoch
+from heat_index import check_reading
+from gas_query import HistoryQuery
+from history_store import HistoryStore
+from liveness import LivenessTracker, build_offline_message, build_online_message
+from notify import HourlyNotifier, LinePushSender
+from recalibrate import Recalibrator
+from ring import RingSet
+from shared import SharedCache, SharedState, SharedTokenBucket
+from snapshot import WarmState, gas_timestamp, gas_ts_key
+from storage import build_storage
+
 TH_TZ = timezone(timedelta(hours=7))
 ZO_TZ = timezone(timedelta(hours=0))
 ONLINE_WINDOW_SEC = 15 * 60  # 15 นาที
+LIVENESS_SWEEP_SEC = 30       # รอบตรวจ device ที่หายไป
+
+# ---------- ingest admission (POST /history) ----------
+INGEST_QUEUE_MAX = int(os.environ.get("HT_INGEST_QUEUE_MAX", "5000"))
+INGEST_WORKERS = int(os.environ.get("HT_INGEST_WORKERS", "4"))
+# งานที่เขียนลง storage ต่อวินาที (gas = ยิง GAS ตรง, sqlite / tiered = เขียน local แล้ว GAS ทยอยส่งเอง)
+INGEST_DRAIN_PER_SEC = float(os.environ.get(
+    "HT_INGEST_DRAIN_PER_SEC", "5" if os.environ.get("HT_STORAGE", "gas") == "gas" else "200"
+))
+INGEST_GLOBAL_PER_SEC = float(os.environ.get("HT_INGEST_GLOBAL_PER_SEC", "50"))
+INGEST_GLOBAL_BURST = float(os.environ.get("HT_INGEST_GLOBAL_BURST", "1000"))
+INGEST_DEVICE_PER_MIN = float(os.environ.get("HT_INGEST_DEVICE_PER_MIN", "1"))
+INGEST_DEVICE_BURST = float(os.environ.get("HT_INGEST_DEVICE_BURST", "3"))
+INGEST_RETRY_MAX_SEC = 60
+INGEST_SHUTDOWN_GRACE_SEC = 20
+
+# ---------- LINE แจ้งเตือนรายชั่วโมง ----------
+HOURLY_NOTIFY_ENABLED = os.environ.get("HT_HOURLY_NOTIFY", "1") != "0"
+LINE_PUSH_PER_SEC = float(os.environ.get("HT_LINE_PUSH_PER_SEC", "10"))
+ALERT_RULES_PATH = os.environ.get("HT_ALERT_RULES")  # ไฟล์ JSON ของ alert rule (ไม่ใส่ = ใช้ค่า default)
+
+# ---------- ปรับ calibration ย้อนหลัง ----------
+RECAL_DIR = os.environ.get("HT_RECAL_DIR", "recal_jobs")           # checkpoint ของแต่ละ job
+RECAL_CHUNK_ROWS = int(os.environ.get("HT_RECAL_CHUNK_ROWS", "500"))
+RECAL_PAUSE_SEC = float(os.environ.get("HT_RECAL_PAUSE_SEC", "0.5"))
+
+# ---------- snapshot / warm start ----------
+SNAPSHOT_PATH = os.environ.get("HT_SNAPSHOT_PATH", "ht_snapshot.bin")   # "" = ปิด
+SNAPSHOT_EVERY_SEC = float(os.environ.get("HT_SNAPSHOT_EVERY_SEC", "300"))
+SNAPSHOT_HISTORY_ROWS = int(os.environ.get("HT_SNAPSHOT_HISTORY_ROWS", "1008"))  # 7 วัน ที่ 10 นาที/แถว
+
+# ---------- cache หน้า /status ----------
+STATUS_PAGE_MAX_AGE_SEC = float(os.environ.get("HT_STATUS_PAGE_MAX_AGE_SEC", "300"))
+
+# ---------- cache ผล current_status / history (stale-while-revalidate) ----------
+GAS_CACHE_FRESH_SEC = float(os.environ.get("HT_GAS_CACHE_FRESH_SEC", "60"))
+GAS_CACHE_STALE_SEC = float(os.environ.get("HT_GAS_CACHE_STALE_SEC", "900"))
+
+# ---------- history ในเครื่อง + sync แบบ incremental ----------
+HISTORY_STORE_MAX_ROWS = int(os.environ.get("HT_HISTORY_STORE_MAX_ROWS", "0"))          # ต่อ device, 0 = ไม่จำกัด
+HISTORY_SYNC_OVERLAP_SEC = float(os.environ.get("HT_HISTORY_SYNC_OVERLAP_SEC", "3600"))  # ขอย้อนจาก HWM กันแถวที่มาช้า
+GAS_STREAM_CHUNK_BYTES = int(os.environ.get("HT_GAS_STREAM_CHUNK_BYTES", "65536"))     # อ่าน response history ทีละก้อน
+
+# ---------- pushdown เงื่อนไข history ไปให้ Apps Script (ดู gas_query.py) ----------
+GAS_PUSHDOWN = os.environ.get("HT_GAS_PUSHDOWN", "auto")                 # auto | 1 | 0
+HISTORY_PAGE_QUERY = os.environ.get("HT_HISTORY_PAGE_QUERY", "1") != "0"  # /history ที่ยังไม่มีใน cache ⇒ ขอเฉพาะหน้า
+
+# ---------- ค่าล่าสุดของแต่ละ device ใน ring buffer (mmap ใช้ร่วมกันทุก worker ดู ring.py) ----------
+RING_DIR = os.environ.get("HT_RING_DIR", "ht_rings")      # "" = ปิด
+RING_ROWS = int(os.environ.get("HT_RING_ROWS", "432"))    # ต่อ device (432 = 3 วัน ที่ 10 นาที/แถว)
+
+# ---------- ที่เก็บข้อมูล (ดู storage.py) ----------
+STORAGE_BACKEND = os.environ.get("HT_STORAGE", "gas")               # gas | sqlite | tiered (SQLite + mirror ไป GAS)
+SQLITE_PATH = os.environ.get("HT_SQLITE_PATH", "ht_storage.sqlite3")
+HISTORY_RAW_DAYS = float(os.environ.get("HT_HISTORY_RAW_DAYS", "90"))             # sqlite: เก่ากว่านี้เหลือแค่ rollup
+HISTORY_RETENTION_DAYS = float(os.environ.get("HT_HISTORY_RETENTION_DAYS", "0"))  # sqlite: เก่ากว่านี้ลบทิ้ง (0 = เก็บตลอด)
+HISTORY_ROLLUP_MIN = int(os.environ.get("HT_HISTORY_ROLLUP_MIN", "60"))            # ขนาด bucket ของ rollup
+MIRROR_BATCH = int(os.environ.get("HT_MIRROR_BATCH", "50"))                        # tiered: แถว outbox ต่อรอบ
+MIRROR_BACKOFF_MAX_SEC = float(os.environ.get("HT_MIRROR_BACKOFF_MAX_SEC", "300"))  # GAS ล่ม ⇒ พักนานสุด
+MIRROR_MAX_ATTEMPTS = int(os.environ.get("HT_MIRROR_MAX_ATTEMPTS", "8"))            # GAS ตอบ success=false เกินนี้ ⇒ outbox_dead
+GAS_CONNECT_TIMEOUT_SEC = float(os.environ.get("HT_GAS_CONNECT_TIMEOUT_SEC", "10"))  # ทุก request ไป GAS
+GAS_READ_TIMEOUT_SEC = float(os.environ.get("HT_GAS_READ_TIMEOUT_SEC", "60"))        # รอ byte ถัดไปนานสุด (ไม่ใช่เวลารวม)
+
+# ---------- หลาย worker (uvicorn --workers N) ดู shared.py ----------
+SHARED_MODE = os.environ.get("HT_SHARED", "auto")       # auto (เปิดเมื่อรันเป็น worker ของ uvicorn --workers) | 1 | 0
+SHARED_PATH = os.environ.get("HT_SHARED_PATH", "ht_shared.sqlite3")
+SHARED_POLL_SEC = float(os.environ.get("HT_SHARED_POLL_SEC", "0.2"))
+
+# ---------- process pool ของงานกิน CPU: render /history /compare, export CSV, recalibrate (ดู cpu_pool.py) ----------
+CPU_POOL_WORKERS = int(os.environ.get("HT_CPU_POOL_WORKERS", "2"))   # ต่อ worker ของ uvicorn, 0 = ทำใน thread เหมือนเดิม
+CPU_POOL_QUEUE = int(os.environ.get("HT_CPU_POOL_QUEUE", "8"))       # งานรอคิวได้อีกเท่านี้ เกิน ⇒ 503
+EXPORT_CHUNK_ROWS = int(os.environ.get("HT_EXPORT_CHUNK_ROWS", "5000"))  # export CSV ส่งไป pool ทีละกี่แถว
+PAGE_STREAM_ROWS = int(os.environ.get("HT_PAGE_STREAM_ROWS", "100"))      # ตาราง /history ส่งทีละกี่แถว
 
 def format_ts_th(s: str) -> str:
     """
@@ -52,21 +141,182 @@ LINE_CHANNEL_ACCESS_TOKEN = "irnHkqFbWyJW5SAVKPbqv9bITkPaZIXWNKlXfg7RKUYwLVNufpW
 
 # 🌐 BASE URL ของเว็บเรา (ใช้สร้างลิงก์ให้ user คลิกจาก LINE)
 # WEB_BASE_URL = "https://fb59454d4019.ngrok-free.app"  # <--- แก้ตรงนี้เวลาเปลี่ยน ngrok
-WEB_BASE_URL = "https://ht-2025.onrender.com"
+WEB_BASE_URL = os.environ.get("HT_WEB_BASE_URL", "https://ht-2025.onrender.com")
 
-print(f"SECRET length: {len(LINE_CHANNEL_SECRET)}")
-print(f"TOKEN length: {len(LINE_CHANNEL_ACCESS_TOKEN)}")
-
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
-parser = WebhookParser(LINE_CHANNEL_SECRET)
+# LINE API endpoint (เปลี่ยนได้ เช่นชี้ไป fake LINE API ตอน benchmark)
+LINE_API_URL = os.environ.get("HT_LINE_API_URL", "https://api.line.me")
 
 logger = logging.getLogger("uvicorn.error")
 
+# LINE SDK import + สร้าง client ตอนใช้ครั้งแรก (หน้า /status /history /config ไม่ต้องรอ)
+_line_lock = threading.Lock()
+_line_bot_api = None
+_webhook_parser = None
+
+
+def get_line_bot_api():
+    global _line_bot_api
+    if _line_bot_api is None:
+        with _line_lock:
+            if _line_bot_api is None:
+                from linebot import LineBotApi
+
+                logger.info(f"LINE TOKEN length: {len(LINE_CHANNEL_ACCESS_TOKEN)}")
+                _line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN, endpoint=LINE_API_URL)
+    return _line_bot_api
+
+
+def get_webhook_parser():
+    global _webhook_parser
+    if _webhook_parser is None:
+        with _line_lock:
+            if _webhook_parser is None:
+                from linebot import WebhookParser
+
+                logger.info(f"LINE SECRET length: {len(LINE_CHANNEL_SECRET)}")
+                _webhook_parser = WebhookParser(LINE_CHANNEL_SECRET)
+    return _webhook_parser
+
 # =========================================================
-# 🧩 Google Apps Script API (Config + History + Subs)
+# 🧩 Config + History + Subs (Google Apps Script / SQLite ดู storage.py)
 # =========================================================
 # BASE_URL = "https://script.google.com/macros/s/AKfycbzlvan12-CNKU97jHaKGMdD0vVJoBD13T4GGq6cFhlshAug7oEw3KjG3WSmh3F4-iN4/exec"
-BASE_URL = "https://script.google.com/macros/s/AKfycbz3oEFvrweKXHzHpj2XzMkWpuDRlAYH7CEK6YmegVoAHBGTQ7fa_lStOnUEB2BgjsEm/exec"
+BASE_URL = os.environ.get(
+    "HT_GAS_URL",
+    "https://script.google.com/macros/s/AKfycbz3oEFvrweKXHzHpj2XzMkWpuDRlAYH7CEK6YmegVoAHBGTQ7fa_lStOnUEB2BgjsEm/exec",
+)
+
+# state ที่จำไว้จาก GAS / ingest (เขียนลง snapshot, ใช้ตอนเพิ่ง start) ดู snapshot.py
+warm_state = WarmState(history_rows=SNAPSHOT_HISTORY_ROWS)
+
+# history ที่ sync มาจาก GAS แล้ว (ขอเฉพาะแถวใหม่กว่า high-water mark) ดู history_store.py
+history_store = HistoryStore(max_rows_per_device=HISTORY_STORE_MAX_ROWS, overlap_sec=HISTORY_SYNC_OVERLAP_SEC)
+
+# ค่าล่าสุด RING_ROWS แถวของแต่ละ device (post_history append, /history /status อ่านตรงจาก mmap)
+reading_rings = RingSet(RING_DIR, RING_ROWS) if RING_DIR and RING_ROWS > 0 else None
+
+
+def _shared_enabled() -> bool:
+    if SHARED_MODE == "auto":
+        return multiprocessing.parent_process() is not None   # uvicorn --workers spawn worker ผ่าน multiprocessing
+    return SHARED_MODE == "1"
+
+
+# worker อื่นบนเครื่องเดียวกัน: cache ชั้นสอง + แจ้ง invalidate / config / subs / ค่าที่รับเข้า + เลือก leader
+shared_state = SharedState(
+    SHARED_PATH, poll_sec=SHARED_POLL_SEC, max_age_sec=max(GAS_CACHE_STALE_SEC, STATUS_PAGE_MAX_AGE_SEC)
+) if _shared_enabled() else None
+if shared_state is not None:
+    shared_state.try_lead()
+
+
+def is_leader() -> bool:
+    """
+    worker ที่ทำงานที่ทั้งเครื่องต้องมีตัวเดียว (แจ้งเตือน LINE / เขียน snapshot / mirror + maintain ของ storage)
+    """
+    return shared_state is None or shared_state.leader
+
+
+def _broadcast(topic: str, payload: dict, tags: Tuple[str, ...] = (), wait: bool = True):
+    if shared_state is not None:
+        shared_state.publish(topic, payload, tags=tags, wait=wait)
+
+
+# หน้า /status ที่ render แล้ว แยกตาม line_id (ดู cache.py)
+status_page_cache = PageCache(
+    max_age_sec=STATUS_PAGE_MAX_AGE_SEC,
+    shared=SharedCache(shared_state, "page", tags=lambda key: (f"line:{key}", f"page:{key}"))
+    if shared_state is not None else None,
+)
+
+
+def _on_gas_refresh(key):
+    kind, line_id = key[0], key[1]
+    if kind == "status":
+        invalidate_views(pages=(line_id,))  # render ใหม่ด้วยข้อมูลที่เพิ่ง refresh
+
+
+# ผล current_status / history ต่อ line_id key = ("status" | "history", line_id)
+# + history ทีละหน้า key = ("history_query", line_id, ...) ดู query_history
+# ใช้ร่วมกับ worker อื่นเฉพาะ status / history_query (history ทั้งห้องใหญ่ + แต่ละ worker sync ต่อจาก history_store ของตัวเอง)
+gas_cache = SWRCache(
+    fresh_sec=GAS_CACHE_FRESH_SEC,
+    stale_sec=GAS_CACHE_STALE_SEC,
+    on_refresh=_on_gas_refresh,
+    shared=SharedCache(shared_state, "gas", tags=lambda key: (f"line:{key[1]}",),
+                       share=lambda key: key[0] in ("status", "history_query"))
+    if shared_state is not None else None,
+)
+
+
+def _invalidate_views(devices=(), lines=(), pages=()):
+    """
+    - devices : หน้า /status ที่มี device นี้
+    - lines   : current_status / history / history_query + หน้า /status ของห้องนี้
+    - pages   : แค่หน้า /status ของห้องนี้
+    """
+    for device_id in devices:
+        status_page_cache.invalidate_device(device_id)
+    for line_id in lines:
+        gas_cache.expire_if(lambda key, line_id=line_id: key[1] == line_id)
+        status_page_cache.invalidate(line_id)
+    for line_id in pages:
+        status_page_cache.invalidate(line_id)
+
+
+def invalidate_views(devices=(), lines=(), pages=()):
+    """
+    ล้างในตัวเอง + บอก worker อื่น (ลบ cache ชั้นสองที่ tag ตรงกันก่อนคืน ⇒ request ถัดไปของทุก worker ไม่เห็นของเก่า)
+    """
+    _invalidate_views(devices, lines, pages)
+    tags = tuple(f"device:{d}" for d in devices) + tuple(f"line:{l}" for l in lines) + tuple(f"page:{l}" for l in pages)
+    _broadcast("invalidate", {"devices": list(devices), "lines": list(lines), "pages": list(pages)}, tags=tags)
+
+
+def invalidate_device_views(device_id: str):
+    """
+    ข้อมูลของ device เปลี่ยน ⇒ ล้างหน้า /status ที่มี device นี้ + ให้ current_status / history
+    ของทุกห้องที่ผูก device นี้ refresh รอบหน้า
+    """
+    invalidate_views(devices=(device_id,), lines=tuple(warm_state.line_ids_for(device_id) or ()))
+
+
+def invalidate_line_views(line_id: str):
+    invalidate_views(lines=(line_id,))
+
+
+def sync_shared():
+    """
+    apply สิ่งที่ worker อื่นเปลี่ยนก่อนอ่าน cache (ไม่มีอะไรใหม่ = เช็ค data_version ครั้งเดียว)
+    """
+    if shared_state is not None:
+        shared_state.poll()
+
+# ---------- ที่เก็บ config / subs / history (gas | sqlite | tiered ดู storage.py) ----------
+storage = build_storage(
+    STORAGE_BACKEND,
+    BASE_URL,
+    SQLITE_PATH,
+    stream_chunk_bytes=GAS_STREAM_CHUNK_BYTES,
+    pushdown=GAS_PUSHDOWN,
+    mirror={"batch": MIRROR_BATCH, "backoff_max_sec": MIRROR_BACKOFF_MAX_SEC, "max_attempts": MIRROR_MAX_ATTEMPTS},
+    sqlite={"raw_days": HISTORY_RAW_DAYS, "retention_days": HISTORY_RETENTION_DAYS, "rollup_sec": HISTORY_ROLLUP_MIN * 60},
+    timeout=(GAS_CONNECT_TIMEOUT_SEC, GAS_READ_TIMEOUT_SEC),
+)
+
+
+def query_history(q: HistoryQuery) -> dict:
+    """
+    history ตามเงื่อนไขของ q (device / ช่วงเวลา / offset / limit / order / columns) + fetched_at
+    Apps Script ไม่รองรับ ⇒ กรองเองระหว่าง stream
+    ผลอยู่ใน gas_cache key = ("history_query", line_id, ...) ⇒ invalidate_line_views ล้างให้ด้วย
+    """
+    sync_shared()
+    data, fetched_at = gas_cache.get(("history_query",) + q.key()[1:], lambda: storage.query_history(q))
+    if isinstance(data, dict):
+        data = dict(data, fetched_at=fetched_at)
+    return data
+
 
 # ---------- small helper ----------
 def _safe_float(v, default: float = 0.0) -> float:
@@ -78,6 +328,44 @@ def _safe_float(v, default: float = 0.0) -> float:
         return default
 
 
+def _ago_text(sec: float) -> str:
+    sec = max(0, int(sec))
+    if sec < 60:
+        return f"{sec} วินาทีที่แล้ว"
+    if sec < 3600:
+        return f"{sec // 60} นาทีที่แล้ว"
+    return f"{sec // 3600} ชั่วโมงที่แล้ว"
+
+
+def updated_ago_html(fetched_at: Optional[float]) -> str:
+    """
+    "ข้อมูลอัปเดตเมื่อ N วินาทีที่แล้ว" (ข้อมูลอาจมาจาก cache)
+    ตัวเลขนับต่อเองฝั่ง browser ⇒ HTML ที่ cache ไว้ก็ยังบอกอายุถูก
+    """
+    if not fetched_at:
+        return ""
+    return f"""
+    <span class="updated-ago" data-ts="{fetched_at:.0f}">ข้อมูลอัปเดตเมื่อ {_ago_text(time.time() - fetched_at)}</span>
+    <script>
+    (function () {{
+        function ago(s) {{
+            s = Math.max(0, Math.floor(s));
+            if (s < 60) return s + " วินาทีที่แล้ว";
+            if (s < 3600) return Math.floor(s / 60) + " นาทีที่แล้ว";
+            return Math.floor(s / 3600) + " ชั่วโมงที่แล้ว";
+        }}
+        function tick() {{
+            document.querySelectorAll(".updated-ago").forEach(function (el) {{
+                el.textContent = "ข้อมูลอัปเดตเมื่อ " + ago(Date.now() / 1000 - Number(el.dataset.ts));
+            }});
+        }}
+        tick();
+        setInterval(tick, 5000);
+    }})();
+    </script>
+    """
+
+
 def _parse_dt(s: str) -> datetime:
     """
     แปลง string → datetime แบบกันตาย
@@ -107,29 +395,22 @@ def write_config(device_id: str, unit: str, adj_temp: float, adj_humid: float):
     - adj_temp  = ค่าชดเชย temp
     - adj_humid = ค่าชดเชย humidity
     """
-    payload = {
-        "action": "writeConfig",
-        "id": device_id,
-        "unit": unit,
-        "adj_temp": adj_temp,
-        "adj_humid": adj_humid,
-    }
-    resp = requests.post(BASE_URL, json=payload)
-    resp.raise_for_status()
-    return resp.json()
+    data = storage.write_config(device_id, unit, adj_temp, adj_humid)
+    if isinstance(data, dict) and data.get("success"):
+        row = {"id": device_id, "unit": unit, "adj_temp": adj_temp, "adj_humid": adj_humid}
+        warm_state.note_config(device_id, row)
+        _broadcast("config", {"device_id": device_id, "row": row})
+    return data
 
 
 def get_config_by_id(device_id: str):
     """
     GET config row ตาม device_id (id)
     """
-    resp = requests.get(
-        BASE_URL,
-        params={"action": "getConfigById", "id": device_id},
-    )
-    resp.raise_for_status()
-    data = resp.json()
+    data = storage.get_config(device_id)
     logger.info(f"getConfigById({device_id}) -> {data}")
+    if isinstance(data, dict) and data.get("success") and data.get("count", 0) > 0:
+        warm_state.note_config(device_id, data["data"][0])
     return data
 
 
@@ -138,12 +419,7 @@ def list_devices():
     GET /exec?action=listDevices
     คืน list id ทั้งหมดจาก config
     """
-    resp = requests.get(
-        BASE_URL,
-        params={"action": "listDevices"},
-    )
-    resp.raise_for_status()
-    data = resp.json()
+    data = storage.list_devices()
     logger.info(f"listDevices -> {data}")
     return data
 
@@ -158,14 +434,11 @@ def add_subscription(device_id: str, line_id: str):
     - id       = device_id
     - line_id  = LINE chat id (user/group/room)
     """
-    payload = {
-        "action": "addSubscription",
-        "id": device_id,
-        "line_id": line_id,
-    }
-    resp = requests.post(BASE_URL, json=payload)
-    resp.raise_for_status()
-    return resp.json()
+    data = storage.add_subscription(device_id, line_id)
+    if isinstance(data, dict) and data.get("success"):
+        warm_state.add_sub(device_id, line_id)
+        _broadcast("sub", {"device_id": device_id, "line_id": line_id, "added": True})
+    return data
 
 
 def remove_subscription(device_id: str, line_id: str):
@@ -175,14 +448,11 @@ def remove_subscription(device_id: str, line_id: str):
     Sheet: subs
     - ลบทุกแถวที่ (id, line_id) ตรงกัน
     """
-    payload = {
-        "action": "removeSubscription",
-        "id": device_id,
-        "line_id": line_id,
-    }
-    resp = requests.post(BASE_URL, json=payload)
-    resp.raise_for_status()
-    return resp.json()
+    data = storage.remove_subscription(device_id, line_id)
+    if isinstance(data, dict) and data.get("success"):
+        warm_state.remove_sub(device_id, line_id)
+        _broadcast("sub", {"device_id": device_id, "line_id": line_id, "added": False})
+    return data
 
 
 def get_subscriptions_by_id(device_id: str):
@@ -198,13 +468,10 @@ def get_subscriptions_by_id(device_id: str):
       ]
     }
     """
-    resp = requests.get(
-        BASE_URL,
-        params={"action": "getSubscriptionsById", "id": device_id},
-    )
-    resp.raise_for_status()
-    data = resp.json()
+    data = storage.get_subscriptions(device_id)
     logger.info(f"getSubscriptionsById({device_id}) -> {data}")
+    if isinstance(data, dict) and data.get("success"):
+        warm_state.note_subs(device_id, extract_line_ids_from_subs(data))
     return data
 
 
@@ -251,37 +518,49 @@ def append_history(
     Sheet: history
     - id | timestamp | temp | humid | hic | flag
     """
-    payload = {
-        "action": "appendHistory",
-        "id": device_id,
-        "temp": temp,
-        "humid": humid,
-        "hic": hic,
-        "flag": flag,
-    }
-    if timestamp:
-        payload["timestamp"] = timestamp
+    return storage.append_history(device_id, temp, humid, hic, flag, timestamp)
 
-    resp = requests.post(BASE_URL, json=payload)
-    resp.raise_for_status()
-    return resp.json()
 
-
-def get_history_by_id_sorted(device_id: str):
+def get_history_by_id_sorted(device_id: str, since: Optional[str] = None):
     """
-    GET /exec?action=getHistoryByIdSorted&id=dev1
+    GET /exec?action=getHistoryByIdSorted&id=dev1[&since=...]
     คืน history ของ device นี้ sort ตาม timestamp (เก่า → ใหม่)
+    since = เอาเฉพาะแถวที่ timestamp > since (GAS ตัวเก่าไม่รู้จัก ⇒ คืนทั้งหมด)
     """
-    resp = requests.get(
-        BASE_URL,
-        params={"action": "getHistoryByIdSorted", "id": device_id},
-    )
-    resp.raise_for_status()
-    data = resp.json()
+    data = storage.history_by_device(device_id, since)
     logger.info(f"getHistoryByIdSorted({device_id}) -> count={data.get('count')}")
     return data
 
 
+def recal_history_page(device_id: str, line_id: Optional[str], start: Optional[float], end: Optional[float],
+                       offset: int, limit: int) -> dict:
+    """
+    หน้าหนึ่งของ history ของ device ช่วง start <= t < end เรียงเก่า → ใหม่ (recalibrate.py เดินทีละหน้า)
+    ผ่าน query ของ storage (sqlite / tiered: ทีละเดือน LIMIT, GAS: pushdown) ไม่ผ่าน gas_cache (ค่าเปลี่ยนทุกหน้าที่เขียนกลับ)
+    line_id ไม่ใส่ (job จาก checkpoint เก่า) ⇒ ใช้ห้องแรกที่ผูก device ไว้
+    """
+    if not line_id:
+        line_ids = extract_line_ids_from_subs(get_subscriptions_by_id(device_id))
+        if not line_ids:
+            return {"success": False, "message": "device is not bound to any line_id"}
+        line_id = line_ids[0]
+    q = HistoryQuery(line_id, device_id=device_id, order="asc", offset=offset, limit=limit,
+                     start=gas_timestamp(start) if start is not None else None,
+                     end=gas_timestamp(end) if end is not None else None)
+    return storage.query_history(q)
+
+
+def update_history_rows(device_id: str, rows: List[dict]):
+    """
+    POST updateHistory
+    เขียนทับ temp / humid / hic / flag ของแถวเดิม (key = id + timestamp เดิมจาก GAS)
+    ใช้ตอนปรับ calibration ย้อนหลัง (recalibrate.py)
+
+    rows: [{timestamp, temp, humid, hic, flag}, ...]
+    """
+    return storage.update_history(device_id, rows)
+
+
 # =========================================================
 # 🌐 LINE Flex Card Builder (เมนู register / status / history)
 # =========================================================
@@ -374,8 +653,11 @@ async def callback(request: Request):
     if not signature:
         return PlainTextResponse("Missing signature", status_code=400)
 
+    from linebot.exceptions import InvalidSignatureError
+    from linebot.models import FlexSendMessage, MessageEvent, TextMessage
+
     try:
-        events = parser.parse(body_text, signature)
+        events = get_webhook_parser().parse(body_text, signature)
     except InvalidSignatureError:
         logger.exception("Invalid signature. Check LINE_CHANNEL_SECRET.")
         return PlainTextResponse("Invalid signature", status_code=400)
@@ -420,7 +702,7 @@ async def callback(request: Request):
                 )
 
             if reply_message:
-                line_bot_api.reply_message(
+                get_line_bot_api().reply_message(
                     event.reply_token,
                     reply_message
                 )
@@ -428,18 +710,17 @@ async def callback(request: Request):
     return PlainTextResponse("OK", status_code=200)
 
 
-def calc_status_from_lastupdate(raw_lastupdate) -> str:
-    """
-    คำนวณสถานะ online/offline จาก lastupdate
+# สถานะ online/offline ที่รู้จาก ingest (ดู liveness.py)
+liveness = LivenessTracker(ONLINE_WINDOW_SEC)
 
-    กติกา:
-    - ถ้า lastupdate เป็น string ไม่มี timezone ⇒ ถือว่าเป็น 'เวลาไทย (+7)'
-    - ถ้ามี 'Z' หรือ +xx:xx ⇒ ใช้ timezone นั้น
-    - ถ้าเป็นเลข ⇒ epoch seconds (UTC)
-    แล้วเอามาเทียบกับ 'ตอนนี้ (เวลาไทย)' ใน timezone เดียวกัน
+
+def lastupdate_epoch(raw_lastupdate) -> Optional[float]:
+    """
+    แปลง lastupdate จาก GAS → epoch วินาที (ตามกติกาเดียวกับ calc_status_from_lastupdate)
+    คืน None ถ้าแปลงไม่ได้
     """
     if raw_lastupdate in (None, "-", ""):
-        return "offline"
+        return None
 
     # แปลงเป็น datetime ก่อน
     try:
@@ -453,23 +734,34 @@ def calc_status_from_lastupdate(raw_lastupdate) -> str:
             dt = datetime.fromisoformat(s)
 
         if dt == datetime.min:
-            return "offline"
+            return None
 
         # ถ้าไม่มี timezone ⇒ ถือว่าเป็นเวลาไทย (+7)
         if dt.tzinfo is None:
             dt = dt.replace(tzinfo=TH_TZ)
 
     except Exception:
-        return "offline"
+        return None
 
     # เทียบใน timezone ไทยตรง ๆ ไปเลย (ง่ายและตรงตามที่ DB เก็บ)
-    # now_th = datetime.now(TH_TZ)
-    now_th = datetime.now(TH_TZ)
-    diff_sec = (now_th - dt.astimezone(ZO_TZ).replace(tzinfo=TH_TZ)).total_seconds()
+    return dt.astimezone(ZO_TZ).replace(tzinfo=TH_TZ).timestamp()
+
 
-    print('now_th',now_th)
-    print('dt.astimezone(ZO_TZ).replace(tzinfo=TH_TZ)',dt.astimezone(ZO_TZ).replace(tzinfo=TH_TZ))
-    print('diff_sec',diff_sec)
+def calc_status_from_lastupdate(raw_lastupdate) -> str:
+    """
+    คำนวณสถานะ online/offline จาก lastupdate
+
+    กติกา:
+    - ถ้า lastupdate เป็น string ไม่มี timezone ⇒ ถือว่าเป็น 'เวลาไทย (+7)'
+    - ถ้ามี 'Z' หรือ +xx:xx ⇒ ใช้ timezone นั้น
+    - ถ้าเป็นเลข ⇒ epoch seconds (UTC)
+    แล้วเอามาเทียบกับ 'ตอนนี้ (เวลาไทย)' ใน timezone เดียวกัน
+    """
+    ts = lastupdate_epoch(raw_lastupdate)
+    if ts is None:
+        return "offline"
+
+    diff_sec = time.time() - ts
 
     # เผื่อกรณีนาฬิกาอุปกรณ์ล้ำไปในอนาคต ⇒ ถือว่า online
     if diff_sec < 0:
@@ -479,43 +771,121 @@ def calc_status_from_lastupdate(raw_lastupdate) -> str:
 
 
 
-def get_current_status_by_line_id(line_id: str):
+def fetch_current_status(line_id: str):
     """
-    GET /exec?action=current_status&line_id=...
-    คืน list device + last reading + status (อัปเดตใหม่ตาม lastupdate)
+    GET /exec?action=current_status&line_id=... (ยิง GAS จริงเสมอ แล้วจำลง warm_state)
     """
-    resp = requests.get(
-        BASE_URL,
-        params={"action": "current_status", "line_id": line_id},
-    )
-    resp.raise_for_status()
-    data = resp.json()
+    data = storage.current_status(line_id)
 
     logger.info(f"current_status({line_id}) -> {data}")
+    if isinstance(data, dict) and data.get("success"):
+        warm_state.note_status(line_id, data.get("data", []))
+        warm_state.mark_fresh("status", line_id)
+    return data
 
-    # อัปเดต status ใหม่
+
+def get_current_status_by_line_id(line_id: str):
+    """
+    คืน list device + last reading + status (อัปเดตใหม่ตาม lastupdate) + fetched_at (epoch ที่ได้ข้อมูลมา)
+    - เพิ่ง start และ line นี้มีใน snapshot ⇒ ใช้ของ snapshot ไปก่อน (background refresh จะดึง GAS ให้)
+    - ไม่งั้น current_status จาก gas_cache (stale-while-revalidate)
+    """
+    sync_shared()
+    data = None
+    if not warm_state.is_fresh("status", line_id):
+        data = warm_state.current_status(line_id)
+    if data is None:
+        data, fetched_at = gas_cache.get(("status", line_id), lambda: fetch_current_status(line_id))
+        if isinstance(data, dict):
+            data = dict(data, fetched_at=fetched_at)
+
+    # อัปเดต status ใหม่ (ใช้สถานะจาก liveness ถ้ารู้แล้ว ไม่ต้อง parse lastupdate ซ้ำ)
     if isinstance(data, dict) and data.get("success"):
-        for row in data.get("data", []):
-            raw_lastupdate = row.get("lastupdate")
-            new_status = calc_status_from_lastupdate(raw_lastupdate)
+        # data อาจใช้ร่วมกับ request อื่น (single-flight / cache) ⇒ copy แถวก่อนแก้
+        data = dict(data, data=[dict(r) for r in data.get("data", [])])
+        for row in data["data"]:
+            did = str(row.get("id", ""))
+            new_status = liveness.status(did)
+            if new_status is None:
+                raw_lastupdate = row.get("lastupdate")
+                new_status = calc_status_from_lastupdate(raw_lastupdate)
+                ts = lastupdate_epoch(raw_lastupdate)
+                if did and ts is not None:
+                    liveness.seed(did, ts)
             row["status"] = new_status  # แทนที่สถานะเดิม
+            _overlay_latest(row)
+
+    return data
+
+
+def _overlay_latest(row: dict):
+    """
+    ค่าใน ring ใหม่กว่า lastupdate ของ row (ingest เข้ามาหลังดึง current_status / เข้าที่ worker อื่น) ⇒ ใช้ค่าจาก ring
+    """
+    if reading_rings is None:
+        return
+    last = reading_rings.latest(str(row.get("id", "")))
+    if last is None:
+        return
+    cur = gas_ts_key(row.get("lastupdate"))
+    if cur is None or last["ts"] > cur:
+        row.update(lastupdate=last["timestamp"], temp=last["temp"], humid=last["humid"],
+                   hic=last["hic"], flag=last["flag"])
+
+
 
+def fetch_history_by_line_id(line_id: str):
+    """
+    GET /exec?action=history&line_id=...[&since=...] (ยิง GAS จริงเสมอ แล้วจำลง warm_state)
+    - รู้แล้วว่าห้องนี้มี device ไหน และทุกตัวเคย sync แล้ว ⇒ ขอเฉพาะแถวใหม่ (since)
+    - merge เข้า history_store แล้วคืนทั้งหมดจาก store (ใหม่ → เก่า แบบเดียวกับ GAS)
+    """
+    device_ids = warm_state.device_ids_for(line_id)
+    since = history_store.since_for(device_ids) if device_ids else None
+    data = storage.history_by_line(line_id, since, device_ids)
+    logger.info(f"history({line_id}, since={since}) -> count={data.get('count')}")
+    if isinstance(data, dict) and data.get("success"):
+        fetched = data.get("data", [])
+        history_store.merge(fetched, synced_ids=device_ids or (), since=since)
+        ids = device_ids or list(dict.fromkeys(str(r.get("id", "")) for r in fetched))
+        rows = history_store.rows_desc(ids)
+        # columnar สร้างครั้งเดียวต่อรอบ fetch แล้วอยู่ใน gas_cache คู่กับ rows
+        columns = columns_by_device(rows, ids)
+        data = {"success": True, "count": len(rows), "data": rows, "columns": columns}
+        if reading_rings is not None and HISTORY_STORE_MAX_ROWS == 0:
+            # store มี history ครบทุกแถว ⇒ ring ที่ยังไม่รู้ base รู้ total จากตรงนี้
+            for did, cols in columns.items():
+                reading_rings.seed_if_unknown(did, cols)
+        warm_state.note_history(line_id, rows)
+        warm_state.mark_fresh("history", line_id)
     return data
 
 
+def history_cached(line_id: str) -> bool:
+    """
+    มี history ทั้งห้องพร้อมใช้แล้ว (gas_cache / snapshot) ⇒ get_history_by_line_id ไม่ต้องรอ GAS
+    """
+    sync_shared()
+    if gas_cache.has(("history", line_id)):
+        return True
+    return not warm_state.is_fresh("history", line_id) and warm_state.has_history(line_id)
+
 
 def get_history_by_line_id(line_id: str):
     """
-    GET /exec?action=history&line_id=...
-    คืน history ของทุก device ที่ผูกกับ line นี้ (timestamp DESC)
+    คืน history ของทุก device ที่ผูกกับ line นี้ (timestamp DESC) + columns ({device_id: DeviceColumns}) + fetched_at
+    - เพิ่ง start ⇒ ใช้ history ล่าสุดจาก snapshot ไปก่อนจนกว่า background refresh จะดึง GAS เสร็จ
+    - ไม่งั้นจาก gas_cache (stale-while-revalidate)
     """
-    resp = requests.get(
-        BASE_URL,
-        params={"action": "history", "line_id": line_id},
-    )
-    resp.raise_for_status()
-    data = resp.json()
-    logger.info(f"history({line_id}) -> count={data.get('count')}")
+    sync_shared()
+    if not warm_state.is_fresh("history", line_id):
+        data = warm_state.history_for_line(line_id)
+        if data is not None:
+            data["columns"] = columns_by_device(data["data"])
+            return data
+    data, fetched_at = gas_cache.get(("history", line_id), lambda: fetch_history_by_line_id(line_id))
+    if isinstance(data, dict):
+        data = dict(data, fetched_at=fetched_at)
     return data
 
 
@@ -1166,7 +1536,9 @@ def register_submit(
     บันทึก:
     1) config ลง Google Sheet (config sheet)
     2) subscription ลงชีต subs
+    3) adj_temp / adj_humid เปลี่ยนจากค่าเดิม ⇒ สั่ง recalibrate history ก่อนเวลาที่เขียน config
     """
+    old_adj = _current_adj(device_id)
     try:
         cfg_result = write_config(
             device_id=device_id,
@@ -1177,6 +1549,7 @@ def register_submit(
     except Exception as e:
         logger.exception("Error in write_config")
         cfg_result = {"error": str(e)}
+    written_at = time.time()
 
     try:
         subs_result = add_subscription(
@@ -1187,10 +1560,20 @@ def register_submit(
         logger.exception("Error in add_subscription")
         subs_result = {"error": str(e)}
 
+    # unit / ห้องที่ผูกอาจเปลี่ยน
+    invalidate_device_views(device_id)
+    invalidate_line_views(line_chat_id)
+
     result_obj = {
         "config_result": cfg_result,
         "subscription_result": subs_result,
     }
+    if old_adj is not None and isinstance(cfg_result, dict) and cfg_result.get("success"):
+        delta_temp = round(adj_temp - old_adj[0], 2)
+        delta_humid = round(adj_humid - old_adj[1], 2)
+        if delta_temp or delta_humid:
+            job = recalibrator.submit(device_id, delta_temp, delta_humid, None, written_at, line_chat_id)
+            result_obj["recalibrate_job"] = job.job_id
     status_html = f"<pre>{json.dumps(result_obj, ensure_ascii=False, indent=2)}</pre>"
 
     html = f"""
@@ -1357,12 +1740,79 @@ def register_submit(
     return HTMLResponse(content=html)
 
 
+# =========================================================
+# ⚙️ งานกิน CPU ของหน้าเว็บ ⇒ process pool (ดู cpu_pool.py / render.py)
+# =========================================================
+
+cpu_pool = CpuPool(CPU_POOL_WORKERS, queue_max=CPU_POOL_QUEUE)
+
+
+def _client_gone(request: Request) -> Callable[[], bool]:
+    """
+    ใช้ใน endpoint แบบ sync (รันใน threadpool ของ anyio) ถาม event loop ว่า client ตัดการเชื่อมต่อไปแล้วหรือยัง
+    """
+    return lambda: from_thread.run(request.is_disconnected)
+
+
+@app.exception_handler(PoolBusy)
+async def cpu_pool_busy(request: Request, exc: PoolBusy):
+    return HTMLResponse(
+        status_code=503,
+        content="<p>ระบบกำลังสร้างหน้าอื่นอยู่ กรุณาลองใหม่อีกครั้ง</p>",
+        headers={"Retry-After": str(int(math.ceil(exc.retry_after)))},
+    )
+
+
+@app.exception_handler(CallCancelled)
+async def cpu_pool_cancelled(request: Request, exc: CallCancelled):
+    # client ปิดไปแล้ว ไม่มีใครอ่าน
+    return PlainTextResponse(status_code=499, content="")
+
+
+@app.on_event("startup")
+async def start_cpu_pool():
+    cpu_pool.start(warm=render.warm)
+
+
+@app.on_event("shutdown")
+async def stop_cpu_pool():
+    await asyncio.to_thread(cpu_pool.stop)
+
+
 # =========================================================
 # 📊 หน้า /history (GET) – dropdown + graph + table + pagination
 # =========================================================
 
+HISTORY_PAGE_COLUMNS = ("temp", "humid", "hic", "flag")
+
+
+def _history_page_query(line_id: str, device_id: str, page: int, per_page: int):
+    """
+    หน้าเดียวของ /history จาก GAS โดยตรง คืน (hist_json, total, page, page_cols)
+    page เกินหน้าสุดท้าย ⇒ ขอหน้าสุดท้ายใหม่อีกรอบ
+    """
+    page = max(1, page)
+    for _ in range(2):
+        q = HistoryQuery(line_id, device_id=device_id, offset=(page - 1) * per_page, limit=per_page,
+                         columns=HISTORY_PAGE_COLUMNS)
+        try:
+            hist_json = query_history(q)
+        except Exception:
+            logger.exception("Error calling history query in /history")
+            return None, 0, 1, DeviceColumns.empty(device_id)
+        if not (isinstance(hist_json, dict) and hist_json.get("success")):
+            return hist_json, 0, 1, DeviceColumns.empty(device_id)
+        total = hist_json["total"]
+        last_page = max(1, (total + per_page - 1) // per_page)
+        if page <= last_page:
+            break
+        page = last_page
+    return hist_json, total, page, DeviceColumns.from_rows(device_id, hist_json["data"])
+
+
 @app.get("/history", response_class=HTMLResponse)
 def history_page(
+    request: Request,
     line_id: Optional[str] = None,
     device_id: Optional[str] = None,
     page: int = 1,
@@ -1372,9 +1822,11 @@ def history_page(
     - ต้องมี line_id (เปิดจาก LINE เท่านั้น)
     - ใช้ current_status(line_id) หา device list ของห้องนี้ (1 call)
     - ใช้ history(line_id) ดึง history ของทุก device ของห้องนี้ (1 call)
+      ถ้ายังไม่มีใน cache ขอเฉพาะ device + หน้าที่แสดง (pushdown)
     - dropdown เลือก device
     - default = device ที่อยู่บนสุดจาก current_status (ซึ่ง sort online ก่อนให้แล้ว)
     - table + graph + pagination (200 แถว/หน้า, ล่าสุดก่อน)
+    - ส่งแบบ StreamingResponse: หัวหน้า + กรอบกราฟก่อน แล้วแถวตารางทีละ PAGE_STREAM_ROWS แถว ข้อมูลกราฟปิดท้าย
     """
     if not line_id:
         # เหมือน /register กรณีไม่มี line_id
@@ -1519,51 +1971,47 @@ def history_page(
     else:
         selected_device = device_ids_only[0]
 
-    # 2) ดึง history ของ line นี้ครั้งเดียว แล้ว filter ตาม device
-    try:
-        hist_json = get_history_by_line_id(line_id)
-        if isinstance(hist_json, dict) and hist_json.get("success"):
-            all_hist = hist_json.get("data", [])
-        else:
-            all_hist = []
-    except Exception as e:
-        logger.exception("Error calling history(line_id) in /history")
-        all_hist = []
-
-    # history จาก GAS เป็น timestamp DESC (ใหม่สุด → เก่าสุด)
-    hist_selected = [r for r in all_hist if str(r.get("id")) == selected_device]
-
-    # pagination (200 แถว/หน้า)
+    # pagination (200 แถว/หน้า ล่าสุดก่อน)
     per_page = 200
-    total = len(hist_selected)
+
+    # 2) history ของหน้านี้
+    #    - หน้าอยู่ใน ring ของ device (ล่าสุด RING_ROWS แถว) ⇒ อ่านจาก mmap เลย
+    #    - มี history ทั้งห้องใน cache แล้ว ⇒ ใช้ columns ที่มี (ไม่ยิง GAS)
+    #    - ยังไม่มี ⇒ ขอ GAS เฉพาะ device + หน้านี้ (pushdown ดู gas_query.py)
+    #      Apps Script ไม่รองรับ pushdown ⇒ ดึงทั้งห้องแบบ incremental (history_store) คุ้มกว่า
+    ring_page = reading_rings.page_desc(selected_device, page, per_page) if reading_rings is not None else None
+    if ring_page is not None:
+        page_cols, total, page = ring_page
+        hist_json = {"success": True, "fetched_at": time.time()}
+    elif HISTORY_PAGE_QUERY and storage.pushdown_supported() is not False and not history_cached(line_id):
+        hist_json, total, page, page_cols = _history_page_query(line_id, selected_device, page, per_page)
+    else:
+        try:
+            hist_json = get_history_by_line_id(line_id)
+            if isinstance(hist_json, dict) and hist_json.get("success"):
+                hist_cols = hist_json.get("columns") or {}
+            else:
+                hist_cols = {}
+        except Exception as e:
+            logger.exception("Error calling history(line_id) in /history")
+            hist_json = None
+            hist_cols = {}
+        cols = hist_cols.get(selected_device) or DeviceColumns.empty(selected_device)
+        total = len(cols)
+        page = max(1, min(page, max(1, (total + per_page - 1) // per_page)))
+        page_cols = cols.page_desc(page, per_page)
+    updated_html = updated_ago_html(hist_json.get("fetched_at") if isinstance(hist_json, dict) else None)
     total_pages = max(1, (total + per_page - 1) // per_page)
-    page = max(1, min(page, total_pages))
-
-    start = (page - 1) * per_page
-    end = start + per_page
-    page_rows = hist_selected[start:end]
-
-    # เตรียม data สำหรับ Chart.js (ให้กราฟเป็นเก่า→ใหม่ภายในหน้า)
-    chart_rows = list(reversed(page_rows))
-    labels = [
-        format_ts_th(r.get("timestamp", "")) if r.get("timestamp") else ""
-        for r in chart_rows
-    ]
-
-    temps = [_safe_float(r.get("temp")) for r in chart_rows]
-    humids = [_safe_float(r.get("humid")) for r in chart_rows]
-    hics = [_safe_float(r.get("hic")) for r in chart_rows]
-
-    chart_payload = {
-        "labels": labels,
-        "temp": temps,
-        "humid": humids,
-        "hic": hics,
-    }
-    chart_json = json.dumps(chart_payload, ensure_ascii=False)
+
+    # แถวตาราง (ใหม่สุด→เก่าสุด) ทีละ PAGE_STREAM_ROWS แถว + กราฟ (เก่า→ใหม่) render ใน process pool
+    # ช่วงแรกทำก่อนตอบ (pool เต็ม ⇒ 503) ที่เหลือทำระหว่างส่ง
+    step = max(1, PAGE_STREAM_ROWS)
+    row_chunks = [page_cols.slice(max(0, hi - step), hi) for hi in range(len(page_cols), 0, -step)]
+    cancelled = _client_gone(request)
+    first_rows = cpu_pool.call(render.history_rows_html, row_chunks[0], cancelled=cancelled) if row_chunks else ""
 
     # dropdown options
-    options_html = ""
+    options = []
     for d in devices_info:
         did = str(d.get("id"))
         if not did:
@@ -1571,7 +2019,8 @@ def history_page(
         sel = "selected" if did == selected_device else ""
         status = d.get("status", "")
         badge = "🟢" if status == "online" else "⚪️"
-        options_html += f'<option value="{did}" {sel}>{badge} {did}</option>'
+        options.append(f'<option value="{did}" {sel}>{badge} {did}</option>')
+    options_html = "".join(options)
 
     # pagination html
     pagination_html = ""
@@ -1586,32 +2035,15 @@ def history_page(
             pagination_html += f'<a href="/history?line_id={line_id}&device_id={selected_device}&page={next_page}">ถัดไป ›</a>'
         pagination_html += "</div>"
 
-    # table rows (page_rows เป็นใหม่สุด→เก่าสุด)
-    table_rows_html = ""
-    for r in page_rows:
-        ts_raw = r.get("timestamp", "")
-        ts = format_ts_th(ts_raw) if ts_raw else ""
-        temp = _safe_float(r.get("temp"))
-        humid = _safe_float(r.get("humid"))
-        hic = _safe_float(r.get("hic"))
-        flag = r.get("flag", "")
-        table_rows_html += f"""
-        <tr>
-            <td>{ts}</td>
-            <td>{temp:.1f}</td>
-            <td>{humid:.1f}</td>
-            <td>{hic:.1f}</td>
-            <td>{flag}</td>
-        </tr>
-        """
-
     # หา status ของ device ที่เลือก
     selected_info = next((d for d in devices_info if str(d.get("id")) == selected_device), None)
     sel_status = selected_info.get("status") if selected_info else "-"
     raw_lastupdate = selected_info.get("lastupdate") if selected_info else "-"
     sel_lastupdate = format_ts_th(raw_lastupdate) if raw_lastupdate not in (None, "-", "") else "-"
 
-    html = f"""
+    def parts():
+        # หัวหน้า + dropdown + กรอบกราฟ + หัวตาราง ⇒ แถวตารางทีละช่วง ⇒ ท้ายตาราง + ข้อมูลกราฟ
+        yield f"""
     <!DOCTYPE html>
     <html lang="th">
     <head>
@@ -1791,6 +2223,11 @@ def history_page(
                         <div class="info-line">
                             Status: <b>{sel_status}</b> | Last update: <b>{sel_lastupdate}</b>
                         </div>
+                        <div class="info-line">{updated_html}</div>
+                        <div class="info-line">
+                            <a href="/compare?line_id={line_id}">เทียบทุกเครื่อง ›</a> |
+                            <a href="/history/export?line_id={line_id}&device_id={selected_device}">ดาวน์โหลด CSV</a>
+                        </div>
                         <input type="hidden" name="page" value="1" />
                     </form>
                 </div>
@@ -1812,7 +2249,18 @@ def history_page(
                         </tr>
                     </thead>
                     <tbody>
-                        {table_rows_html}
+                        """
+        yield first_rows
+        for chunk in row_chunks[1:]:
+            try:
+                yield cpu_pool.call(render.history_rows_html, chunk, cancelled=cancelled, wait=True)
+            except CallCancelled:
+                return
+        try:
+            chart_json = cpu_pool.call(render.history_chart_json, page_cols, cancelled=cancelled, wait=True)
+        except CallCancelled:
+            return
+        yield f"""
                     </tbody>
                 </table>
                 {pagination_html}
@@ -1897,153 +2345,1019 @@ def history_page(
     </body>
     </html>
     """
-    return HTMLResponse(content=html)
+
+    return StreamingResponse(parts(), media_type="text/html")
 
 
 # =========================================================
-# 📡 API: POST /history (sensor → Google Sheet + push LINE)
+# 📈 หน้า /compare (GET) – ทุก device ของห้องบนกราฟ / ตารางเดียวกัน
 # =========================================================
 
-class HistoryIn(BaseModel):
-    id: str          # ตรงนี้คือ device_id (serial เครื่องวัด)
-    temp: float
-    humid: float
-    hic: float
-    flag: str = "OK"
-    timestamp: Optional[str] = None  # ถ้าไม่ส่ง ให้ App Script เติมเองได้
+COMPARE_FIELDS = {"hic": "HIC (°C)", "temp": "Temp (°C)", "humid": "Humid (%RH)"}
+COMPARE_TABLE_ROWS = 200
+COMPARE_DAYS_RANGE = (0.01, 365.0)
+COMPARE_BUCKET_MIN = tuple(b // 60 for b in BUCKET_CHOICES_SEC)   # bucket_min ที่ยอมให้ใส่
 
 
-@app.post("/history")
-async def post_history(data: HistoryIn):
+@app.get("/compare", response_class=HTMLResponse)
+def compare_page(
+    request: Request,
+    line_id: Optional[str] = None,
+    field: str = "hic",
+    days: float = 7.0,
+    bucket_min: Optional[int] = None,
+):
     """
-    API สำหรับ device ส่งค่าเข้า (ไม่ใช่หน้าเว็บ)
-
-    เงื่อนไขเพิ่ม:
-    - LINE noti จะส่งเฉพาะกรณี timestamp มีนาที = 00 (เช่น 01:00, 02:00, 13:00)
-    - ข้อความบรรทัดแรกใช้ Unit จาก config แทน Device
+    เทียบทุก device ของห้อง:
+    - ใช้ current_status(line_id) หา device list + ชื่อ unit
+    - ใช้ history(line_id) + columns ชุดเดียวกับ /history (ผ่าน gas_cache)
+    - เฉลี่ยลงช่องเวลาเดียวกัน (bucket_join) ช่วง `days` วันล่าสุด ใน process pool (render.compare_parts)
+    - bucket_min ไม่ใส่ = เลือกให้กราฟไม่เกิน ~400 จุด
+    - days บีบให้อยู่ใน COMPARE_DAYS_RANGE, bucket_min ที่ไม่อยู่ใน COMPARE_BUCKET_MIN ⇒ ขยับขึ้นเป็นค่าถัดไป
+      (กันขอช่องเวลาจำนวนมหาศาล เช่น days=inf / bucket_min=1 ทั้งปี)
     """
-    device_id = data.id
-
-    # 1) บันทึก History ลง Google Sheet (บันทึกทุกครั้ง)
-    try:
-        gs_result = append_history(
-            device_id=device_id,
-            temp=data.temp,
-            humid=data.humid,
-            hic=data.hic,
-            flag=data.flag,
-            timestamp=data.timestamp,
-        )
-    except Exception as e:
-        logger.exception("Error when calling append_history")
-        return {
-            "status": "error",
-            "message": f"append_history failed: {e}",
-        }
-
-    # 2.1) เช็คว่าเวลานาที = 00 ไหม ถ้าไม่ใช่จะไม่ส่ง LINE noti
-    notify_allowed = True
-    if data.timestamp:
-        dt = _parse_dt(data.timestamp)
-        if dt != datetime.min and dt.minute != 0:
-            notify_allowed = False
+    if not line_id:
+        return HTMLResponse(status_code=400, content="<p>กรุณาเปิดลิงก์จากห้องแชท LINE (/history)</p>")
+    if field not in COMPARE_FIELDS:
+        field = "hic"
+    days = 7.0 if days != days else min(max(days, COMPARE_DAYS_RANGE[0]), COMPARE_DAYS_RANGE[1])   # NaN ⇒ default
+    if bucket_min is not None and bucket_min <= 0:
+        bucket_min = None
+    elif bucket_min is not None and bucket_min not in COMPARE_BUCKET_MIN:
+        bucket_min = next((b for b in COMPARE_BUCKET_MIN if b >= bucket_min), COMPARE_BUCKET_MIN[-1])
 
-    # 2.2) ดึง unit จาก config (เอาไปใช้ในข้อความ noti)
-    unit_name = device_id  # fallback
     try:
-        cfg = get_config_by_id(device_id)
-        if isinstance(cfg, dict) and cfg.get("success") and cfg.get("count", 0) > 0:
-            row = cfg["data"][0]
-            unit_name = str(row.get("unit") or device_id)
-    except Exception as e:
-        logger.exception("Error fetching config in post_history")
-
-    # 3) ดึง subs ตาม device_id (อาจมีหลายห้อง)
+        status_json = get_current_status_by_line_id(line_id)
+        devices_info = status_json.get("data", []) if isinstance(status_json, dict) and status_json.get("success") else []
+    except Exception:
+        logger.exception("Error calling current_status in /compare")
+        devices_info = []
     try:
-        subs_json = get_subscriptions_by_id(device_id)
-        line_ids = extract_line_ids_from_subs(subs_json)
-    except Exception as e:
-        logger.exception("Error when calling get_subscriptions_by_id")
-        line_ids = []
-
-    # ---------- ตรงนี้คือ mapping ธงสี / น้ำ / พัก ----------
-    flag_map = {
-        "white":  {
-            "water": "อย่างน้อย 0.5 ลิตร",
-            "rest": "50/10 นาที"
-        },
-        "green": {
-            "water": "อย่างน้อย 0.5 ลิตร",
-            "rest": "50/10 นาที"
-        },
-        "yellow": {
-            "water": "อย่างน้อย 1 ลิตร",
-            "rest": "45/15 นาที"
-        },
-        "red": {
-            "water": "อย่างน้อย 1 ลิตร",
-            "rest": "30/30 นาที"
-        },
-        "black": {
-            "water": "อย่างน้อย 1 ลิตร",
-            "rest": "20/40 นาที"
-        }
-    }
+        hist_json = get_history_by_line_id(line_id)
+        hist_cols = (hist_json.get("columns") or {}) if isinstance(hist_json, dict) and hist_json.get("success") else {}
+    except Exception:
+        logger.exception("Error calling history(line_id) in /compare")
+        hist_json = None
+        hist_cols = {}
+    updated_html = updated_ago_html(hist_json.get("fetched_at") if isinstance(hist_json, dict) else None)
+
+    device_ids = [str(d.get("id")) for d in devices_info if d.get("id")]
+    units = {str(d.get("id")): d.get("unit") or "" for d in devices_info}
+    cols = [hist_cols.get(did) or DeviceColumns.empty(did) for did in device_ids]
+
+    names = [f"{units[did]} ({did})" if units.get(did) else did for did in device_ids]
+    # ตาราง: ช่องเวลาใหม่สุดก่อน
+    chart_json, table_rows_html, bucket_sec = cpu_pool.call(
+        render.compare_parts, render.compare_window(cols, days), names, field, days, bucket_min, COMPARE_TABLE_ROWS,
+        cancelled=_client_gone(request),
+    )
+    head_html = "".join(f"<th>{n}</th>" for n in names)
 
-    flag_th = {
-        "white": "⚪⚪⚪",
-        "green": "🟢🟢🟢",
-        "yellow": "🟡🟡🟡",
-        "red": "🔴🔴🔴",
-        "black": "⚫⚫⚫"
-    }
+    field_options = "".join(
+        f'<option value="{k}" {"selected" if k == field else ""}>{v}</option>' for k, v in COMPARE_FIELDS.items()
+    )
+    day_options = "".join(
+        f'<option value="{d}" {"selected" if float(d) == days else ""}>{d} วัน</option>' for d in (1, 7, 30)
+    )
+    bucket_text = f"{bucket_sec // 3600:g} ชม." if bucket_sec >= 3600 else f"{bucket_sec // 60:g} นาที"
 
-    # ปรับให้กันกรณีส่งตัวใหญ่ / แปลก ๆ มา
-    flag_key = (data.flag or "").lower()
-    flag_info = flag_map.get(flag_key, {})
-    water_txt = flag_info.get("water", "-")
-    rest_txt = flag_info.get("rest", "-")
-    flag_txt = flag_th.get(flag_key, data.flag)
-
-    # ---------- ประกอบข้อความส่ง LINE ----------
-    msg_lines = [
-        f"หน่วย: {unit_name}",
-        f"🌡อุณหภูมิ: {data.temp:.1f} °C",
-        f"💧ความชื้น: {data.humid:.1f} %RH",
-        f"-สัญญาณธงสี: {flag_txt}",
-        f"-รู้สึกเหมือน: {data.hic:.1f} °C",
-        f"-ฝึก/พัก: {rest_txt}",
-        f"-ดื่มน้ำ: {water_txt}",
-    ]
-
-    msg_text = "\n".join(msg_lines)
-
-    # 4) push LINE ไปทุก line_id (เฉพาะเวลานาที = 00)
-    push_results = []
-    if not notify_allowed:
-        push_results.append("Skip LINE push: minute != 00")
-    else:
-        if line_ids:
-            for lid in line_ids:
-                try:
-                    line_bot_api.push_message(
-                        lid,
-                        TextSendMessage(text=msg_text)
-                    )
-                    push_results.append(f"OK:{lid}")
-                except Exception as e:
-                    logger.exception("Error when pushing LINE message")
-                    push_results.append(f"ERR:{lid}:{e}")
-        else:
-            push_results.append("No line_id subscribed; skip LINE push")
+    html = f"""
+    <!DOCTYPE html>
+    <html lang="th">
+    <head>
+        <meta charset="utf-8" />
+        <meta name="viewport" content="width=device-width, initial-scale=1" />
+        <title>Compare - {COMPARE_FIELDS[field]}</title>
+        <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
+        <style>
+            body {{
+                font-family: -apple-system, BlinkMacSystemFont, "Segoe UI", sans-serif;
+                background: #f3f4f6;
+                color: #111827;
+                margin: 0;
+                padding: 16px;
+            }}
+            .container {{
+                max-width: 1100px;
+                margin: 0 auto;
+            }}
+            .card {{
+                background: #ffffff;
+                border-radius: 18px;
+                padding: 18px 16px 20px;
+                box-shadow: 0 10px 25px rgba(15,23,42,0.12);
+                border: 1px solid #e5e7eb;
+                margin-bottom: 16px;
+                overflow-x: auto;
+            }}
+            .header {{
+                display: flex;
+                flex-wrap: wrap;
+                align-items: center;
+                justify-content: space-between;
+                gap: 10px;
+            }}
+            h1 {{
+                font-size: 1.3rem;
+                margin: 0;
+            }}
+            select {{
+                padding: 8px 10px;
+                border-radius: 999px;
+                border: 1px solid #d1d5db;
+                background: #f9fafb;
+                font-size: 0.9rem;
+            }}
+            .info-line {{
+                font-size: 0.8rem;
+                color: #6b7280;
+                margin-top: 4px;
+            }}
+            .info-line a {{
+                color: #0369a1;
+            }}
+            canvas {{
+                max-height: 320px;
+            }}
+            table {{
+                width: 100%;
+                border-collapse: collapse;
+                margin-top: 10px;
+                font-size: 0.85rem;
+            }}
+            th, td {{
+                border-bottom: 1px solid #e5e7eb;
+                padding: 6px 8px;
+                text-align: left;
+                white-space: nowrap;
+            }}
+            th {{
+                background: #f9fafb;
+                font-weight: 600;
+            }}
+        </style>
+    </head>
+    <body>
+        <div class="container">
+            <div class="card">
+                <div class="header">
+                    <div>
+                        <h1>Compare devices</h1>
+                        <div class="info-line">
+                            เฉลี่ยทุก {bucket_text} | <a href="/history?line_id={line_id}">‹ History รายเครื่อง</a>
+                        </div>
+                        <div class="info-line">{updated_html}</div>
+                    </div>
+                    <form method="get" action="/compare">
+                        <input type="hidden" name="line_id" value="{line_id}" />
+                        <select name="field" onchange="this.form.submit()">{field_options}</select>
+                        <select name="days" onchange="this.form.submit()">{day_options}</select>
+                    </form>
+                </div>
+            </div>
+
+            <div class="card">
+                <canvas id="compareChart"></canvas>
+            </div>
+
+            <div class="card">
+                <table>
+                    <thead>
+                        <tr><th>Timestamp</th>{head_html}</tr>
+                    </thead>
+                    <tbody>
+                        {table_rows_html}
+                    </tbody>
+                </table>
+            </div>
+        </div>
+
+        <script>
+        const chartData = {chart_json};
+        new Chart(document.getElementById('compareChart').getContext('2d'), {{
+            type: 'line',
+            data: {{
+                labels: chartData.labels,
+                datasets: chartData.series.map(function(values, i) {{
+                    return {{
+                        label: chartData.names[i],
+                        data: values,
+                        spanGaps: true,
+                        pointRadius: 0,
+                        tension: 0.25
+                    }};
+                }})
+            }},
+            options: {{
+                responsive: true,
+                maintainAspectRatio: false,
+                interaction: {{
+                    mode: 'index',
+                    intersect: false,
+                }},
+                plugins: {{
+                    legend: {{
+                        position: 'top',
+                    }}
+                }},
+                scales: {{
+                    y: {{
+                        title: {{
+                            display: true,
+                            text: '{COMPARE_FIELDS[field]}'
+                        }}
+                    }}
+                }}
+            }}
+        }});
+        </script>
+    </body>
+    </html>
+    """
+    return HTMLResponse(content=html)
+
+
+@app.get("/history/export")
+def history_export(request: Request, line_id: str, device_id: Optional[str] = None):
+    """
+    history ของห้องเป็น CSV (เก่า → ใหม่) จาก columns ชุดเดียวกับ /history
+    device_id ไม่ใส่ = ทุก device ของห้อง
+    แปลงเป็น CSV ใน process pool ทีละ EXPORT_CHUNK_ROWS แถว: chunk แรกทำก่อนตอบ (pool เต็ม ⇒ 503)
+    chunk ถัดไปรอคิวได้ client ปิดกลางทาง ⇒ หยุดส่งงานที่เหลือ
+    """
+    hist_json = get_history_by_line_id(line_id)
+    if not (isinstance(hist_json, dict) and hist_json.get("success")):
+        return JSONResponse(status_code=502, content={"success": False, "message": "history not available"})
+    hist_cols = hist_json.get("columns") or {}
+    if device_id:
+        selected = [hist_cols.get(device_id) or DeviceColumns.empty(device_id)]
+    else:
+        selected = list(hist_cols.values())
+
+    chunks = [cols.slice(lo, lo + EXPORT_CHUNK_ROWS)
+              for cols in selected for lo in range(0, len(cols), max(1, EXPORT_CHUNK_ROWS))]
+    cancelled = _client_gone(request)
+    first = cpu_pool.call(render.csv_chunk, chunks[0], cancelled=cancelled) if chunks else ""
+
+    def lines():
+        yield ",".join(CSV_HEADER) + "\r\n" + first
+        for chunk in chunks[1:]:
+            try:
+                yield cpu_pool.call(render.csv_chunk, chunk, cancelled=cancelled, wait=True)
+            except CallCancelled:
+                return
+
+    filename = f"history_{device_id or 'all'}.csv"
+    return StreamingResponse(lines(), media_type="text/csv",
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+# =========================================================
+# 📡 API: POST /history (sensor → Google Sheet + push LINE)
+# =========================================================
+
+class HistoryIn(BaseModel):
+    id: str          # ตรงนี้คือ device_id (serial เครื่องวัด)
+    temp: float
+    humid: float
+    hic: float
+    flag: str = "OK"
+    timestamp: Optional[str] = None  # ถ้าไม่ส่ง ใส่เวลาที่รับเข้า queue (เป็น key กันเขียนซ้ำตอน retry)
+
+
+class IngestMetrics:
+    """
+    เก็บสถิติของ POST /history ฝั่ง server (ดูผ่าน GET /metrics)
+    - in_flight / max_in_flight = จำนวน request ที่กำลังทำอยู่พร้อมกัน
+    - latency ของ request ล่าสุด (window) ไว้คิด p50 / p99
+    """
+
+    def __init__(self, window: int = 4096):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.total = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.hic_mismatch = 0
+
+    def start(self):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def finish(self, elapsed_sec: float, ok: bool):
+        with self.lock:
+            self.in_flight -= 1
+            self.total += 1
+            if not ok:
+                self.errors += 1
+            self.latencies.append(elapsed_sec)
+
+    def note_mismatch(self):
+        with self.lock:
+            self.hic_mismatch += 1
+
+    def snapshot(self, reset_peak: bool = False) -> dict:
+        with self.lock:
+            lat = sorted(self.latencies)
+            snap = {
+                "total": self.total,
+                "errors": self.errors,
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "hic_mismatch": self.hic_mismatch,
+                "p50_ms": round(lat[len(lat) // 2] * 1000, 2) if lat else 0.0,
+                "p99_ms": round(lat[min(len(lat) - 1, int(len(lat) * 0.99))] * 1000, 2) if lat else 0.0,
+            }
+            if reset_peak:
+                self.max_in_flight = self.in_flight
+            return snap
+
+
+ingest_metrics = IngestMetrics()
+
+
+@app.post("/history")
+async def post_history(data: HistoryIn):
+    """
+    API สำหรับ device ส่งค่าเข้า (ไม่ใช่หน้าเว็บ)
+
+    - ผ่าน admission (token bucket ต่อ device + รวม) แล้วเข้า queue ตอบกลับทันที
+    - worker ค่อย ๆ ระบาย queue ไป GAS / LINE (ดู process_reading)
+    - ถ้ารับไม่ไหว ⇒ 429 / 503 + retry_after (วินาที) และ header Retry-After
+
+    - LINE noti ไม่ได้ส่งจากตรงนี้แล้ว: HourlyNotifier ส่งค่าล่าสุดทุกต้นชั่วโมง
+    """
+    t0 = time.perf_counter()
+    ingest_metrics.start()
+    ok = False
+    try:
+        if not data.timestamp:
+            data.timestamp = str(round(time.time(), 3))
+        adm = ingest_admission.admit(data.id, data)
+        if adm.accepted:
+            ok = True
+            _check_reading(data)
+            _remember_reading(data)
+            _evaluate_alerts(data)
+            return {
+                "status": "ok",
+                "queued": True,
+                "queue_depth": adm.queue_depth,
+            }
+
+        # รับไม่ไหว ⇒ บอก firmware ว่าให้ยิงใหม่อีกกี่วินาที (ไม่ทิ้งข้อมูลเงียบ ๆ)
+        return JSONResponse(
+            status_code=503 if adm.reason == "queue_full" else 429,
+            content={
+                "status": "retry",
+                "reason": adm.reason,
+                "retry_after": adm.retry_after,
+                "queue_depth": adm.queue_depth,
+            },
+            headers={"Retry-After": str(int(math.ceil(adm.retry_after)))},
+        )
+    finally:
+        ingest_metrics.finish(time.perf_counter() - t0, ok)
+
+
+# =========================================================
+# ⚙️ ingest worker: ระบาย queue → Google Sheet + LINE
+# =========================================================
+
+ingest_admission = IngestAdmission(
+    queue_max=INGEST_QUEUE_MAX,
+    device_rate=INGEST_DEVICE_PER_MIN / 60.0,
+    device_burst=INGEST_DEVICE_BURST,
+    global_rate=INGEST_GLOBAL_PER_SEC,
+    global_burst=INGEST_GLOBAL_BURST,
+    drain_rate=INGEST_DRAIN_PER_SEC,
+    # หลาย worker ⇒ global / drain rate เป็นของทั้งเครื่อง (GAS ได้ไม่เกิน INGEST_DRAIN_PER_SEC ไม่ว่ากี่ worker)
+    shared_bucket=(lambda name, rate, burst: SharedTokenBucket(shared_state, name, rate, burst))
+    if shared_state is not None else None,
+)
+_ingest_tasks: List[asyncio.Task] = []
+_ingest_retrying: Dict[int, HistoryIn] = {}   # worker_no → ค่าที่กำลัง retry อยู่
+
+
+async def _ingest_worker(worker_no: int):
+    """
+    ดึงค่าจาก queue ทีละตัว (ตาม drain rate) แล้วทำงานเดิมของ POST /history ใน thread
+    ถ้า append_history พลาด ⇒ retry แบบ backoff (สูงสุด INGEST_RETRY_MAX_SEC) จนกว่าจะได้ ไม่ทิ้ง
+    ระหว่างนั้น worker ไม่รับงานใหม่ ⇒ queue เต็มแล้ว admission ตอบ 503 ให้ firmware ยิงใหม่เอง (backpressure)
+    retry หลัง timeout ไม่เขียนแถวซ้ำ: appendHistory ส่ง key (id + timestamp) ไปด้วย
+    """
+    while True:
+        data = await ingest_admission.next_item()
+        attempt = 0
+        while True:
+            try:
+                result = await asyncio.to_thread(process_reading, data)
+                if result.get("status") == "ok":
+                    break
+            except Exception:
+                logger.exception(f"ingest worker {worker_no}: process_reading failed")
+            _ingest_retrying[worker_no] = data
+            ingest_admission.note_retry()
+            await asyncio.sleep(min(INGEST_RETRY_MAX_SEC, 2 ** attempt))
+            attempt += 1
+        _ingest_retrying.pop(worker_no, None)
+        ingest_admission.task_done()
+
+
+@app.on_event("startup")
+async def start_ingest_workers():
+    for i in range(INGEST_WORKERS):
+        _ingest_tasks.append(asyncio.create_task(_ingest_worker(i)))
+
+
+@app.on_event("shutdown")
+async def flush_ingest_queue():
+    """
+    ตอนปิด server ให้เวลา worker ระบาย queue ที่ค้างอยู่
+    ที่เหลือหลังหมดเวลา ⇒ log ทิ้งไว้ทุกตัว (ไม่หายเงียบ ๆ)
+    """
+    q = ingest_admission.queue
+    if q is not None and not q.empty():
+        try:
+            await asyncio.wait_for(q.join(), timeout=INGEST_SHUTDOWN_GRACE_SEC)
+        except asyncio.TimeoutError:
+            while not q.empty():
+                data = q.get_nowait()
+                logger.error(f"ingest not flushed at shutdown: {data.dict()}")
+    for data in _ingest_retrying.values():
+        logger.error(f"ingest not flushed at shutdown (retrying): {data.dict()}")
+    for t in _ingest_tasks:
+        t.cancel()
+
+
+def process_reading(data: HistoryIn) -> dict:
+    """
+    งานของ POST /history ที่รันใน worker (ไม่ใช่บน request):
+    บันทึก History ลง Google Sheet
+    (แจ้งเตือน LINE ย้ายไปทำรายชั่วโมงที่ HourlyNotifier)
+    """
+    device_id = data.id
+
+    # 1) บันทึก History ลง Google Sheet (บันทึกทุกครั้ง)
+    try:
+        gs_result = append_history(
+            device_id=device_id,
+            temp=data.temp,
+            humid=data.humid,
+            hic=data.hic,
+            flag=data.flag,
+            timestamp=data.timestamp,
+        )
+    except Exception as e:
+        logger.exception("Error when calling append_history")
+        return {
+            "status": "error",
+            "message": f"append_history failed: {e}",
+        }
+
+    # ค่าใหม่อยู่ใน Sheet แล้ว ⇒ หน้า /status / ข้อมูลของทุกห้องที่มี device นี้ต้อง refresh
+    invalidate_device_views(device_id)
 
     return {
         "status": "ok",
         "google_sheet": gs_result,
-        "line_push_results": push_results,
     }
 
 
+# =========================================================
+# 🔔 แจ้งเตือน LINE รายชั่วโมง (ไม่ผูกกับ request ของ device แล้ว)
+# =========================================================
+
+# ค่าล่าสุดของแต่ละ device (อัปเดตตอนรับเข้า queue) ใช้ทำแจ้งเตือน
+latest_readings: Dict[str, dict] = {}
+
+
+def _check_reading(data: HistoryIn):
+    """
+    เทียบ hic / flag ที่ device คำนวณมากับสูตรฝั่ง server (heat_index.py)
+    ไม่แก้ค่า แค่นับ + log ไว้จับ firmware / calibration ที่เพี้ยน
+    """
+    issues = check_reading(data.temp, data.humid, data.hic, data.flag)
+    if issues:
+        ingest_metrics.note_mismatch()
+        logger.warning(f"reading check {data.id}: {'; '.join(issues)}")
+
+
+def _remember_reading(data: HistoryIn):
+    epoch, ts = _note_reading(data)
+    if reading_rings is not None:
+        reading_rings.append(data.id, gas_ts_key(ts), data.temp, data.humid, data.hic, data.flag)
+    # worker อื่น (ไฟล์ ring ใช้ร่วมกันอยู่แล้ว) ⇒ ค่าล่าสุด / liveness / alert ของ leader
+    # ไม่ส่ง timestamp ⇒ ใช้เวลาที่รับเข้าที่นี่ (ทุก worker ได้ ts เดียวกัน)
+    _broadcast("reading", dict(data.dict(), timestamp=data.timestamp or str(epoch)), wait=False)
+
+
+def _note_reading(data: HistoryIn) -> Tuple[float, str]:
+    """
+    จำค่าล่าสุดใน process นี้ (latest_readings + warm_state) คืน (epoch, timestamp แบบ GAS)
+    ค่าที่เก่ากว่าค่าล่าสุดที่มีอยู่ (firmware retry มาช้า) ⇒ ต่อ history อย่างเดียว ไม่ทับค่าล่าสุด
+    """
+    received_at = time.time()
+    try:
+        epoch = float(data.timestamp)
+    except (TypeError, ValueError):
+        epoch = received_at  # timestamp แบบ ISO / อ่านไม่ได้ ⇒ ใช้เวลาที่รับ
+    reading = {
+        "temp": data.temp,
+        "humid": data.humid,
+        "hic": data.hic,
+        "flag": data.flag,
+        "timestamp": data.timestamp,
+        "received_at": received_at,
+        "epoch": epoch,
+    }
+    cur = latest_readings.get(data.id)
+    newer = cur is None or epoch >= cur.get("epoch", cur["received_at"])
+    if newer:
+        latest_readings[data.id] = reading
+    ts = gas_timestamp(epoch)
+    warm_state.add_reading(data.id, reading, ts, latest=newer)
+    return epoch, ts
+
+
+def resolve_device_targets(device_id: str) -> Tuple[str, List[str]]:
+    """
+    คืน (unit_name, [line_id, ...]) ของ device
+    - unit จาก config (fallback = device_id)
+    - line_id ทุกห้องที่ subscribe device นี้
+    """
+    unit_name = device_id  # fallback
+    try:
+        cfg = get_config_by_id(device_id)
+        if isinstance(cfg, dict) and cfg.get("success") and cfg.get("count", 0) > 0:
+            row = cfg["data"][0]
+            unit_name = str(row.get("unit") or device_id)
+    except Exception as e:
+        logger.exception("Error fetching config in resolve_device_targets")
+        row = warm_state.config(device_id)
+        if row:
+            unit_name = str(row.get("unit") or device_id)
+
+    try:
+        subs_json = get_subscriptions_by_id(device_id)
+        line_ids = extract_line_ids_from_subs(subs_json)
+    except Exception as e:
+        logger.exception("Error when calling get_subscriptions_by_id")
+        line_ids = warm_state.line_ids_for(device_id) or []
+
+    return unit_name, line_ids
+
+
+def _push_texts(line_id: str, texts: List[str], retry_key: Optional[str] = None):
+    from linebot.exceptions import LineBotApiError
+    from linebot.models import TextSendMessage
+
+    try:
+        get_line_bot_api().push_message(line_id, [TextSendMessage(text=t) for t in texts], retry_key=retry_key)
+    except LineBotApiError as e:
+        if retry_key and e.status_code == 409:
+            return   # retry key นี้ LINE รับไปแล้ว (attempt ก่อน timeout แต่ส่งสำเร็จ)
+        raise
+
+
+line_sender = LinePushSender(_push_texts, rate=LINE_PUSH_PER_SEC, burst=LINE_PUSH_PER_SEC)
+
+
+def _newer_reading(cur: Optional[dict], new: Optional[dict]) -> bool:
+    return new is not None and (cur is None or new["epoch"] > cur.get("epoch", cur["received_at"]))
+
+
+def shared_latest_readings() -> Dict[str, dict]:
+    """
+    ค่าล่าสุดของทุก device จากที่ใช้ร่วมกันทุก worker / อยู่รอดข้าม restart (แหล่งเดียวกับ /status)
+    warm_state (snapshot + current_status + ingest) → ring (mmap ที่ทุก worker เขียน) → latest_readings ของ process นี้
+    เลือกค่าที่ timestamp ใหม่สุดต่อ device
+    """
+    merged = warm_state.latest_readings()
+    if reading_rings is not None:
+        for did in warm_state.device_ids() | set(latest_readings):
+            last = reading_rings.latest(did)
+            if last is None:
+                continue
+            reading = {
+                "temp": last["temp"],
+                "humid": last["humid"],
+                "hic": last["hic"],
+                "flag": last["flag"],
+                "timestamp": last["timestamp"],
+                "received_at": last["ts"],
+                "epoch": last["ts"],
+            }
+            if _newer_reading(merged.get(did), reading):
+                merged[did] = reading
+    for did, reading in list(latest_readings.items()):
+        cur = merged.get(did)
+        if cur is None or reading["epoch"] >= cur["epoch"]:
+            merged[did] = reading
+    return merged
+
+
+def seed_latest_readings():
+    """
+    ตอน start ⇒ เติม latest_readings จากแหล่งร่วม
+    ค่า firmware retry ที่มาช้าหลัง restart จะได้ไม่ทับค่าที่ใหม่กว่า
+    """
+    for did, reading in shared_latest_readings().items():
+        if _newer_reading(latest_readings.get(did), reading):
+            latest_readings[did] = reading
+
+
+hourly_notifier = HourlyNotifier(
+    get_latest=shared_latest_readings,
+    resolve=resolve_device_targets,
+    sender=line_sender,
+)
+
+
+# ---------- alert ทันที (ธงสีขยับ / hic สูงต่อเนื่อง / ขึ้นเร็ว) ----------
+alert_engine = AlertEngine.from_config(ALERT_RULES_PATH)
+
+
+async def _deliver_alerts(alerts: List[Alert]):
+    """
+    หา unit + ห้องที่ subscribe แล้วส่งผ่าน line_sender (batch ตามห้อง)
+    rule ที่ผูก line_id ⇒ ส่งเฉพาะห้องนั้น (และห้องนั้นต้อง subscribe device อยู่)
+    """
+    by_device: Dict[str, List[Alert]] = {}
+    for a in alerts:
+        by_device.setdefault(a.device_id, []).append(a)
+
+    for device_id, dev_alerts in by_device.items():
+        try:
+            unit_name, line_ids = await asyncio.to_thread(resolve_device_targets, device_id)
+        except Exception:
+            logger.exception(f"Cannot resolve targets for alerts of {device_id}")
+            continue
+        for a in dev_alerts:
+            targets = [a.rule.line_id] if a.rule.line_id else line_ids
+            for lid in targets:
+                if lid in line_ids:
+                    line_sender.enqueue(lid, a.message(unit_name))
+
+
+_delivery_tasks: set = set()   # ถือ reference ไว้ (ไม่งั้น task โดน GC กลางทาง) + log exception
+
+
+def _on_delivery_done(task: asyncio.Task):
+    _delivery_tasks.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("alert / liveness delivery failed", exc_info=task.exception())
+
+
+def _spawn_delivery(coro):
+    task = asyncio.get_running_loop().create_task(coro)
+    _delivery_tasks.add(task)
+    task.add_done_callback(_on_delivery_done)
+
+
+def _evaluate_alerts(data: HistoryIn):
+    came_back = liveness.touch(data.id)
+    if not is_leader():
+        return   # leader ได้ค่านี้ผ่าน shared_state แล้วแจ้งเตือนเอง (state ของ alert อยู่ที่เดียว ไม่ส่งซ้ำ)
+    alerts = alert_engine.evaluate(data.id, latest_readings[data.id])
+    if alerts:
+        _spawn_delivery(_deliver_alerts(alerts))
+    if came_back:
+        _spawn_delivery(_deliver_liveness(data.id, "online", 0.0))
+
+
+# ---------- device หาย (offline) / กลับมา (online) ----------
+
+async def _deliver_liveness(device_id: str, new_state: str, last_seen: float):
+    try:
+        unit_name, line_ids = await asyncio.to_thread(resolve_device_targets, device_id)
+    except Exception:
+        logger.exception(f"Cannot resolve targets for liveness of {device_id}")
+        return
+    if new_state == "offline":
+        text = build_offline_message(unit_name, device_id, last_seen, ONLINE_WINDOW_SEC)
+    else:
+        text = build_online_message(unit_name, device_id)
+    for lid in line_ids:
+        line_sender.enqueue(lid, text)
+
+
+async def _liveness_sweeper():
+    """
+    ทุก LIVENESS_SWEEP_SEC วินาที หา device ที่เพิ่งเกิน ONLINE_WINDOW_SEC แล้วแจ้งห้องที่ subscribe
+    (แจ้งครั้งเดียวต่อการเปลี่ยนสถานะ)
+    """
+    while True:
+        await asyncio.sleep(LIVENESS_SWEEP_SEC)
+        try:
+            for device_id, last_seen in liveness.sweep():
+                if not is_leader():
+                    status_page_cache.invalidate_device(device_id)   # แจ้งเตือน + ล้าง cache ร่วมเป็นงานของ leader
+                    continue
+                invalidate_views(devices=(device_id,))
+                await _deliver_liveness(device_id, "offline", last_seen)
+        except Exception:
+            logger.exception("liveness sweep failed")
+
+
+_liveness_task: Optional[asyncio.Task] = None
+
+
+@app.on_event("startup")
+async def start_notifier():
+    global _liveness_task
+    line_sender.start()
+    if HOURLY_NOTIFY_ENABLED and is_leader():
+        hourly_notifier.start()
+    _liveness_task = asyncio.create_task(_liveness_sweeper())
+
+
+@app.on_event("shutdown")
+async def stop_notifier():
+    if _liveness_task is not None:
+        _liveness_task.cancel()
+    hourly_notifier.stop()
+    line_sender.stop()
+
+
+# =========================================================
+# 🛠 ปรับ calibration ย้อนหลัง (background job, ดู recalibrate.py)
+# =========================================================
+
+def _on_recalibrated(device_id: str, rows: List[dict]):
+    """
+    แถวใน Sheet ถูกเขียนค่าใหม่ ⇒ ถ้าค่าล่าสุดที่จำไว้อยู่ในชุดนี้ ก็แก้ตามด้วย
+    (timestamp ของ firmware เป็นเลข epoch, ของ GAS เป็น ISO ⇒ เทียบผ่าน lastupdate_epoch ทั้งคู่)
+    """
+    if reading_rings is not None:
+        reading_rings.invalidate(device_id)   # seed ใหม่รอบ fetch หน้า
+    _apply_recalibrated(device_id, rows)
+    _broadcast("recalibrated", {"device_id": device_id, "rows": rows})
+    invalidate_device_views(device_id)
+
+
+def _apply_recalibrated(device_id: str, rows: List[dict]):
+    history_store.apply_updates(device_id, rows)
+    cur = latest_readings.get(device_id)
+    if not cur:
+        return
+    try:
+        cur_ts = lastupdate_epoch(float(cur.get("timestamp")))
+    except (TypeError, ValueError):
+        cur_ts = lastupdate_epoch(cur.get("timestamp"))
+    if cur_ts is None:
+        return
+    for r in rows:
+        ts = lastupdate_epoch(r.get("timestamp"))
+        if ts is not None and abs(ts - cur_ts) < 1.0:
+            cur.update(temp=r["temp"], humid=r["humid"], hic=r["hic"], flag=r["flag"])
+            break
+
+
+recalibrator = Recalibrator(
+    fetch_page=recal_history_page,
+    update_rows=update_history_rows,
+    row_epoch=lastupdate_epoch,
+    checkpoint_dir=RECAL_DIR,
+    chunk_size=RECAL_CHUNK_ROWS,
+    pause_sec=RECAL_PAUSE_SEC,
+    on_rows_updated=_on_recalibrated,
+    run_cpu=cpu_pool.call,
+)
+
+
+def _current_adj(device_id: str) -> Optional[Tuple[float, float]]:
+    """
+    (adj_temp, adj_humid) ที่ตั้งไว้ตอนนี้ ไม่มี config / อ่านไม่ได้ ⇒ None (ลงทะเบียนครั้งแรก ไม่ต้อง recalibrate)
+    """
+    try:
+        cfg = get_config_by_id(device_id)
+    except Exception:
+        logger.exception(f"Error reading config of {device_id} before write")
+        return None
+    if not (isinstance(cfg, dict) and cfg.get("success") and cfg.get("count", 0) > 0):
+        return None
+    row = cfg["data"][0]
+    return _safe_float(row.get("adj_temp"), 0.0), _safe_float(row.get("adj_humid"), 0.0)
+
+
+class RecalibrateIn(BaseModel):
+    device_id: str
+    line_id: str                 # ห้องที่ผูก device นี้อยู่ (แบบเดียวกับ /status/remove)
+    delta_temp: float = 0.0
+    delta_humid: float = 0.0
+    start: Optional[str] = None  # เวลาไทย เช่น 2025-01-01 หรือ 2025-01-01T08:00 (ไม่ใส่ = ตั้งแต่แรก)
+    end: Optional[str] = None    # ไม่รวมจุดนี้ (ไม่ใส่ = เวลาที่สั่ง ค่าที่เข้ามาหลังจากนี้ใช้ adj ใหม่แล้ว)
+
+
+@app.on_event("startup")
+async def start_recalibrator():
+    recalibrator.start(resume=is_leader())
+
+
+@app.on_event("shutdown")
+async def stop_recalibrator():
+    recalibrator.stop()
+
+
+@app.post("/recalibrate")
+def recalibrate_submit(req: RecalibrateIn):
+    """
+    สั่งปรับค่าย้อนหลังของ device: temp += delta_temp, humid += delta_humid ในช่วง [start, end)
+    แล้วคำนวณ hic / ธงสีใหม่ (ทำเป็น background job ดูความคืบหน้าที่ GET /recalibrate/{job_id})
+
+    แก้ adj ใน /register จะสั่ง job ให้เอง endpoint นี้ไว้แก้ช่วงอื่น ๆ ด้วยมือ
+    ต้องส่ง line_id ของห้องที่ผูก device ไว้ (ไม่ผูก ⇒ 403)
+    """
+    if req.delta_temp == 0 and req.delta_humid == 0:
+        return JSONResponse(status_code=400, content={"success": False, "message": "delta_temp / delta_humid are both 0"})
+    try:
+        bound = req.line_id in extract_line_ids_from_subs(get_subscriptions_by_id(req.device_id))
+    except Exception:
+        logger.exception("Error checking subscription in /recalibrate")
+        return JSONResponse(status_code=503, content={"success": False, "message": "cannot check subscription"})
+    if not bound:
+        return JSONResponse(status_code=403, content={"success": False, "message": "device is not bound to this line_id"})
+    start = reading_epoch(req.start, default=float("nan")) if req.start else None
+    end = reading_epoch(req.end, default=float("nan")) if req.end else time.time()
+    if start != start or end != end:
+        return JSONResponse(status_code=400, content={"success": False, "message": "invalid start / end"})
+    job = recalibrator.submit(req.device_id, req.delta_temp, req.delta_humid, start, end, req.line_id)
+    return {"success": True, "job": job.progress()}
+
+
+@app.get("/recalibrate")
+def recalibrate_list():
+    return {
+        "success": True,
+        "data": [j.progress() for j in sorted(recalibrator.jobs.values(), key=lambda j: j.created_at)],
+    }
+
+
+@app.get("/recalibrate/{job_id}")
+def recalibrate_status(job_id: str):
+    job = recalibrator.get(job_id)
+    if job is None:
+        return JSONResponse(status_code=404, content={"success": False, "message": "job not found"})
+    return {"success": True, "job": job.progress()}
+
+
+# =========================================================
+# 🔄 history sync (ดู history_store.py)
+# =========================================================
+
+@app.post("/history/resync")
+def history_resync(line_id: Optional[str] = Query(None), device_id: Optional[str] = Query(None)):
+    """
+    ทิ้ง history ที่ sync ไว้ของห้อง / device แล้วให้รอบหน้าดึงทั้งหมดจาก GAS ใหม่
+    (ใช้เมื่อแก้ข้อมูลใน Sheet ด้วยมือ หรือ HWM เพี้ยน)
+    """
+    if not line_id and not device_id:
+        return JSONResponse(status_code=400, content={"success": False, "message": "line_id or device_id is required"})
+    ids = []
+    if line_id:
+        ids.extend(warm_state.device_ids_for(line_id) or [])
+    if device_id:
+        ids.append(device_id)
+    history_store.reset(ids)
+    _broadcast("resync", {"device_ids": ids})
+    for did in ids:
+        if reading_rings is not None:
+            reading_rings.invalidate(did)
+        invalidate_device_views(did)
+    if line_id:
+        invalidate_line_views(line_id)
+    return {"success": True, "reset": ids}
+
+
+# =========================================================
+# 💾 snapshot / warm start (ดู snapshot.py)
+# =========================================================
+
+_snapshot_tasks: List[asyncio.Task] = []
+
+
+async def _warm_refresh():
+    """
+    หลังโหลด snapshot: ดึง current_status + history ของทุก line ที่รู้จักจาก GAS ใหม่ทีละ line
+    (หน้าเว็บใช้ข้อมูล snapshot ไปก่อนจนกว่า line นั้นจะเสร็จ)
+    """
+    for line_id in warm_state.line_ids():
+        try:
+            gas_cache.put(("status", line_id), await asyncio.to_thread(fetch_current_status, line_id))
+            gas_cache.put(("history", line_id), await asyncio.to_thread(fetch_history_by_line_id, line_id))
+            invalidate_views(pages=(line_id,))  # หน้าที่ render จาก snapshot
+        except Exception:
+            logger.exception(f"warm refresh of {line_id} failed")
+
+
+async def _snapshot_loop():
+    while True:
+        await asyncio.sleep(SNAPSHOT_EVERY_SEC)
+        if not warm_state.dirty or not is_leader():
+            continue
+        try:
+            await asyncio.to_thread(warm_state.save, SNAPSHOT_PATH)
+        except Exception:
+            logger.exception(f"Cannot write snapshot {SNAPSHOT_PATH}")
+
+
+@app.on_event("startup")
+async def load_snapshot():
+    if not SNAPSHOT_PATH:
+        return
+    if warm_state.load(SNAPSHOT_PATH):
+        logger.info(f"warm start from {SNAPSHOT_PATH}: {warm_state.snapshot()}")
+        _snapshot_tasks.append(asyncio.create_task(_warm_refresh()))
+    _snapshot_tasks.append(asyncio.create_task(_snapshot_loop()))
+
+
+@app.on_event("startup")
+async def seed_latest():
+    seed_latest_readings()   # หลังโหลด snapshot (ring ไม่ต้องรอ)
+
+
+@app.on_event("shutdown")
+async def save_snapshot():
+    for t in _snapshot_tasks:
+        t.cancel()
+    if SNAPSHOT_PATH and warm_state.dirty and is_leader():
+        try:
+            warm_state.save(SNAPSHOT_PATH)
+        except Exception:
+            logger.exception(f"Cannot write snapshot {SNAPSHOT_PATH}")
+
+
+@app.on_event("startup")
+async def start_storage():
+    storage.start(leader=is_leader())   # tiered: bootstrap จาก GAS (ครั้งแรก) + thread mirror
+
+
+@app.on_event("shutdown")
+async def stop_storage():
+    # ลงทะเบียนหลัง flush_ingest_queue ⇒ งาน ingest ที่ค้างเขียนเสร็จก่อนปิด
+    await asyncio.to_thread(storage.stop)
+
+
+# =========================================================
+# 🔀 หลาย worker (uvicorn --workers N ดู shared.py)
+# =========================================================
+# worker อื่นเปลี่ยนอะไร ⇒ ทำตามใน process นี้ (ไม่ publish ต่อ)
+
+_main_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def _on_shared_reading(payload: dict):
+    # liveness / alert / task ของ LINE อยู่บน event loop
+    _main_loop.call_soon_threadsafe(_apply_shared_reading, HistoryIn(**payload))
+
+
+def _apply_shared_reading(data: HistoryIn):
+    _note_reading(data)
+    _evaluate_alerts(data)
+
+
+def _on_shared_sub(payload: dict):
+    if payload["added"]:
+        warm_state.add_sub(payload["device_id"], payload["line_id"])
+    else:
+        warm_state.remove_sub(payload["device_id"], payload["line_id"])
+
+
+def _take_over():
+    """
+    leader เดิมหายไป (process ตาย / restart) ⇒ worker นี้รับงานที่ต้องมีตัวเดียวต่อ
+    """
+    logger.info(f"pid {os.getpid()} took over background jobs")
+    if HOURLY_NOTIFY_ENABLED:
+        hourly_notifier.start()
+    recalibrator.resume()
+    storage.start(leader=True)
+
+
+@app.on_event("startup")
+async def start_shared():
+    global _main_loop
+    if shared_state is None:
+        return
+    _main_loop = asyncio.get_running_loop()
+    shared_state.on("invalidate", lambda p: _invalidate_views(p["devices"], p["lines"], p["pages"]))
+    shared_state.on("config", lambda p: warm_state.note_config(p["device_id"], p["row"]))
+    shared_state.on("sub", _on_shared_sub)
+    shared_state.on("reading", _on_shared_reading)
+    shared_state.on("recalibrated", lambda p: _apply_recalibrated(p["device_id"], p["rows"]))
+    shared_state.on("resync", lambda p: history_store.reset(p["device_ids"]))
+    shared_state.start(on_leader=lambda: _main_loop.call_soon_threadsafe(_take_over))
+
+
+@app.on_event("shutdown")
+async def stop_shared():
+    if shared_state is not None:
+        await asyncio.to_thread(shared_state.stop)
+
+
 @app.get("/status", response_class=HTMLResponse)
 def status_page(line_id: Optional[str] = None):
     """
@@ -2051,6 +3365,8 @@ def status_page(line_id: Optional[str] = None):
     - ใช้ current_status(line_id) ดึงข้อมูลล่าสุด
     - โชว์การ์ดสวย ๆ แยกตาม device
     - เพิ่มปุ่ม "ลบออกจากห้องนี้" สำหรับแต่ละ device
+    - HTML ที่ render แล้วเก็บใน status_page_cache (request พร้อมกัน render ครั้งเดียว)
+    - ยังไม่มีใน cache ⇒ ส่งหัวหน้าก่อน แล้วส่งการ์ดทีละใบระหว่าง render (StreamingResponse)
     """
     # ถ้าไม่มี line_id → ไม่ให้เปิดตรง ๆ
     if not line_id:
@@ -2115,16 +3431,32 @@ def status_page(line_id: Optional[str] = None):
         """
         return HTMLResponse(content=html)
 
+    # cache ตาม line_id (ล้างเมื่อ device ในห้องส่งค่าใหม่ / subscription เปลี่ยน)
+    sync_shared()
+    return StreamingResponse(status_page_cache.stream(line_id, lambda: _render_status_page(line_id)),
+                             media_type="text/html")
+
+
+def _render_status_page(line_id: str) -> Tuple[Iterator[str], List[str], bool]:
+    """
+    render หน้า /status ของ line_id คืน (ส่วนของ html ตามลำดับ, device_ids ในหน้า, เก็บลง cache ได้ไหม)
+    (ดึง GAS ไม่สำเร็จ ⇒ ไม่เก็บ) ดึงข้อมูลก่อนคืน ตัว html สร้างตอนไล่ส่วน (_status_page_parts)
+    """
     # ดึง current_status ของ line นี้
+    cacheable = True
     try:
         status_json = get_current_status_by_line_id(line_id)
         if not (isinstance(status_json, dict) and status_json.get("success")):
             devices_info = []
+            cacheable = False
         else:
             devices_info = status_json.get("data", [])
     except Exception as e:
         logger.exception("Error calling current_status in /status")
+        status_json = None
         devices_info = []
+        cacheable = False
+    updated_html = updated_ago_html(status_json.get("fetched_at") if isinstance(status_json, dict) else None)
 
     if not devices_info:
         html = f"""
@@ -2186,10 +3518,17 @@ def status_page(line_id: Optional[str] = None):
         </body>
         </html>
         """
-        return HTMLResponse(content=html)
+        return iter((html,)), [], cacheable
 
-    # สร้างการ์ดอุปกรณ์แต่ละตัว
-    cards_html = ""
+    device_ids = [str(d.get("id")) for d in devices_info if d.get("id")]
+    return _status_page_parts(line_id, devices_info, updated_html), device_ids, cacheable
+
+
+def _status_page_parts(line_id: str, devices_info: List[dict], updated_html: str) -> Iterator[str]:
+    """
+    หัวหน้า (style + header) ⇒ การ์ดอุปกรณ์ทีละใบ ⇒ ท้ายหน้า
+    """
+    yield _status_page_head(line_id, updated_html)
     for d in devices_info:
         did = str(d.get("id", "-"))
         unit = d.get("unit") or did
@@ -2215,7 +3554,7 @@ def status_page(line_id: Optional[str] = None):
             status_class = "status-unknown"
             status_icon = "⚪️"
 
-        cards_html += f"""
+        yield f"""
         <div class="device-card">
             <div class="device-header">
                 <div>
@@ -2254,8 +3593,16 @@ def status_page(line_id: Optional[str] = None):
         </div>
         """
 
-    # HTML หลัก
-    html = f"""
+    yield """
+            </div>
+        </div>
+    </body>
+    </html>
+    """
+
+
+def _status_page_head(line_id: str, updated_html: str) -> str:
+    return f"""
     <!DOCTYPE html>
     <html lang="th">
     <head>
@@ -2409,17 +3756,12 @@ def status_page(line_id: Optional[str] = None):
                 <div class="header-sub">
                     LINE: <span>{line_id}</span><br />
                     กดปุ่ม "ลบออกจากห้องนี้" เพื่อลบการเชื่อมอุปกรณ์ออกจากห้องแชทนี้เท่านั้น (ไม่ลบข้อมูลใน history)
+                    <br />{updated_html}
                 </div>
             </div>
 
             <div class="device-grid">
-                {cards_html}
-            </div>
-        </div>
-    </body>
-    </html>
-    """
-    return HTMLResponse(content=html)
+                """
 
 
 # =========================================================
@@ -2446,6 +3788,8 @@ async def status_remove(
         deleted = 0
         message = str(e)
 
+    invalidate_line_views(line_id)
+
     status_text = "ลบสำเร็จ" if success and deleted > 0 else "ไม่พบข้อมูลที่จะลบ"
     badge_color = "#dcfce7" if success and deleted > 0 else "#fee2e2"
     badge_text_color = "#166534" if success and deleted > 0 else "#b91c1c"
@@ -2540,6 +3884,36 @@ async def status_remove(
     return HTMLResponse(content=html)
 
 
+# =========================================================
+# 📈 GET /metrics (ใช้ดูตอน load test)
+# =========================================================
+
+@app.get("/metrics")
+def metrics_api(reset_peak: bool = False):
+    """
+    คืนสถิติ ingest ฝั่ง server เป็น JSON
+    - reset_peak=true ⇒ reset max_in_flight หลังอ่าน (ใช้แยกดูทีละ burst)
+    """
+    return {
+        "ingest": ingest_metrics.snapshot(reset_peak=reset_peak),
+        "queue": ingest_admission.snapshot(reset_peak=reset_peak),
+        "retrying": len(_ingest_retrying),
+        "line": line_sender.snapshot(),
+        "hourly": hourly_notifier.snapshot(),
+        "alerts": alert_engine.snapshot(),
+        "liveness": liveness.snapshot(),
+        "recalibrate": recalibrator.snapshot(),
+        "warm_state": warm_state.snapshot(),
+        "status_page": status_page_cache.snapshot(),
+        "gas_cache": gas_cache.snapshot(),
+        "history_store": history_store.snapshot(),
+        "storage": storage.snapshot(),
+        "ring": reading_rings.snapshot() if reading_rings is not None else None,
+        "shared": shared_state.snapshot() if shared_state is not None else None,
+        "cpu_pool": cpu_pool.snapshot(),
+    }
+
+
 # =========================================================
 @app.get("/config")
 def config_api(id: str = Query(..., description="device_id / serial ของเครื่องวัด")):
@@ -0,0 +1,252 @@
+"""
+แจ้งเตือน LINE รายชั่วโมง
+
+เดิม POST /history เช็คเองทีละ request ว่านาที = 00 ไหม แล้ว push LINE ตรงนั้นเลย
+⇒ ถ้าเครื่องไม่ได้ส่งค่าตอน 00 พอดี ก็ไม่มีแจ้งเตือน และ device ต้องรอ LINE ด้วย
+
+ตอนนี้:
+- HourlyNotifier ตื่นทุกต้นชั่วโมง (เวลาไทย) เอาค่าล่าสุดของแต่ละ device จาก state ในเครื่อง
+  ประกอบข้อความทั้งหมดทีเดียว
+- LinePushSender ค่อย ๆ ส่งออกตาม rate ที่กำหนด (token bucket)
+"""
+import asyncio
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from admission import TokenBucket
+
+logger = logging.getLogger("uvicorn.error")
+
+TH_TZ = timezone(timedelta(hours=7))
+
+# ---------- mapping ธงสี / น้ำ / พัก ----------
+FLAG_MAP = {
+    "white": {
+        "water": "อย่างน้อย 0.5 ลิตร",
+        "rest": "50/10 นาที"
+    },
+    "green": {
+        "water": "อย่างน้อย 0.5 ลิตร",
+        "rest": "50/10 นาที"
+    },
+    "yellow": {
+        "water": "อย่างน้อย 1 ลิตร",
+        "rest": "45/15 นาที"
+    },
+    "red": {
+        "water": "อย่างน้อย 1 ลิตร",
+        "rest": "30/30 นาที"
+    },
+    "black": {
+        "water": "อย่างน้อย 1 ลิตร",
+        "rest": "20/40 นาที"
+    }
+}
+
+FLAG_TH = {
+    "white": "⚪⚪⚪",
+    "green": "🟢🟢🟢",
+    "yellow": "🟡🟡🟡",
+    "red": "🔴🔴🔴",
+    "black": "⚫⚫⚫"
+}
+
+
+def build_reading_message(unit_name: str, reading: dict) -> str:
+    """
+    ประกอบข้อความ LINE จากค่าล่าสุด 1 ชุด (temp / humid / hic / flag)
+    """
+    flag = reading.get("flag") or ""
+    # ปรับให้กันกรณีส่งตัวใหญ่ / แปลก ๆ มา
+    flag_key = flag.lower()
+    flag_info = FLAG_MAP.get(flag_key, {})
+    water_txt = flag_info.get("water", "-")
+    rest_txt = flag_info.get("rest", "-")
+    flag_txt = FLAG_TH.get(flag_key, flag)
+
+    msg_lines = [
+        f"หน่วย: {unit_name}",
+        f"🌡อุณหภูมิ: {float(reading.get('temp', 0.0)):.1f} °C",
+        f"💧ความชื้น: {float(reading.get('humid', 0.0)):.1f} %RH",
+        f"-สัญญาณธงสี: {flag_txt}",
+        f"-รู้สึกเหมือน: {float(reading.get('hic', 0.0)):.1f} °C",
+        f"-ฝึก/พัก: {rest_txt}",
+        f"-ดื่มน้ำ: {water_txt}",
+    ]
+    return "\n".join(msg_lines)
+
+
+class LinePushSender:
+    """
+    คิวส่ง LINE push แบบจำกัด rate + รวมข้อความ (batch)
+
+    - enqueue(line_id, text) ใส่คิว ไม่ block
+    - worker รอ batch_window_sec เก็บข้อความที่เข้ามาพร้อม ๆ กัน แล้วรวมข้อความของห้องเดียวกัน
+      ส่งทีเดียวสูงสุด MAX_MESSAGES_PER_PUSH ข้อความต่อ 1 call (ข้อจำกัดของ LINE push API)
+    - push_fn(line_id, [text, ...], retry_key) รันใน thread เพราะ SDK เป็น sync
+      retry_key (X-Line-Retry-Key) เดียวกันทุก attempt ของ batch ⇒ timeout แล้วส่งซ้ำ LINE ไม่ส่งข้อความซ้ำ
+    """
+
+    MAX_MESSAGES_PER_PUSH = 5
+
+    def __init__(self, push_fn: Callable[[str, List[str], str], None], rate: float = 10.0, burst: float = 10.0,
+                 max_attempts: int = 3, batch_window_sec: float = 0.5, max_batch: int = 500):
+        self.push_fn = push_fn
+        self.bucket = TokenBucket(rate, burst)
+        self.max_attempts = max_attempts
+        self.batch_window_sec = batch_window_sec
+        self.max_batch = max_batch
+        self.queue: Optional[asyncio.Queue] = None
+        self.stats: Dict[str, int] = {"enqueued": 0, "sent": 0, "push_calls": 0, "failed": 0}
+        self._task: Optional[asyncio.Task] = None
+
+    def _q(self) -> asyncio.Queue:
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        return self.queue
+
+    def enqueue(self, line_id: str, text: str):
+        self._q().put_nowait((line_id, text))
+        self.stats["enqueued"] += 1
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        q = self._q()
+        while True:
+            items = [await q.get()]
+            if self.batch_window_sec > 0:
+                await asyncio.sleep(self.batch_window_sec)
+            while len(items) < self.max_batch and not q.empty():
+                items.append(q.get_nowait())
+
+            # รวมตามห้อง (คงลำดับเดิม)
+            grouped: Dict[str, List[str]] = {}
+            for line_id, text in items:
+                grouped.setdefault(line_id, []).append(text)
+            try:
+                for line_id, texts in grouped.items():
+                    for i in range(0, len(texts), self.MAX_MESSAGES_PER_PUSH):
+                        await self._send(line_id, texts[i:i + self.MAX_MESSAGES_PER_PUSH])
+            finally:
+                for _ in items:
+                    q.task_done()
+
+    async def _send(self, line_id: str, texts: List[str]):
+        retry_key = str(uuid.uuid4())
+        for attempt in range(self.max_attempts):
+            wait = self.bucket.reserve()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                await asyncio.to_thread(self.push_fn, line_id, texts, retry_key)
+                self.stats["sent"] += len(texts)
+                self.stats["push_calls"] += 1
+                return
+            except Exception:
+                logger.exception(f"LINE push failed ({line_id}), attempt {attempt + 1}/{self.max_attempts}")
+                await asyncio.sleep(2 ** attempt)
+        self.stats["failed"] += len(texts)
+
+    def snapshot(self) -> dict:
+        snap = dict(self.stats)
+        snap["pending"] = self.queue.qsize() if self.queue is not None else 0
+        return snap
+
+
+class HourlyNotifier:
+    """
+    ต้นชั่วโมง (เวลาไทย) ⇒ ส่งค่าล่าสุดของทุก device ไปทุกห้องที่ subscribe
+
+    - get_latest()       คืน {device_id: reading} (reading มี received_at = epoch วินาที)
+    - resolve(device_id) คืน (unit_name, [line_id, ...]) (sync, เรียกใน thread)
+    - ใช้เฉพาะค่าที่เข้ามาภายใน max_age_sec (default 1 ชั่วโมง) ค่าเก่ากว่านั้นไม่ส่ง
+    """
+
+    def __init__(
+        self,
+        get_latest: Callable[[], Dict[str, dict]],
+        resolve: Callable[[str], Tuple[str, List[str]]],
+        sender: LinePushSender,
+        max_age_sec: float = 3600.0,
+        resolve_concurrency: int = 4,
+    ):
+        self.get_latest = get_latest
+        self.resolve = resolve
+        self.sender = sender
+        self.max_age_sec = max_age_sec
+        self.resolve_concurrency = resolve_concurrency
+        self.last_run: Optional[str] = None
+        self.last_count = 0
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def seconds_until_next_hour(now: Optional[datetime] = None) -> float:
+        now = now or datetime.now(TH_TZ)
+        nxt = (now + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
+        return max(0.0, (nxt - now).total_seconds())
+
+    async def run_once(self) -> int:
+        """
+        ประกอบข้อความของทุก device แล้วใส่คิว sender คืนจำนวนข้อความ
+        """
+        now = time.time()
+        latest = {
+            did: r for did, r in self.get_latest().items()
+            if now - float(r.get("received_at", 0)) <= self.max_age_sec
+        }
+        sem = asyncio.Semaphore(self.resolve_concurrency)
+
+        async def build(did: str, reading: dict):
+            async with sem:
+                try:
+                    unit_name, line_ids = await asyncio.to_thread(self.resolve, did)
+                except Exception:
+                    logger.exception(f"hourly notify: resolve({did}) failed")
+                    return []
+            text = build_reading_message(unit_name, reading)
+            return [(lid, text) for lid in line_ids]
+
+        batches = await asyncio.gather(*(build(did, r) for did, r in latest.items()))
+        count = 0
+        for batch in batches:
+            for lid, text in batch:
+                self.sender.enqueue(lid, text)
+                count += 1
+
+        self.last_run = datetime.now(TH_TZ).isoformat()
+        self.last_count = count
+        logger.info(f"hourly notify: {len(latest)} devices → {count} messages")
+        return count
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.seconds_until_next_hour())
+            try:
+                await self.run_once()
+            except Exception:
+                logger.exception("hourly notify failed")
+            # กันตื่นซ้ำในชั่วโมงเดียวกัน (sleep คลาดเคลื่อนเล็กน้อย)
+            await asyncio.sleep(1)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def snapshot(self) -> dict:
+        return {"last_run": self.last_run, "last_count": self.last_count}
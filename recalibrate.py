@@ -0,0 +1,383 @@
+"""
+ปรับ calibration ย้อนหลังให้ history ของ device (background job)
+
+firmware บวก adj_temp / adj_humid ก่อนส่งค่า ⇒ แก้ config ใน /register แล้ว ค่าเก่าใน Sheet ยังเพี้ยนอยู่
+job นี้:
+- ดึง history ของ device ในช่วงเวลา [start, end) ทีละหน้า (เก่า → ใหม่, หน้าละ chunk_size แถว)
+  ⇒ memory ใช้แค่ 1 หน้า ไม่ว่า history จะยาวแค่ไหน
+- แต่ละหน้า: temp += delta_temp, humid += delta_humid แล้วคำนวณ hic / flag ใหม่
+  (heat_index.recompute_arrays) ⇒ เขียนกลับ (updateHistory)
+  แถวที่ไม่มีค่า temp / humid (ว่าง / อ่านไม่ได้) ไม่แตะ
+- checkpoint = (cursor, cursor_skip): epoch ของแถวสุดท้ายที่ทำแล้ว + จำนวนแถวที่ epoch นั้นที่ทำไปแล้ว
+  (หลายแถว timestamp เดียวกันคร่อมหน้าได้) หน้าถัดไปขอจาก cursor (รวม) ข้าม cursor_skip แถว
+- หยุดพักระหว่าง chunk + ทำงานใน thread (คำนวณใน process ของ cpu_pool ถ้าส่ง run_cpu มา) ⇒ ingest ไม่สะดุด
+- checkpoint ลงไฟล์ JSON ทุก chunk ⇒ restart แล้วทำต่อจากจุดเดิมได้
+
+กันบวก delta ซ้ำ: ก่อนเขียน chunk จะบันทึกค่าใหม่ (ค่าสัมบูรณ์) ลง checkpoint ก่อน (write-ahead)
+ถ้าดับกลางทาง ตอน resume จะส่งค่าชุดเดิมซ้ำ (idempotent) แทนการคำนวณจากค่าใน Sheet อีกรอบ
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional
+
+from cpu_pool import PoolBusy
+from heat_index import FLAG_NONE, flag_names_array, recompute_arrays
+
+logger = logging.getLogger("uvicorn.error")
+
+JOB_STATES = ("pending", "running", "done", "failed")
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _reading(v) -> Optional[float]:
+    """
+    ค่าใน history → float (ว่าง / None / NaN / อ่านไม่ได้ ⇒ None)
+    """
+    if v is None or v == "":
+        return None
+    try:
+        f = float(v)
+    except (TypeError, ValueError):
+        return None
+    return f if f == f else None
+
+
+def recompute_rows(chunk: List[dict], delta_temp: float, delta_humid: float) -> List[dict]:
+    """
+    แถวชุดหนึ่ง + delta ⇒ ค่าใหม่ (temp / humid / hic / flag) ต่อแถว key ด้วย timestamp เดิม
+    แถวที่ไม่มี temp / humid ไม่อยู่ในผล (ไม่แตะ ไม่เขียน 0 + delta กลับไป)
+    ระดับ module ⇒ ส่งไปทำใน process ของ cpu_pool ได้
+    """
+    chunk = [r for r in chunk if _reading(r.get("temp")) is not None and _reading(r.get("humid")) is not None]
+    if not chunk:
+        return []
+    temp = [_reading(r.get("temp")) for r in chunk]
+    humid = [_reading(r.get("humid")) for r in chunk]
+    t2, h2, hic, codes = recompute_arrays(temp, humid, delta_temp, delta_humid)
+    flags = flag_names_array(codes)
+    out = []
+    for i, r in enumerate(chunk):
+        flag = str(flags[i])
+        out.append({
+            "timestamp": r.get("timestamp"),
+            "temp": round(float(t2[i]), 2),
+            "humid": round(float(h2[i]), 2),
+            "hic": round(float(hic[i]), 2),
+            # sensor error เดิมเก็บ flag อะไรไว้ก็คงไว้
+            "flag": r.get("flag") if flag == FLAG_NONE else flag,
+        })
+    return out
+
+
+class RecalJob:
+    """
+    สถานะของ job 1 งาน (เก็บลงไฟล์ <job_id>.json)
+    """
+
+    def __init__(self, job_id: str, device_id: str, delta_temp: float, delta_humid: float,
+                 start: Optional[float], end: Optional[float], line_id: Optional[str] = None):
+        self.job_id = job_id
+        self.device_id = device_id
+        self.line_id = line_id         # ห้องที่ใช้ query history (None ⇒ fetch_page หาเอง)
+        self.delta_temp = float(delta_temp)
+        self.delta_humid = float(delta_humid)
+        self.start = start
+        self.end = end
+        self.state = "pending"
+        self.total = 0
+        self.processed = 0
+        self.updated = 0
+        self.cursor: Optional[float] = None       # epoch ของแถวสุดท้ายที่เขียนเสร็จแล้ว
+        self.cursor_skip = 0                      # จำนวนแถวที่ epoch = cursor ที่ทำไปแล้ว
+        self.pending_chunk: Optional[dict] = None  # write-ahead: {"cursor", "skip", "count", "rows": [...]}
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.error: Optional[str] = None
+        self.owner = os.getpid()   # process ที่รัน job นี้อยู่ (หลาย worker ใช้ checkpoint_dir เดียวกัน)
+
+    def to_dict(self) -> dict:
+        return dict(self.__dict__)
+
+    @classmethod
+    def from_dict(cls, d: dict) -> "RecalJob":
+        job = cls(d["job_id"], d["device_id"], d["delta_temp"], d["delta_humid"], d.get("start"), d.get("end"),
+                  d.get("line_id"))
+        for k, v in d.items():
+            setattr(job, k, v)
+        return job
+
+    def progress(self) -> dict:
+        snap = {k: v for k, v in self.to_dict().items() if k != "pending_chunk"}
+        snap["percent"] = round(100.0 * self.processed / self.total, 1) if self.total else 0.0
+        if self.state == "running" and self.started_at and self.processed:
+            rate = self.processed / max(1e-6, time.time() - self.started_at)
+            snap["rows_per_sec"] = round(rate, 1)
+            snap["eta_sec"] = round((self.total - self.processed) / rate, 1)
+        return snap
+
+
+class Recalibrator:
+    """
+    คิว job ปรับ calibration (ทำทีละ job ตามลำดับ)
+
+    - fetch_page(device_id, line_id, start, end, offset, limit) → {"success", "total", "data": [row, ...]} (sync)
+      แถวของ device ที่ start <= epoch < end (None = ไม่จำกัด) เรียงเก่า → ใหม่ ข้าม offset แถวแรก เอา limit แถว
+      total = จำนวนแถวในช่วงทั้งหมด (ก่อน offset / limit)
+    - update_rows(device_id, rows) เขียนค่าใหม่กลับ (sync) แต่ละ row มี timestamp เดิมเป็น key
+    - row_epoch(raw_timestamp) → epoch วินาที หรือ None
+    - on_rows_updated(device_id, rows) ให้ main ล้าง / สร้าง state ที่คิดจาก history ใหม่
+    - run_cpu(fn, *args) ทำงานคำนวณ (sync) เช่น CpuPool.call ไม่ใส่ = เรียก fn ตรง ๆ
+    """
+
+    def __init__(
+        self,
+        fetch_page: Callable[[str, Optional[str], Optional[float], Optional[float], int, int], dict],
+        update_rows: Callable[[str, List[dict]], dict],
+        row_epoch: Callable[[object], Optional[float]],
+        checkpoint_dir: str,
+        chunk_size: int = 500,
+        pause_sec: float = 0.5,
+        on_rows_updated: Optional[Callable[[str, List[dict]], None]] = None,
+        run_cpu: Optional[Callable[..., Any]] = None,
+    ):
+        self.fetch_page = fetch_page
+        self.update_rows = update_rows
+        self.row_epoch = row_epoch
+        self.checkpoint_dir = checkpoint_dir
+        self.chunk_size = max(1, int(chunk_size))
+        self.pause_sec = pause_sec
+        self.on_rows_updated = on_rows_updated
+        self.run_cpu = run_cpu if run_cpu is not None else (lambda fn, *args: fn(*args))
+        self.jobs: Dict[str, RecalJob] = {}
+        self.queue: Optional[asyncio.Queue] = None
+        self.queued: set = set()   # job ที่เข้าคิวของ process นี้แล้ว (resume ซ้ำไม่ใส่ซ้ำ)
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    # ---------- checkpoint ----------
+
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self.checkpoint_dir, f"{job_id}.json")
+
+    def _save(self, job: RecalJob):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        tmp = self._path(job.job_id) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(job.to_dict(), f, ensure_ascii=False)
+        os.replace(tmp, self._path(job.job_id))
+
+    def load(self) -> List[RecalJob]:
+        """
+        อ่าน checkpoint ทั้งหมด คืน job ที่ยังไม่เสร็จ (ไว้ resume)
+        """
+        unfinished = []
+        if not os.path.isdir(self.checkpoint_dir):
+            return unfinished
+        for name in sorted(os.listdir(self.checkpoint_dir)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.checkpoint_dir, name), encoding="utf-8") as f:
+                    job = RecalJob.from_dict(json.load(f))
+            except (OSError, ValueError, KeyError):
+                logger.exception(f"recalibrate: cannot read checkpoint {name}")
+                continue
+            if job.job_id in self.queued:
+                continue   # กำลังรันอยู่ใน process นี้ ⇒ ของใน memory ใหม่กว่าไฟล์
+            self.jobs[job.job_id] = job
+            if job.state in ("pending", "running"):
+                unfinished.append(job)
+        unfinished.sort(key=lambda j: j.created_at)
+        return unfinished
+
+    # ---------- queue ----------
+
+    def _q(self) -> asyncio.Queue:
+        if self.queue is None:
+            self.queue = asyncio.Queue()
+        return self.queue
+
+    def submit(self, device_id: str, delta_temp: float, delta_humid: float,
+               start: Optional[float] = None, end: Optional[float] = None,
+               line_id: Optional[str] = None) -> RecalJob:
+        job = RecalJob(uuid.uuid4().hex[:12], device_id, delta_temp, delta_humid, start, end, line_id)
+        self.jobs[job.job_id] = job
+        self._save(job)
+        self._enqueue(job.job_id)
+        return job
+
+    def start(self, resume: bool = True):
+        """
+        resume=False ⇒ ไม่หยิบ job ที่ค้างจาก checkpoint (หลาย worker ใช้ directory เดียวกัน ให้ leader ตัวเดียว resume)
+        """
+        if self._task is None:
+            self._loop = asyncio.get_running_loop()
+            if resume:
+                self.resume()
+            self._task = asyncio.create_task(self._run())
+
+    def resume(self):
+        for job in self.load():
+            if job.owner != os.getpid() and _alive(job.owner):
+                continue   # worker อื่นรันอยู่
+            job.owner = os.getpid()
+            logger.info(f"recalibrate: resuming job {job.job_id} ({job.device_id}) at {job.processed}/{job.total}")
+            self._enqueue(job.job_id)
+
+    def _enqueue(self, job_id: str):
+        """
+        submit() ถูกเรียกจาก thread ของ endpoint แบบ sync ได้ ⇒ ส่งเข้าคิวผ่าน loop ของ _run
+        """
+        self.queued.add(job_id)
+        try:
+            in_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            in_loop = False
+        if self._loop is None or in_loop:
+            self._q().put_nowait(job_id)
+        else:
+            self._loop.call_soon_threadsafe(self._q().put_nowait, job_id)
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        q = self._q()
+        while True:
+            job = self.jobs.get(await q.get())
+            try:
+                if job is not None and job.state in ("pending", "running"):
+                    await self._run_job(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.exception(f"recalibrate job {job.job_id} failed")
+                job.state = "failed"
+                job.error = str(e)
+                job.finished_at = time.time()
+                self._save(job)
+            finally:
+                q.task_done()
+
+    # ---------- ตัวงาน ----------
+
+    def _fetch(self, job: RecalJob) -> dict:
+        """
+        หน้าถัดไปหลัง checkpoint: จาก cursor (รวมแถวที่ epoch เท่ากัน) ข้าม cursor_skip แถวที่ทำไปแล้ว
+        """
+        start = job.start if job.cursor is None else job.cursor
+        skip = job.cursor_skip
+        page = self.fetch_page(job.device_id, job.line_id, start, job.end, skip, self.chunk_size)
+        if not (isinstance(page, dict) and page.get("success")):
+            raise RuntimeError(f"cannot fetch history of {job.device_id}: "
+                               f"{page.get('message') if isinstance(page, dict) else page}")
+        page["skip"] = skip
+        return page
+
+    def _advance(self, job: RecalJob, rows: List[dict], skip: int) -> tuple:
+        """
+        checkpoint หลังหน้านี้ (cursor, cursor_skip) จาก epoch ของแถว
+        แถวที่อ่าน timestamp ไม่ได้: ก่อนมี cursor ⇒ นับเป็นแถวที่ข้าม, หลังจากนั้น ⇒ ไม่ขยับ cursor
+        """
+        cursor, n = job.cursor, skip
+        for r in rows:
+            ts = self.row_epoch(r.get("timestamp"))
+            if ts is None and cursor is not None:
+                continue
+            if ts == cursor:
+                n += 1
+            else:
+                cursor, n = ts, 1
+        return cursor, n
+
+    async def _recompute_chunk(self, job: RecalJob, chunk: List[dict]) -> List[dict]:
+        # pool เต็ม (หน้าเว็บใช้อยู่) ⇒ job เบื้องหลังรอไปก่อน
+        while True:
+            try:
+                return await asyncio.to_thread(self.run_cpu, recompute_rows, chunk, job.delta_temp, job.delta_humid)
+            except PoolBusy as e:
+                await asyncio.sleep(e.retry_after)
+
+    def _write_pending(self, job: RecalJob):
+        pending = job.pending_chunk
+        if not pending:
+            return
+        res = self.update_rows(job.device_id, pending["rows"]) if pending["rows"] else {"updated": 0}
+        if isinstance(res, dict) and res.get("success") is False:
+            raise RuntimeError(f"updateHistory failed: {res.get('message')}")
+        job.cursor = pending["cursor"]
+        job.cursor_skip = pending.get("skip", 0)
+        job.processed += pending.get("count", len(pending["rows"]))
+        job.updated += int(res.get("updated", len(pending["rows"]))) if isinstance(res, dict) else len(pending["rows"])
+        job.pending_chunk = None
+        self._save(job)
+        if self.on_rows_updated is not None:
+            self.on_rows_updated(job.device_id, pending["rows"])
+
+    async def _run_job(self, job: RecalJob):
+        job.state = "running"
+        job.started_at = job.started_at or time.time()
+        self._save(job)
+
+        # ค้างจากรอบก่อน (ดับหลังบันทึก write-ahead) ⇒ ส่งค่าชุดเดิมให้จบก่อน
+        await asyncio.to_thread(self._write_pending, job)
+
+        first = True
+        while True:
+            page = await asyncio.to_thread(self._fetch, job)
+            rows = page.get("data") or []
+            if first:
+                job.total = job.processed + max(0, int(page.get("total", len(rows))) - page["skip"])
+                self._save(job)
+                first = False
+            if not rows:
+                break
+            new_rows = await self._recompute_chunk(job, rows)
+            cursor, skip = self._advance(job, rows, page["skip"])
+            job.pending_chunk = {"cursor": cursor, "skip": skip, "count": len(rows), "rows": new_rows}
+            self._save(job)
+            await asyncio.to_thread(self._write_pending, job)
+            if len(rows) < self.chunk_size:
+                break
+            if self.pause_sec > 0:
+                await asyncio.sleep(self.pause_sec)
+
+        job.state = "done"
+        job.finished_at = time.time()
+        self._save(job)
+        logger.info(f"recalibrate job {job.job_id} ({job.device_id}) done: {job.updated} rows")
+
+    def get(self, job_id: str) -> Optional[RecalJob]:
+        """
+        job ที่ worker อื่นรับไว้ ⇒ อ่านจาก checkpoint (ความคืบหน้า ณ chunk ล่าสุด)
+        """
+        job = self.jobs.get(job_id)
+        if job is not None and job_id in self.queued:
+            return job
+        try:
+            with open(self._path(job_id), encoding="utf-8") as f:
+                return RecalJob.from_dict(json.load(f))
+        except (OSError, ValueError, KeyError):
+            return job
+
+    def snapshot(self) -> dict:
+        by_state = {s: 0 for s in JOB_STATES}
+        for job in self.jobs.values():
+            by_state[job.state] = by_state.get(job.state, 0) + 1
+        return {"jobs": by_state, "queued": self.queue.qsize() if self.queue is not None else 0}
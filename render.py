@@ -0,0 +1,130 @@
+"""
+ส่วนที่กิน CPU ของหน้า /history, /compare และ export CSV (ส่งไปทำใน process ของ cpu_pool.py)
+
+ทุกฟังก์ชันรับ / คืนของที่ pickle ได้ (DeviceColumns, str, list) และไม่ import main
+(process ลูกของ pool import แค่ module นี้ ไม่ต้องโหลด FastAPI / LINE SDK / state ของ server)
+"""
+import json
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Sequence, Tuple
+
+from columnar import TH_OFFSET_SEC, DeviceColumns, bucket_join, pick_bucket_sec
+
+
+def warm() -> bool:
+    """
+    งานเปล่า ๆ ให้ pool spawn process + import module นี้ไว้ก่อน request แรก
+    """
+    DeviceColumns.empty("")
+    return True
+
+
+# ---------- /history ----------
+
+def history_chart_json(page_cols: DeviceColumns) -> str:
+    """
+    ข้อมูลกราฟของหน้า /history (เก่า → ใหม่)
+    """
+    chart_payload = {
+        "labels": page_cols.labels(),
+        "temp": page_cols.values("temp", nan=0.0),
+        "humid": page_cols.values("humid", nan=0.0),
+        "hic": page_cols.values("hic", nan=0.0),
+    }
+    return json.dumps(chart_payload, ensure_ascii=False)
+
+
+def history_rows_html(cols: DeviceColumns) -> str:
+    """
+    แถวตารางของช่วงนี้ ใหม่สุด → เก่าสุด (หน้า /history ส่งทีละช่วง)
+    """
+    labels = cols.labels()
+    temps = cols.values("temp", nan=0.0)
+    humids = cols.values("humid", nan=0.0)
+    hics = cols.values("hic", nan=0.0)
+    flags = cols.flags()
+    return "".join(
+        f"""
+        <tr>
+            <td>{labels[i]}</td>
+            <td>{temps[i]:.1f}</td>
+            <td>{humids[i]:.1f}</td>
+            <td>{hics[i]:.1f}</td>
+            <td>{flags[i]}</td>
+        </tr>
+        """
+        for i in range(len(labels) - 1, -1, -1)
+    )
+
+
+# ---------- /compare ----------
+
+def _th_label(t: float) -> str:
+    """
+    epoch จริงแบบ gas_ts_key → เวลาไทยแบบ format_ts_th
+    """
+    return (datetime(1970, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=t + TH_OFFSET_SEC)).strftime("%m/%d/%y-%H:%M")
+
+
+def _nan_to_none(values) -> list:
+    return [None if v != v else round(v, 2) for v in values]
+
+
+def _compare_range(cols: Sequence[DeviceColumns], days: float) -> Optional[Tuple[float, float]]:
+    """
+    [start, end) ของ days วันล่าสุด (นับจากแถวล่าสุดของทุก device) ไม่มีข้อมูล ⇒ None
+    """
+    latest = max((float(c.ts[-1]) for c in cols if len(c)), default=None)
+    if latest is None:
+        return None
+    end = latest + 1.0
+    return end - max(days, 0.01) * 86400, end
+
+
+def compare_window(cols: Sequence[DeviceColumns], days: float) -> List[DeviceColumns]:
+    """
+    ตัดแต่ละ device เหลือแค่ช่วงที่ compare_parts ใช้ (searchsorted บน ts ที่เรียงอยู่แล้ว เป็น view ไม่ copy)
+    เรียกใน process หลักก่อนส่งเข้า pool ⇒ pickle แค่ days วัน ไม่ใช่ history ทั้งหมด
+    """
+    rng = _compare_range(cols, days)
+    if rng is None:
+        return list(cols)
+    lo = rng[0]
+    return [c.slice(int(c.ts.searchsorted(lo, side="left")), len(c)) if len(c) else c for c in cols]
+
+
+def compare_parts(cols: Sequence[DeviceColumns], names: List[str], field: str, days: float,
+                  bucket_min: Optional[int], table_rows: int) -> Tuple[str, str, int]:
+    """
+    ทุก device เฉลี่ยลงช่องเวลาเดียวกันช่วง days วันล่าสุด → (chart_json, table_rows_html, bucket_sec)
+    bucket_min ไม่ใส่ = เลือกให้กราฟไม่เกิน ~400 จุด, ตาราง table_rows ช่องล่าสุด (ใหม่สุดก่อน)
+    """
+    rng = _compare_range(cols, days)
+    labels: List[str] = []
+    series: List[list] = []
+    bucket_sec = 0
+    if rng is not None:
+        start, end = rng
+        bucket_sec = bucket_min * 60 if bucket_min and bucket_min > 0 else pick_bucket_sec(end - start)
+        grid, matrix = bucket_join(cols, field, bucket_sec, start=start, end=end)
+        labels = [_th_label(t) for t in grid.tolist()]
+        series = [_nan_to_none(row) for row in matrix.tolist()]
+    chart_json = json.dumps({"labels": labels, "names": names, "series": series}, ensure_ascii=False)
+
+    rows = []
+    for i in range(len(labels) - 1, max(-1, len(labels) - 1 - table_rows), -1):
+        cells = "".join(
+            f"<td>{s[i]:.1f}</td>" if s[i] is not None else "<td>-</td>" for s in series
+        )
+        rows.append(f"<tr><td>{labels[i]}</td>{cells}</tr>")
+    table_rows_html = "".join(rows)
+    return chart_json, table_rows_html, bucket_sec
+
+
+# ---------- export CSV ----------
+
+def csv_chunk(cols: DeviceColumns) -> str:
+    """
+    ช่วงหนึ่งของ DeviceColumns เป็น CSV (ไม่มี header)
+    """
+    return "".join(cols.iter_csv())
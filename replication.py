@@ -0,0 +1,188 @@
+"""
+ส่งสิ่งที่เขียนลง SQLite ต่อไป Google Sheet (GAS) เบื้องหลัง (HT_STORAGE=tiered)
+
+- ทุกการเขียน (writeConfig / addSubscription / removeSubscription / appendHistory / updateHistory)
+  ลง SQLite พร้อมแถวใน outbox ใน transaction เดียวกัน (ดู SqliteStorage) ⇒ ตอบ ingest ได้ทันที ไม่รอ GAS
+- thread นี้อ่าน outbox (main + ไฟล์เดือนที่มีแถวค้าง) เก่าสุดก่อนทีละ batch แล้วยิง action เดิมของ GAS ทีละแถว
+- ส่งสำเร็จ ⇒ ลบแถวออกจาก outbox + จำ seq ล่าสุด (checkpoint) ⇒ restart แล้วส่งต่อจากจุดเดิม
+- ต่อ GAS ไม่ได้ / timeout ⇒ พักแบบ exponential backoff แล้วลองแถวเดิมใหม่ไม่จำกัดรอบ (ไม่ข้าม ⇒ ลำดับไม่เพี้ยน)
+- GAS ตอบ success=false / HTTP error / ตอบไม่ใช่ JSON (หน้า error HTML) ซ้ำเกิน max_attempts
+  ⇒ ย้ายไป outbox_dead (ไม่ทิ้ง) แล้วไปแถวถัดไป
+- appendHistory มี key (storage.append_key) ⇒ ส่งซ้ำหลัง timeout (GAS เขียนไปแล้วแต่ตอบไม่ทัน) ไม่ได้แถวซ้ำ
+
+memory ใช้แค่ 1 batch (outbox อยู่บน disk) ไม่ว่า GAS จะล่มนานแค่ไหน
+lag_sec = อายุของแถวที่ค้างนานสุด (ดูใน /metrics → storage → mirror)
+"""
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+import requests
+
+logger = logging.getLogger("uvicorn.error")
+
+
+class Replicator:
+    """
+    - outbox: SqliteStorage ที่เปิด outbox (outbox_batch / outbox_ack / outbox_retry / outbox_bury / outbox_stats)
+    - send(payload) → dict แบบ GAS (sync) เช่น GasStorage.post
+    """
+
+    def __init__(
+        self,
+        outbox,
+        send: Callable[[dict], dict],
+        batch: int = 50,
+        backoff_base_sec: float = 1.0,
+        backoff_max_sec: float = 300.0,
+        max_attempts: int = 8,
+        poll_sec: float = 5.0,
+    ):
+        self.outbox = outbox
+        self.send = send
+        self.batch = max(1, batch)
+        self.backoff_base_sec = backoff_base_sec
+        self.backoff_max_sec = backoff_max_sec
+        self.max_attempts = max_attempts
+        self.poll_sec = poll_sec
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+        self.sending = threading.Lock()   # ถือระหว่างส่ง + ack 1 แถว (paused())
+        self.backoff_sec = 0.0
+        self.stats = {
+            "sent": 0,
+            "batches": 0,
+            "transport_errors": 0,
+            "rejected": 0,
+            "dead": 0,
+            "last_error": None,
+            "last_sent_at": None,
+        }
+
+    def _count(self, key: str, n: int = 1):
+        with self.lock:
+            self.stats[key] += n
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.stopping.clear()
+                self.thread = threading.Thread(target=self._run, name="storage-mirror", daemon=True)
+                self.thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        """
+        หยุดหลังส่งแถวที่กำลังส่งอยู่เสร็จ (ที่เหลืออยู่ใน outbox ส่งต่อรอบ start หน้า)
+        """
+        self.stopping.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join(timeout=timeout)
+            self.thread = None
+
+    def wake(self):
+        """
+        มีแถวใหม่ใน outbox (ไม่ตัด backoff ที่กำลังพักอยู่)
+        """
+        if self.backoff_sec == 0.0:
+            self.wakeup.set()
+
+    @contextmanager
+    def paused(self):
+        """
+        ไม่ส่งอะไรไป GAS ระหว่างนี้ (รอแถวที่กำลังส่งอยู่ให้จบก่อน) ใช้ตอน bootstrap อ่าน GAS แล้วเขียน local
+        """
+        with self.sending:
+            yield
+
+    def _sleep(self, sec: float):
+        self.wakeup.wait(sec)
+        self.wakeup.clear()
+
+    def _run(self):
+        while not self.stopping.is_set():
+            try:
+                sent_any = self.run_once()
+            except Exception:
+                logger.exception("mirror: cannot read outbox")
+                sent_any = False
+            if self.stopping.is_set():
+                return
+            if self.backoff_sec:
+                self._sleep_backoff()
+            elif not sent_any:
+                self._sleep(self.poll_sec)
+
+    def _sleep_backoff(self):
+        # wake() ไม่ปลุกตอน backoff ⇒ ตื่นเฉพาะตอนครบเวลา / stop
+        deadline = time.monotonic() + self.backoff_sec
+        while not self.stopping.is_set():
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return
+            self.stopping.wait(left)
+
+    def _fail(self, error: str):
+        self.backoff_sec = min(self.backoff_max_sec, max(self.backoff_base_sec, self.backoff_sec * 2))
+        with self.lock:
+            self.stats["last_error"] = error
+
+    def run_once(self) -> bool:
+        """
+        ส่ง 1 batch ตามลำดับ หยุดที่แถวแรกที่ส่งไม่ผ่าน คืน True ถ้าส่งได้อย่างน้อย 1 แถว
+        """
+        entries = self.outbox.outbox_batch(self.batch)
+        if not entries:
+            return False
+        self._count("batches")
+        sent = 0
+        for e in entries:
+            if self.stopping.is_set():
+                break
+            with self.sending:
+                try:
+                    result = self.send(e["payload"])
+                except (requests.ConnectionError, requests.Timeout) as exc:
+                    # ต่อไม่ได้ / timeout ⇒ ไม่นับ attempts (GAS ล่มนานแค่ไหนก็ไม่ทิ้ง)
+                    self._count("transport_errors")
+                    self._fail(f"{type(exc).__name__}: {exc}")
+                    logger.warning(f"mirror seq={e['seq']} {e['payload'].get('action')} failed: {exc} "
+                                   f"(retry in {self.backoff_sec:.1f}s)")
+                    break
+                except Exception as exc:
+                    # HTTP 4xx/5xx / ตอบไม่ใช่ JSON ⇒ นับ attempts แบบ success=false
+                    result = {"success": False, "message": f"{type(exc).__name__}: {exc}"}
+                if isinstance(result, dict) and result.get("success"):
+                    self.outbox.outbox_ack(e["seq"])
+                    sent += 1
+                    self.backoff_sec = 0.0
+                    continue
+                error = str(result.get("message") or result.get("error") or result) if isinstance(result, dict) else str(result)
+                self._count("rejected")
+                attempts = self.outbox.outbox_retry(e["seq"], error)
+                if attempts >= self.max_attempts:
+                    self.outbox.outbox_bury(e["seq"])
+                    self._count("dead")
+                    logger.error(f"mirror seq={e['seq']} {e['payload'].get('action')} rejected {attempts} times → outbox_dead: {error}")
+                    continue
+                self._fail(error)
+                break
+        if sent:
+            with self.lock:
+                self.stats["sent"] += sent
+                self.stats["last_sent_at"] = time.time()
+        return sent > 0
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            snap = dict(self.stats)
+        snap.update(self.outbox.outbox_stats())
+        oldest = snap.pop("oldest_created", None)
+        snap["lag_sec"] = round(time.time() - oldest, 1) if oldest else 0.0
+        snap["backoff_sec"] = self.backoff_sec
+        snap["running"] = self.thread is not None and self.thread.is_alive()
+        return snap
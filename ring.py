@@ -0,0 +1,313 @@
+"""
+ค่าล่าสุด N แถวของแต่ละ device ในไฟล์ ring buffer (memory-mapped, record ขนาดคงที่)
+
+หน้าเว็บส่วนใหญ่ดูแค่ 1-2 วันล่าสุด ⇒ ไม่ต้องดึง / decode history ทั้งหมดทุกครั้ง
+- post_history ⇒ append 1 record (O(1) เขียนทับช่องที่เก่าสุดเมื่อเต็ม)
+- /history หน้าแรก ๆ / ค่าล่าสุดของ /status ⇒ อ่านจาก mmap ตรง ๆ (view ของ NumPy ไม่ decode JSON)
+- ไฟล์เดียวกันเปิดได้หลาย process (uvicorn --workers) ผ่าน MAP_SHARED ไม่ต้องมี IPC
+  เขียน: flock ของไฟล์ (+ lock ใน process) / อ่าน: seqlock (seq คี่ = กำลังเขียน, เปลี่ยนระหว่างอ่าน ⇒ อ่านใหม่)
+  อ่านใหม่ครบ SPIN_TRIES รอบแล้วยังไม่ได้ (writer ช้า / ตายกลางทาง) ⇒ อ่านภายใต้ flock แทน
+
+header: magic | capacity | count (จำนวนที่ append ทั้งหมด) | seq | base
+- base = จำนวนแถวที่เก่ากว่าแถวแรกที่ ring เคยเก็บ (-1 = ไม่รู้ ⇒ ยังใช้ทำหน้า /history ไม่ได้)
+  รู้ตอน seed จาก history ทั้งหมดของ device (fetch_history_by_line_id)
+  total ของ device = base + count
+record: ts (epoch จริงแบบ gas_ts_key) | temp | humid | hic | flag (8 byte) | naive
+- naive = timestamp เดิมไม่มี Z (เวลาไทย) ไว้แปลงกลับเป็น timestamp แบบเดิม (gas_ts_format)
+"""
+import fcntl
+import hashlib
+import mmap
+import os
+import re
+import struct
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional, Tuple
+
+from columnar import DeviceColumns, _np
+from snapshot import gas_ts_format
+
+MAGIC = b"HTRING02"
+_HEADER = struct.Struct("<8sQqqq")       # magic, capacity, count, seq, base
+HEADER_SIZE = 64
+FLAG_BYTES = 8
+RECORD_SIZE = 8 * 4 + FLAG_BYTES + 1
+SPIN_TRIES = 1000
+_SAFE_ID = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+
+def record_dtype():
+    np = _np()
+    return np.dtype([("ts", "<f8"), ("temp", "<f8"), ("humid", "<f8"), ("hic", "<f8"), ("flag", f"S{FLAG_BYTES}"), ("naive", "u1")])
+
+
+class DeviceRing:
+    def __init__(self, path: str, capacity: int, device_id: str = ""):
+        self.path = path
+        self.device_id = device_id
+        self.lock = threading.Lock()
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        self.fd = fd
+        size = HEADER_SIZE + capacity * RECORD_SIZE
+        with self._locked():
+            head = os.pread(fd, _HEADER.size, 0)
+            valid = len(head) == _HEADER.size and head[:8] == MAGIC and _HEADER.unpack(head)[1] == capacity
+            if not valid:
+                # ไฟล์ใหม่ / ขนาดเปลี่ยน ⇒ เริ่มใหม่ (base ไม่รู้)
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+                os.pwrite(fd, _HEADER.pack(MAGIC, capacity, 0, 0, -1), 0)
+        self.mm = mmap.mmap(fd, size, mmap.MAP_SHARED, mmap.PROT_READ | mmap.PROT_WRITE)
+        self.capacity = capacity
+        self.records = _np().frombuffer(self.mm, dtype=record_dtype(), count=capacity, offset=HEADER_SIZE)
+
+    # ---------- header ----------
+
+    @contextmanager
+    def _locked(self):
+        # thread ใน process เดียวกันใช้ fd เดียวกัน ⇒ flock กันได้แค่ข้าม process ต้องมี lock ของ process ด้วย
+        with self.lock:
+            fcntl.flock(self.fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+    def _header(self) -> Tuple[int, int, int]:
+        _, _, count, seq, base = _HEADER.unpack_from(self.mm, 0)
+        return count, seq, base
+
+    def _set(self, count: int, seq: int, base: int):
+        _HEADER.pack_into(self.mm, 0, MAGIC, self.capacity, count, seq, base)
+
+    def _snapshot_read(self, fn):
+        """
+        อ่านแบบ seqlock: fn(count, base) ต้อง copy ข้อมูลที่ต้องการออกมาเอง
+        """
+        for _ in range(SPIN_TRIES):
+            count, seq, base = self._header()
+            if seq & 1:
+                os.sched_yield()
+                continue
+            out = fn(count, base)
+            if self._header()[1] == seq:
+                return out
+        with self._locked():
+            count, seq, base = self._header()
+            if seq & 1:
+                # writer ตายระหว่างเขียน (flock หลุดตาม process) ⇒ แถวอาจไม่ครบ ให้ seed ใหม่
+                base = -1
+                self._set(count, seq + 1, base)
+            return fn(count, base)
+
+    # ---------- write ----------
+
+    def append(self, ts: float, temp: float, humid: float, hic: float, flag: str, naive: bool = False) -> bool:
+        """
+        ts (แบบ gas_ts_key) ต้องใหม่กว่าแถวล่าสุด (เท่ากัน = ส่งซ้ำ ⇒ ข้าม, เก่ากว่า ⇒ ลำดับเสีย ต้อง seed ใหม่)
+        """
+        with self._locked():
+            count, seq, base = self._header()
+            if count:
+                last = float(self.records["ts"][(count - 1) % self.capacity])
+                if ts == last:
+                    return False
+                if ts < last:
+                    base = -1
+            self._set(count, seq + 1, base)
+            self.records[count % self.capacity] = (ts, temp, humid, hic, str(flag or "").encode()[:FLAG_BYTES], naive)
+            self._set(count + 1, seq + 2, base)
+        return True
+
+    def seed(self, cols: DeviceColumns) -> bool:
+        """
+        ใส่ history ทั้งหมดของ device (เก่า → ใหม่) แทนของเดิม ⇒ รู้ base
+        แถวใน ring ที่ใหม่กว่าแถวสุดท้ายของ cols (append เข้ามาระหว่างดึง) เก็บไว้ต่อท้าย
+        """
+        np = _np()
+        with self._locked():
+            count, seq, base = self._header()
+            rows = np.empty(len(cols), dtype=record_dtype())
+            rows["ts"] = cols.ts
+            rows["naive"] = cols.naive
+            newest = float(cols.ts[-1]) if len(cols) else float("-inf")
+            keep = self._rows(count, min(count, self.capacity))
+            keep = keep[keep["ts"] > newest]
+            rows["temp"] = cols.temp
+            rows["humid"] = cols.humid
+            rows["hic"] = cols.hic
+            names = np.asarray([n.encode()[:FLAG_BYTES] for n in cols.flag_names] or [b""], dtype=f"S{FLAG_BYTES}")
+            rows["flag"] = names[cols.flag] if len(cols) else b""
+            rows = np.concatenate([rows, keep])
+            stored = rows[-self.capacity:]
+            self._set(count, seq + 1, base)
+            self.records[:len(stored)] = stored
+            self._set(len(stored), seq + 2, len(rows) - len(stored))
+        return True
+
+    def invalidate(self):
+        with self._locked():
+            count, seq, _ = self._header()
+            self._set(count, seq + 2, -1)
+
+    # ---------- read ----------
+
+    def _rows(self, count: int, n: int):
+        """
+        n แถวล่าสุด (เก่า → ใหม่) เป็น copy (ring วนรอบ ⇒ ต่อ 2 ช่วง)
+        """
+        np = _np()
+        n = min(n, count, self.capacity)
+        if n <= 0:
+            return self.records[:0].copy()
+        end = count % self.capacity or self.capacity
+        start = end - n
+        if start >= 0:
+            return self.records[start:end].copy()
+        return np.concatenate([self.records[start:], self.records[:end]])
+
+    def state(self) -> Tuple[int, int]:
+        """
+        (count, base)
+        """
+        return self._snapshot_read(lambda count, base: (count, base))
+
+    def latest(self) -> Optional[dict]:
+        rows = self._snapshot_read(lambda count, base: self._rows(count, 1))
+        if not len(rows):
+            return None
+        r = rows[0]
+        return {
+            "ts": float(r["ts"]),
+            "timestamp": gas_ts_format(float(r["ts"]), bool(r["naive"])),
+            "temp": float(r["temp"]),
+            "humid": float(r["humid"]),
+            "hic": float(r["hic"]),
+            "flag": r["flag"].decode(errors="replace"),
+        }
+
+    def page_desc(self, page: int, per_page: int) -> Optional[Tuple[DeviceColumns, int, int]]:
+        """
+        หน้าที่ page แบบ DeviceColumns.page_desc + total + page (ปรับให้ไม่เกินหน้าสุดท้าย)
+        None = ring ไม่รู้ base หรือหน้านี้เก่ากว่าที่ ring มี
+        """
+        def read(count, base):
+            if base < 0:
+                return None
+            total = base + count
+            last_page = max(1, (total + per_page - 1) // per_page)
+            p = max(1, min(page, last_page))
+            hi = max(0, total - (p - 1) * per_page)
+            lo = max(0, hi - per_page)
+            oldest = total - min(count, self.capacity)
+            if lo < oldest and total:
+                return None
+            rows = self._rows(count, total - lo)
+            return rows[:hi - lo], total, p
+
+        got = self._snapshot_read(read)
+        if got is None:
+            return None
+        rows, total, p = got
+        return _columns(self.device_id, rows), total, p
+
+    def close(self):
+        self.records = None
+        self.mm.close()
+        os.close(self.fd)
+
+
+def _columns(device_id: str, rows) -> DeviceColumns:
+    np = _np()
+    names, codes = np.unique(rows["flag"], return_inverse=True)
+    return DeviceColumns(
+        device_id,
+        rows["ts"].astype(np.int64),
+        rows["naive"].astype(bool),
+        rows["temp"].astype(np.float64),
+        rows["humid"].astype(np.float64),
+        rows["hic"].astype(np.float64),
+        codes.astype(np.uint8 if len(names) <= 256 else np.uint16).reshape(-1),
+        tuple(n.decode(errors="replace") for n in names.tolist()),
+    )
+
+
+class RingSet:
+    """
+    ring ของทุก device ใน directory เดียว (เปิดไฟล์ตอนใช้ครั้งแรก)
+    """
+
+    def __init__(self, directory: str, capacity: int):
+        self.dir = directory
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.rings: Dict[str, DeviceRing] = {}
+        self.stats = {"appends": 0, "seeds": 0, "page_hits": 0, "page_misses": 0, "out_of_order": 0}
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, device_id: str) -> str:
+        name = device_id if _SAFE_ID.match(device_id) else hashlib.sha1(device_id.encode()).hexdigest()
+        return os.path.join(self.dir, f"{name}.ring")
+
+    def get(self, device_id: str, create: bool = True) -> Optional[DeviceRing]:
+        """
+        create=False ⇒ device ที่ยังไม่มีไฟล์ (ไม่เคยส่งค่า / seed) คืน None
+        """
+        ring = self.rings.get(device_id)
+        if ring is None:
+            if not create and not os.path.exists(self._path(device_id)):
+                return None
+            with self.lock:
+                ring = self.rings.get(device_id)
+                if ring is None:
+                    ring = DeviceRing(self._path(device_id), self.capacity, device_id)
+                    self.rings[device_id] = ring
+        return ring
+
+    def _count(self, key: str):
+        with self.lock:
+            self.stats[key] += 1
+
+    def append(self, device_id: str, ts: float, temp: float, humid: float, hic: float, flag: str,
+               naive: bool = False):
+        ring = self.get(device_id)
+        had_base = ring.state()[1] >= 0
+        if ring.append(ts, temp, humid, hic, flag, naive):
+            self._count("appends")
+            if had_base and ring.state()[1] < 0:
+                self._count("out_of_order")
+
+    def seed_if_unknown(self, device_id: str, cols: DeviceColumns):
+        ring = self.get(device_id)
+        if ring.state()[1] < 0:
+            ring.seed(cols)
+            self._count("seeds")
+
+    def invalidate(self, device_id: str):
+        ring = self.get(device_id, create=False)
+        if ring is not None:
+            ring.invalidate()
+
+    def latest(self, device_id: str) -> Optional[dict]:
+        ring = self.get(device_id, create=False)
+        return ring.latest() if ring is not None else None
+
+    def page_desc(self, device_id: str, page: int, per_page: int) -> Optional[Tuple[DeviceColumns, int, int]]:
+        ring = self.get(device_id, create=False)
+        got = ring.page_desc(page, per_page) if ring is not None else None
+        self._count("page_hits" if got is not None else "page_misses")
+        return got
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            snap = dict(self.stats)
+            snap["open"] = len(self.rings)
+        snap.update(dir=self.dir, capacity=self.capacity)
+        return snap
+
+    def close(self):
+        with self.lock:
+            for ring in self.rings.values():
+                ring.close()
+            self.rings.clear()
@@ -0,0 +1,230 @@
+"""
+history ในเครื่องแบบแบ่งไฟล์ตามเดือน (time-partitioned) สำหรับ SqliteStorage
+
+<dir>/history-YYYYMM.sqlite3 = แถวดิบของเดือนนั้น (ทุก device, PK (id, ts) ⇒ แถวของ device เดียวกันอยู่ติดกัน)
+- เขียน (ingest) ลงแค่ไฟล์ของเดือนปัจจุบัน
+- query ช่วงเวลาไหนก็เปิดเฉพาะไฟล์ของเดือนที่ทับช่วงนั้น (ATTACH ทีละไฟล์ เก็บที่เปิดค้างไว้ไม่เกิน open_max)
+- เดือนที่เก่ากว่า raw_days ⇒ สรุปเป็น rollup (ทีละ bucket_sec) ใน main DB แล้วลบไฟล์ทิ้งทั้งไฟล์
+  (ไม่มี DELETE แถวจำนวนมากในตารางที่ ingest เขียนอยู่)
+- เดือนที่จบแล้ว ⇒ VACUUM หนึ่งครั้ง (ไฟล์เล็กลง) แล้วปล่อยให้หลุดจาก connection ไปเองเมื่อไม่มีใครใช้
+
+rollup ใช้ column เดียวกับ history: temp / humid = เฉลี่ย, hic / flag = ของแถวที่ hic สูงสุดใน bucket, n = จำนวนแถวดิบ
+เฉลี่ยเฉพาะค่าที่อ่านได้ (ไม่นับ SENSOR_ERROR / NULL) nt / nh = จำนวนค่าที่นับของ temp / humid
+ทั้ง bucket อ่านไม่ได้เลย ⇒ เก็บ SENSOR_ERROR แบบแถวดิบ
+"""
+import calendar
+import os
+import re
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from heat_index import SENSOR_ERROR
+from snapshot import gas_timestamp
+
+SEGMENT_RE = re.compile(r"^history-(\d{6})\.sqlite3$")
+
+SEGMENT_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {schema}.history (
+    id TEXT NOT NULL,
+    ts REAL NOT NULL,
+    timestamp TEXT NOT NULL,
+    temp REAL,
+    humid REAL,
+    hic REAL,
+    flag TEXT,
+    PRIMARY KEY (id, ts)
+) WITHOUT ROWID
+"""
+
+# outbox ของการเขียน history ที่อยู่ในไฟล์เดือนนั้น ⇒ แถว history กับแถว outbox commit ในไฟล์เดียวกัน
+# (WAL: transaction ที่เขียนหลายไฟล์ไม่ atomic ข้ามไฟล์) ดู SqliteStorage._write
+SEGMENT_OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {schema}.outbox (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    created REAL NOT NULL,
+    coalesce_key TEXT,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT
+)
+"""
+
+ROLLUP_SCHEMA = """
+CREATE TABLE IF NOT EXISTS rollup (
+    id TEXT NOT NULL,
+    ts REAL NOT NULL,
+    timestamp TEXT NOT NULL,
+    temp REAL,
+    humid REAL,
+    hic REAL,
+    flag TEXT,
+    n INTEGER NOT NULL,
+    nt INTEGER NOT NULL DEFAULT 0,
+    nh INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (id, ts)
+) WITHOUT ROWID;
+"""
+
+# merge เข้า bucket เดิม (temp / humid ถ่วงน้ำหนักด้วยจำนวนค่าที่อ่านได้ nt / nh ไม่ใช่ n)
+UPSERT_ROLLUP = f"""
+INSERT INTO rollup (id, ts, timestamp, temp, humid, hic, flag, n, nt, nh) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (id, ts) DO UPDATE SET
+    temp = CASE WHEN nt + excluded.nt > 0
+        THEN (CASE WHEN nt > 0 THEN temp * nt ELSE 0 END
+              + CASE WHEN excluded.nt > 0 THEN excluded.temp * excluded.nt ELSE 0 END) / (nt + excluded.nt)
+        ELSE {SENSOR_ERROR} END,
+    humid = CASE WHEN nh + excluded.nh > 0
+        THEN (CASE WHEN nh > 0 THEN humid * nh ELSE 0 END
+              + CASE WHEN excluded.nh > 0 THEN excluded.humid * excluded.nh ELSE 0 END) / (nh + excluded.nh)
+        ELSE {SENSOR_ERROR} END,
+    flag = CASE WHEN excluded.hic > hic OR hic IS NULL THEN excluded.flag ELSE flag END,
+    hic = CASE WHEN excluded.hic > hic OR hic IS NULL THEN excluded.hic ELSE hic END,
+    n = n + excluded.n,
+    nt = nt + excluded.nt,
+    nh = nh + excluded.nh
+"""
+
+
+def month_of(ts: float) -> int:
+    t = time.gmtime(ts)
+    return t.tm_year * 100 + t.tm_mon
+
+
+def month_range(month: int) -> Tuple[float, float]:
+    """
+    [ต้นเดือน, ต้นเดือนถัดไป) เป็น key แบบ gas_ts_key
+    """
+    y, m = divmod(month, 100)
+    lo = calendar.timegm((y, m, 1, 0, 0, 0))
+    hi = calendar.timegm((y + m // 12, m % 12 + 1, 1, 0, 0, 0))
+    return float(lo), float(hi)
+
+
+def rollup_rows(path: str, bucket_sec: int) -> List[tuple]:
+    """
+    สรุปแถวดิบทั้งไฟล์เป็น bucket (อ่านผ่าน connection แยก ⇒ ไม่แย่ง lock กับ ingest)
+    คืน tuple ตามลำดับ column ของ UPSERT_ROLLUP
+    """
+    db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = db.execute(
+            "SELECT id, CAST(ts / ? AS INTEGER) * ? AS bucket, AVG(NULLIF(temp, ?)), AVG(NULLIF(humid, ?)), "
+            "MAX(hic), flag, COUNT(*), COUNT(NULLIF(temp, ?)), COUNT(NULLIF(humid, ?)) "
+            "FROM history GROUP BY id, bucket",
+            (bucket_sec, bucket_sec) + (SENSOR_ERROR,) * 4,
+        ).fetchall()
+    finally:
+        db.close()
+    # MAX(hic) ⇒ flag มาจากแถวเดียวกับ hic สูงสุด (bare column ของ SQLite)
+    return [
+        (did, float(b), gas_timestamp(b), t if nt else SENSOR_ERROR, h if nh else SENSOR_ERROR, hic, flag, n, nt, nh)
+        for did, b, t, h, hic, flag, n, nt, nh in rows
+    ]
+
+
+def reading_count(value) -> int:
+    """
+    ค่าเดียวนับเข้าค่าเฉลี่ยของ rollup ไหม (1 / 0) แบบเดียวกับ COUNT(NULLIF(x, SENSOR_ERROR))
+    """
+    try:
+        return 0 if value is None or float(value) == SENSOR_ERROR else 1
+    except (TypeError, ValueError):
+        return 0
+
+
+class SegmentSet:
+    """
+    ไฟล์เดือนต่าง ๆ ที่ ATTACH เข้ากับ connection หลัก (เรียกทุก method ภายใต้ lock ของ SqliteStorage
+    และนอก transaction: ATTACH / DETACH ทำใน transaction ไม่ได้)
+    """
+
+    def __init__(self, db: sqlite3.Connection, directory: str, open_max: int = 6):
+        self.db = db
+        self.dir = directory
+        self.open_max = max(1, open_max)
+        os.makedirs(directory, exist_ok=True)
+        self.months: List[int] = []
+        self.mtime_ns = -1
+        self.attached: "OrderedDict[int, str]" = OrderedDict()
+        self.rescan()
+
+    def rescan(self) -> bool:
+        """
+        อ่านรายการไฟล์ใหม่ถ้า directory เปลี่ยน (process อื่นสร้าง / ลบไฟล์เดือน) คืน True ถ้าอ่านใหม่
+        เดือนที่ไฟล์หายไปแล้ว ⇒ DETACH (ไม่งั้นยังอ่านไฟล์ที่ถูกลบได้จาก fd เดิม)
+        """
+        mtime_ns = os.stat(self.dir).st_mtime_ns
+        if mtime_ns == self.mtime_ns:
+            return False
+        self.mtime_ns = mtime_ns
+        self.months = sorted(int(m.group(1)) for m in (SEGMENT_RE.match(f) for f in os.listdir(self.dir)) if m)
+        for m in [m for m in self.attached if m not in self.months]:
+            self.detach(m)
+        return True
+
+    def path(self, month: int) -> str:
+        return os.path.join(self.dir, f"history-{month}.sqlite3")
+
+    def table(self, month: int) -> str:
+        """
+        ชื่อตาราง history ของเดือนนี้ (ATTACH / สร้างไฟล์ถ้ายังไม่มี)
+        """
+        if month in self.attached:
+            self.attached.move_to_end(month)
+            return f"{self.attached[month]}.history"
+        while len(self.attached) >= self.open_max:
+            self.detach(next(iter(self.attached)))
+        alias = f"seg_{month}"
+        self.db.execute("ATTACH DATABASE ? AS " + alias, (self.path(month),))
+        self.db.execute(f"PRAGMA {alias}.journal_mode=WAL")
+        self.db.execute(SEGMENT_SCHEMA.format(schema=alias))
+        self.db.execute(SEGMENT_OUTBOX_SCHEMA.format(schema=alias))
+        self.attached[month] = alias
+        if month not in self.months:
+            self.months.append(month)
+            self.months.sort()
+        return f"{alias}.history"
+
+    def outbox_table(self, month: int) -> str:
+        return self.table(month).split(".")[0] + ".outbox"
+
+    def detach(self, month: int):
+        alias = self.attached.pop(month, None)
+        if alias is not None:
+            self.db.execute(f"DETACH DATABASE {alias}")
+
+    def covering(self, lo: Optional[float] = None, hi: Optional[float] = None) -> List[int]:
+        """
+        เดือนที่ทับช่วง [lo, hi) เรียงเก่า → ใหม่
+        """
+        out = []
+        for m in self.months:
+            m_lo, m_hi = month_range(m)
+            if (lo is None or m_hi > lo) and (hi is None or m_lo < hi):
+                out.append(m)
+        return out
+
+    def drop(self, month: int):
+        self.detach(month)
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.remove(self.path(month) + suffix)
+            except FileNotFoundError:
+                pass
+        if month in self.months:
+            self.months.remove(month)
+
+    def size_bytes(self) -> int:
+        total = 0
+        for m in self.months:
+            try:
+                total += os.path.getsize(self.path(m))
+            except OSError:
+                pass
+        return total
+
+    def close(self):
+        for m in list(self.attached):
+            self.detach(m)
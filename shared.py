@@ -0,0 +1,395 @@
+"""
+state ที่ใช้ร่วมกันระหว่าง worker บนเครื่องเดียว (uvicorn --workers N) ผ่านไฟล์ SQLite (WAL)
+
+แต่ละ worker เป็นคนละ process ⇒ cache / warm_state / liveness อยู่แยกกัน ต้องมีช่องทางบอกกัน
+- events : log ของสิ่งที่เปลี่ยน (invalidate / config / subs / ค่าที่รับเข้า ...) เรียงตาม seq
+  publish() เขียนแถว, poll() อ่านแถวที่ใหม่กว่า cursor ของตัวเอง (ข้ามแถวที่ตัวเองเขียน) แล้วเรียก handler ตาม topic
+  ไม่มีอะไรเปลี่ยน ⇒ poll() เช็คแค่ PRAGMA data_version (ไม่อ่านตาราง) เรียกก่อนทุก request ได้
+- cache  : cache ชั้นสอง (ค่าที่ pickle แล้ว) ที่ worker หนึ่งดึง / render แล้ว worker อื่นใช้ต่อได้
+  แต่ละแถวมี tag (line:<id> / device:<id> / page:<id>) ⇒ publish(tags=...) ลบแถวที่มี tag นั้นใน transaction เดียวกับ event
+  put ที่เริ่มดึงก่อน event ที่ tag ชนกัน (token เก่ากว่า) ⇒ ไม่เก็บ (ค่าอาจเก่ากว่าที่ invalidate ไปแล้ว)
+- buckets: token bucket ที่ต้องจำกัดรวมทั้งเครื่อง (admission รวม / drain rate ไป GAS) ⇒ N worker ไม่ได้ N เท่า
+- leader : flock ของ <path>.leader ⇒ worker เดียวทำงานที่ทั้งเครื่องต้องมีตัวเดียว (แจ้งเตือน / snapshot / mirror)
+  leader ตาย ⇒ lock หลุดเอง worker ที่เหลือ (thread poll) แย่งได้แล้วเรียก on_leader()
+"""
+import fcntl
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger("uvicorn.error")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    at REAL NOT NULL,
+    origin TEXT NOT NULL,
+    topic TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    tags TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS cache (
+    key TEXT PRIMARY KEY,
+    fetched_at REAL NOT NULL,
+    value BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS cache_tags (
+    tag TEXT NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (tag, key)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS buckets (
+    name TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+
+class SharedState:
+    """
+    - on(topic, handler) : handler(payload) ถูกเรียกเมื่อ worker อื่น publish topic นี้
+      (เรียกจาก thread ที่ poll อยู่ ⇒ handler ต้อง thread-safe และไม่ publish ต่อ)
+    - publish(topic, payload, tags, wait=False) ⇒ พักไว้ให้ thread poll เขียนทีเดียวหลายแถว (ไม่บล็อก event loop)
+    - keep_sec   : เก็บ event ไว้นานเท่านี้ (worker ที่ยังอยู่ poll ทุก poll_sec อ่านไปนานแล้ว)
+    - max_age_sec: แถวใน cache ที่เก่ากว่านี้ไม่คืน / ลบทิ้ง
+    """
+
+    def __init__(self, path: str, poll_sec: float = 0.2, keep_sec: float = 300.0, max_age_sec: float = 900.0):
+        self.path = path
+        self.poll_sec = poll_sec
+        self.keep_sec = keep_sec
+        self.max_age_sec = max_age_sec
+        self.origin = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.lock = threading.Lock()         # connection
+        self.apply_lock = threading.Lock()   # poll ทีละตัว ⇒ poll() คืนเมื่อ event ก่อนหน้าถูก apply ครบแล้ว
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(_SCHEMA)
+        self.cursor = self.db.execute("SELECT COALESCE(MAX(seq), 0) FROM events").fetchone()[0]
+        self.data_version = self._data_version()
+        self.handlers: Dict[str, Callable[[dict], None]] = {}
+        self.pending: List[tuple] = []
+        self.leader = False
+        self.lock_fd = os.open(path + ".leader", os.O_RDWR | os.O_CREAT, 0o644)
+        self.on_leader: Optional[Callable[[], None]] = None
+        self.stopping = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.last_prune = 0.0
+        self.stats = {
+            "published": 0, "applied": 0, "handler_errors": 0,
+            "cache_hits": 0, "cache_misses": 0, "cache_puts": 0, "cache_conflicts": 0, "pruned": 0,
+            "bucket_ops": 0,
+        }
+
+    def _count(self, key: str, n: int = 1):
+        self.stats[key] += n   # เรียกภายใต้ self.lock
+
+    def _data_version(self) -> int:
+        return self.db.execute("PRAGMA data_version").fetchone()[0]
+
+    def _begin(self):
+        # IMMEDIATE ⇒ จอง lock เขียนตั้งแต่ต้น (ไม่ชนกับ worker อื่นตอน upgrade จาก read lock)
+        self.db.execute("BEGIN IMMEDIATE")
+
+    # ---------- leader ----------
+
+    def try_lead(self) -> bool:
+        if self.leader:
+            return True
+        try:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        self.leader = True
+        logger.info(f"shared state: pid {os.getpid()} is leader")
+        return True
+
+    # ---------- events ----------
+
+    def on(self, topic: str, handler: Callable[[dict], None]):
+        self.handlers[topic] = handler
+
+    def publish(self, topic: str, payload: dict, tags: Iterable[str] = (), wait: bool = True):
+        """
+        wait=True ⇒ commit ก่อนคืน (worker อื่นที่ poll หลังจากนี้เห็นแน่นอน)
+        """
+        row = (topic, json.dumps(payload, ensure_ascii=False), tuple(tags))
+        if not wait:
+            with self.lock:
+                self.pending.append(row)
+            return
+        with self.lock:
+            self._write_events([row])
+
+    def _write_events(self, rows: List[tuple]):
+        now = time.time()
+        self._begin()
+        try:
+            for topic, payload, tags in rows:
+                if tags:
+                    self._drop_tagged(tags)
+                self.db.execute(
+                    "INSERT INTO events (at, origin, topic, payload, tags) VALUES (?, ?, ?, ?, ?)",
+                    (now, self.origin, topic, payload, _join_tags(tags)),
+                )
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        self._count("published", len(rows))
+
+    def _drop_tagged(self, tags: Tuple[str, ...]):
+        marks = ",".join("?" * len(tags))
+        keys = [r[0] for r in self.db.execute(f"SELECT DISTINCT key FROM cache_tags WHERE tag IN ({marks})", tags)]
+        for i in range(0, len(keys), 500):
+            part = keys[i:i + 500]
+            marks = ",".join("?" * len(part))
+            self.db.execute(f"DELETE FROM cache WHERE key IN ({marks})", part)
+            self.db.execute(f"DELETE FROM cache_tags WHERE key IN ({marks})", part)
+
+    def flush(self):
+        with self.lock:
+            rows, self.pending = self.pending, []
+            if rows:
+                self._write_events(rows)
+
+    def poll(self) -> int:
+        """
+        apply event ของ worker อื่นที่ยังไม่เคยเห็น คืนจำนวนที่ apply
+        """
+        with self.apply_lock:
+            with self.lock:
+                version = self._data_version()
+                if version == self.data_version:
+                    return 0
+                self.data_version = version
+                rows = self.db.execute(
+                    "SELECT seq, origin, topic, payload FROM events WHERE seq > ? ORDER BY seq", (self.cursor,)
+                ).fetchall()
+                if rows:
+                    self.cursor = rows[-1][0]
+            n = 0
+            for _, origin, topic, payload in rows:
+                if origin == self.origin:
+                    continue
+                handler = self.handlers.get(topic)
+                if handler is None:
+                    continue
+                try:
+                    handler(json.loads(payload))
+                    n += 1
+                except Exception:
+                    logger.exception(f"shared state: handler of {topic} failed")
+                    with self.lock:
+                        self._count("handler_errors")
+            if n:
+                with self.lock:
+                    self._count("applied", n)
+            return n
+
+    def token(self) -> int:
+        """
+        จุดใน event log ก่อนเริ่มดึง / render ค่าที่จะ cache_put (poll ก่อน ⇒ invalidate ที่มาก่อนหน้านี้ apply แล้ว)
+        """
+        self.poll()
+        return self.cursor
+
+    # ---------- token bucket ----------
+
+    def take_tokens(self, name: str, rate: float, capacity: float, n: float = 1.0, reserve: bool = False) -> float:
+        """
+        token bucket ที่ใช้ร่วมกันทุก worker ความหมายเดียวกับ admission.TokenBucket
+        reserve=False ⇒ try_take (ไม่พอ = ไม่หยิบ) / True ⇒ reserve (ติดลบได้) คืนวินาทีที่ต้องรอ
+        n < 0 ⇒ คืน token (refund)
+        """
+        now = time.time()
+        with self.lock:
+            self._begin()
+            try:
+                row = self.db.execute("SELECT tokens, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+                tokens, updated = row if row else (capacity, now)
+                tokens = min(capacity, tokens + max(0.0, now - updated) * rate)   # นาฬิกาถอยหลัง ⇒ ไม่เติม
+                if reserve or n <= 0 or tokens >= n:
+                    tokens = min(capacity, tokens - n)
+                    wait = 0.0 if tokens >= 0 or rate <= 0 else -tokens / rate
+                else:
+                    wait = float("inf") if rate <= 0 else (n - tokens) / rate
+                self.db.execute("INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)",
+                                (name, tokens, now))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self._count("bucket_ops")
+        return wait
+
+    # ---------- cache ----------
+
+    def cache_get(self, key: str) -> Optional[Tuple[Any, float]]:
+        with self.lock:
+            row = self.db.execute("SELECT fetched_at, value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or time.time() - row[0] > self.max_age_sec:
+                self._count("cache_misses")
+                return None
+            self._count("cache_hits")
+        return pickle.loads(row[1]), row[0]
+
+    def cache_put(self, key: str, value: Any, fetched_at: float, tags: Iterable[str], token: int) -> bool:
+        """
+        เก็บ ถ้าไม่มี event หลัง token ที่ tag ชนกับ tags (ไม่งั้นคืน False)
+        """
+        tags = tuple(dict.fromkeys(tags))
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self._begin()
+            try:
+                for (event_tags,) in self.db.execute("SELECT tags FROM events WHERE seq > ? AND tags != ''", (token,)):
+                    if any(f"\n{t}\n" in event_tags for t in tags):
+                        self.db.execute("ROLLBACK")
+                        self._count("cache_conflicts")
+                        return False
+                self.db.execute("INSERT OR REPLACE INTO cache (key, fetched_at, value) VALUES (?, ?, ?)",
+                                (key, fetched_at, blob))
+                self.db.execute("DELETE FROM cache_tags WHERE key = ?", (key,))
+                self.db.executemany("INSERT OR IGNORE INTO cache_tags (tag, key) VALUES (?, ?)", [(t, key) for t in tags])
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self._count("cache_puts")
+        return True
+
+    # ---------- background ----------
+
+    def start(self, on_leader: Optional[Callable[[], None]] = None):
+        self.on_leader = on_leader
+        if self.thread is None:
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run, name="shared-state", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout=5)
+            self.thread = None
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("shared state: cannot flush pending events")
+        if self.leader:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+            self.leader = False
+
+    def _run(self):
+        while not self.stopping.wait(self.poll_sec):
+            try:
+                self.flush()
+                self.poll()
+                if not self.leader and self.try_lead() and self.on_leader is not None:
+                    self.on_leader()
+                if self.leader and time.time() - self.last_prune > self.poll_sec * 50:
+                    self.prune()
+            except Exception:
+                logger.exception("shared state: poll failed")
+
+    def prune(self, now: Optional[float] = None) -> int:
+        now = time.time() if now is None else now
+        with self.lock:
+            self._begin()
+            try:
+                n = self.db.execute("DELETE FROM events WHERE at < ?", (now - self.keep_sec,)).rowcount
+                n += self.db.execute("DELETE FROM cache WHERE fetched_at < ?", (now - self.max_age_sec,)).rowcount
+                self.db.execute("DELETE FROM cache_tags WHERE key NOT IN (SELECT key FROM cache)")
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self._count("pruned", n)
+        self.last_prune = now
+        return n
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            snap = dict(self.stats)
+            snap["pending"] = len(self.pending)
+            snap["cache_rows"] = self.db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+        snap.update(path=self.path, pid=os.getpid(), leader=self.leader, cursor=self.cursor)
+        return snap
+
+
+def _join_tags(tags: Iterable[str]) -> str:
+    # "\n" หน้า-หลัง ⇒ เช็ค tag ชนกันด้วย substring ได้ตรงตัว
+    tags = list(tags)
+    return "\n" + "\n".join(tags) + "\n" if tags else ""
+
+
+class SharedTokenBucket:
+    """
+    แทน admission.TokenBucket ได้ (try_take / reserve / refund) แต่ token อยู่ใน SharedState ⇒ rate รวมทุก worker
+    """
+
+    def __init__(self, state: SharedState, name: str, rate: float, capacity: float):
+        self.state = state
+        self.name = name
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+
+    def try_take(self, n: float = 1.0, now: Optional[float] = None) -> float:
+        return self.state.take_tokens(self.name, self.rate, self.capacity, n)
+
+    def reserve(self, n: float = 1.0, now: Optional[float] = None) -> float:
+        return self.state.take_tokens(self.name, self.rate, self.capacity, n, reserve=True)
+
+    def refund(self, n: float = 1.0):
+        self.state.take_tokens(self.name, self.rate, self.capacity, -n)
+
+
+class SharedCache:
+    """
+    มุมมองของ SharedState ให้ SWRCache / PageCache หนึ่งตัว
+    - namespace : prefix ของ key ในตาราง cache
+    - tags(key) : tag ของแถวนี้ (invalidate ด้วย tag เดียวกัน ⇒ แถวหาย)
+    - share(key): key ไหนเก็บร่วม (เช่นไม่แชร์ค่าที่ใหญ่มาก)
+    """
+
+    def __init__(self, state: SharedState, namespace: str, tags: Callable[[Hashable], Iterable[str]],
+                 share: Callable[[Hashable], bool] = lambda key: True):
+        self.state = state
+        self.namespace = namespace
+        self.tags = tags
+        self.share = share
+
+    def _key(self, key: Hashable) -> str:
+        return f"{self.namespace}:{key!r}"
+
+    def token(self) -> int:
+        return self.state.token()
+
+    # cache ชั้นสองพัง (ไฟล์ถูก lock นาน / เสีย) ⇒ ทำเหมือน miss ไม่ให้ request พังตาม
+
+    def get(self, key: Hashable) -> Optional[Tuple[Any, float]]:
+        if not self.share(key):
+            return None
+        try:
+            return self.state.cache_get(self._key(key))
+        except (sqlite3.Error, pickle.UnpicklingError, EOFError):
+            logger.exception(f"shared cache: cannot read {key}")
+            return None
+
+    def put(self, key: Hashable, value: Any, fetched_at: float, token: int, tags: Iterable[str] = ()) -> bool:
+        if not self.share(key):
+            return False
+        try:
+            return self.state.cache_put(self._key(key), value, fetched_at, list(self.tags(key)) + list(tags), token)
+        except sqlite3.Error:
+            logger.exception(f"shared cache: cannot store {key}")
+            return False
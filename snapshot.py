@@ -0,0 +1,448 @@
+"""
+Snapshot ของ state ในหน่วยความจำ + warm start
+
+host ฟรีหลับแล้วตื่นใหม่บ่อย ⇒ request แรกของ /status /history ต้องรอ GAS ดึงทั้งก้อน
+WarmState จำสิ่งที่เคยได้จาก GAS / ingest ไว้:
+- configs   : config ของแต่ละ device (unit / adj_temp / adj_humid)
+- subs      : device → [line_id, ...]
+- lines     : line_id → [device_id, ...] (ลำดับตาม current_status ล่าสุด)
+- status    : device → แถวล่าสุดแบบ current_status (lastupdate / temp / humid / hic / flag)
+- history   : device → แถวล่าสุดไม่เกิน history_rows แถว (เก่า → ใหม่)
+
+save() เขียนไฟล์ binary ขนาดเล็ก (เขียนไฟล์ชั่วคราวแล้ว rename):
+    MAGIC | u32 ความยาว header | header JSON | history ของแต่ละ device เป็น record ขนาดคงที่
+    record = <d f f f B> = raw epoch ของ timestamp, temp, humid, hic, รหัส flag (ตาราง flags ใน header)
+load() mmap ไฟล์ อ่านแค่ header ⇒ history ของ device ไหน decode ตอนถูกขอครั้งแรก
+
+line_id ที่โหลดมาจาก snapshot ถือว่า "ไม่สด" จนกว่าจะดึงจาก GAS ใหม่สำเร็จ (mark_fresh)
+ระหว่างนั้นหน้าเว็บใช้ข้อมูลจาก snapshot ไปก่อน
+"""
+import json
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Set, Tuple
+
+logger = logging.getLogger("uvicorn.error")
+
+MAGIC = b"HTSNAP1\n"
+_HEADER_LEN = struct.Struct("<I")
+_RECORD = struct.Struct("<dfffB")
+_NAIVE_BIT = 0x80   # timestamp เดิมไม่มี timezone (ไม่มี Z)
+TH_OFFSET_SEC = 7 * 3600   # timestamp ไม่มี timezone = เวลาไทย
+
+
+def _ts_to_raw(ts) -> Optional[Tuple[float, bool]]:
+    """
+    timestamp string จาก GAS → (epoch ของตัวเลขใน string, naive?) ไว้แปลงกลับเป็น string เดิมได้
+    """
+    if ts in (None, "", "-"):
+        return None
+    s = str(ts)
+    try:
+        dt = datetime.fromisoformat(s.replace("Z", "+00:00") if s.endswith("Z") else s)
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        return dt.replace(tzinfo=timezone.utc).timestamp(), True
+    return dt.timestamp(), False
+
+
+def _raw_to_ts(raw: float, naive: bool) -> str:
+    dt = datetime.fromtimestamp(raw, tz=timezone.utc)
+    if naive:
+        return dt.strftime("%Y-%m-%dT%H:%M:%S")
+    return dt.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+
+
+def gas_timestamp(epoch: float) -> str:
+    """
+    epoch ที่ส่งเข้า appendHistory → timestamp แบบที่ GAS คืนมา (JSON.stringify ของ Date)
+    """
+    return _raw_to_ts(epoch, False)
+
+
+def gas_ts_parse(ts) -> Optional[Tuple[float, bool]]:
+    """
+    timestamp ของแถว GAS → (epoch จริง, ไม่มี timezone?) (None = แปลงไม่ได้)
+    ไม่มี timezone = เวลาไทย ⇒ ลบ 7 ชม. (แถว Z กับไม่มี Z ของ device เดียวกันเรียง / เทียบกันได้)
+    naive ใช้แค่ตอนแสดงผล / แปลงกลับ (gas_ts_format)
+    """
+    raw = _ts_to_raw(ts)
+    if raw is None:
+        return None
+    return (raw[0] - TH_OFFSET_SEC, True) if raw[1] else raw
+
+
+def gas_ts_key(ts) -> Optional[float]:
+    """
+    ค่าไว้เรียง / เทียบ timestamp ของแถว GAS = epoch จริง (None = แปลงไม่ได้)
+    """
+    parsed = gas_ts_parse(ts)
+    return parsed[0] if parsed is not None else None
+
+
+def gas_ts_format(epoch: float, naive: bool) -> str:
+    """
+    กลับของ gas_ts_parse: epoch จริง + naive → timestamp แบบเดิม (naive ⇒ เวลาไทยไม่มี Z)
+    """
+    return _raw_to_ts(epoch + TH_OFFSET_SEC if naive else epoch, naive)
+
+
+def _num(v) -> float:
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class WarmState:
+    def __init__(self, history_rows: int = 1008):
+        self.history_rows = history_rows
+        self.lock = threading.Lock()
+        self.configs: Dict[str, dict] = {}
+        self.subs: Dict[str, List[str]] = {}
+        self.lines: Dict[str, List[str]] = {}
+        self.status: Dict[str, dict] = {}
+        self.history: Dict[str, List[dict]] = {}
+        self.fresh: Set[Tuple[str, str]] = set()   # (kind, line_id) ที่ดึงจาก GAS แล้วหลัง start
+        self.warm_lines: Set[str] = set()           # line_id ที่มีใน snapshot ที่โหลดมา
+        self.dirty = False
+        self.loaded_at: Optional[float] = None
+        self.created_at: Optional[float] = None     # เวลาที่เขียน snapshot ที่โหลดมา
+        self.saved_at: Optional[float] = None
+        self.stats = {"warm_hits": 0, "saves": 0}
+        # history ที่ยังไม่ decode: device → (offset, count) ใน mmap
+        self._mm: Optional[mmap.mmap] = None
+        self._lazy: Dict[str, Tuple[int, int]] = {}
+        self._flags: List[str] = []
+
+    # ---------- บันทึกจาก GAS / ingest ----------
+
+    def note_config(self, device_id: str, row: dict):
+        with self.lock:
+            self.configs[device_id] = dict(row)
+            self.dirty = True
+
+    def note_subs(self, device_id: str, line_ids: List[str]):
+        with self.lock:
+            self.subs[device_id] = list(dict.fromkeys(line_ids))
+            self.dirty = True
+
+    def add_sub(self, device_id: str, line_id: str):
+        with self.lock:
+            subs = self.subs.setdefault(device_id, [])
+            if line_id not in subs:
+                subs.append(line_id)
+            ids = self.lines.get(line_id)
+            if ids is not None and device_id not in ids:
+                ids.append(device_id)
+            self.dirty = True
+
+    def remove_sub(self, device_id: str, line_id: str):
+        with self.lock:
+            if line_id in self.subs.get(device_id, []):
+                self.subs[device_id].remove(line_id)
+            if device_id in self.lines.get(line_id, []):
+                self.lines[line_id].remove(device_id)
+            self.dirty = True
+
+    def note_status(self, line_id: str, rows: List[dict]):
+        """
+        ผลของ current_status(line_id) จาก GAS
+        """
+        with self.lock:
+            ids = []
+            for r in rows:
+                did = str(r.get("id", ""))
+                if not did:
+                    continue
+                ids.append(did)
+                self.status[did] = {k: v for k, v in r.items() if k != "status"}
+                subs = self.subs.setdefault(did, [])
+                if line_id not in subs:
+                    subs.append(line_id)
+            self.lines[line_id] = ids
+            self.dirty = True
+
+    def note_history(self, line_id: str, rows: List[dict]):
+        """
+        ผลของ history(line_id) จาก GAS (ใหม่ → เก่า) เก็บล่าสุด history_rows แถวต่อ device
+        """
+        per_dev: Dict[str, List[dict]] = {}
+        for r in rows:
+            did = str(r.get("id", ""))
+            bucket = per_dev.setdefault(did, [])
+            if len(bucket) < self.history_rows:
+                bucket.append(dict(r))
+        with self.lock:
+            for did, bucket in per_dev.items():
+                bucket.reverse()
+                self.history[did] = bucket
+                self._lazy.pop(did, None)
+            self.dirty = True
+
+    def add_reading(self, device_id: str, reading: dict, ts: str, latest: bool = True):
+        """
+        ค่าที่เพิ่งรับเข้า (ingest) ⇒ ต่อท้าย history + เป็นค่าล่าสุดของ device (latest=False ⇒ ค่าเก่าที่มาช้า ไม่ทับ)
+        ts = timestamp แบบเดียวกับที่ GAS คืนมา
+        """
+        row = {
+            "id": device_id,
+            "timestamp": ts,
+            "temp": reading.get("temp"),
+            "humid": reading.get("humid"),
+            "hic": reading.get("hic"),
+            "flag": reading.get("flag"),
+        }
+        with self.lock:
+            hist = self._history_locked(device_id)
+            if hist is not None:
+                hist.append(row)
+                if len(hist) > self.history_rows:
+                    del hist[:len(hist) - self.history_rows]
+            st = self.status.get(device_id) if latest else None
+            if st is not None:
+                st.update(lastupdate=ts, temp=row["temp"], humid=row["humid"], hic=row["hic"], flag=row["flag"])
+            self.dirty = True
+
+    def latest_readings(self) -> Dict[str, dict]:
+        """
+        ค่าล่าสุดของทุก device ที่รู้จัก (จาก current_status / snapshot / ingest) แบบ reading ของ ingest
+        device ที่ไม่มี lastupdate / อ่านไม่ได้ ⇒ ไม่มีใน dict
+        """
+        with self.lock:
+            rows = {did: dict(st) for did, st in self.status.items()}
+        out: Dict[str, dict] = {}
+        for did, st in rows.items():
+            epoch = gas_ts_key(st.get("lastupdate"))
+            if epoch is None:
+                continue
+            out[did] = {
+                "temp": st.get("temp"),
+                "humid": st.get("humid"),
+                "hic": st.get("hic"),
+                "flag": st.get("flag"),
+                "timestamp": st.get("lastupdate"),
+                "received_at": epoch,
+                "epoch": epoch,
+            }
+        return out
+
+    def device_ids(self) -> Set[str]:
+        """
+        device ทุกตัวที่รู้จัก (config / subscribe / current_status)
+        """
+        with self.lock:
+            return set(self.configs) | set(self.subs) | set(self.status)
+
+    # ---------- ใช้ตอนยังไม่สด ----------
+
+    def mark_fresh(self, kind: str, line_id: str):
+        with self.lock:
+            self.fresh.add((kind, line_id))
+
+    def is_fresh(self, kind: str, line_id: str) -> bool:
+        with self.lock:
+            return (kind, line_id) in self.fresh
+
+    def line_ids(self) -> List[str]:
+        with self.lock:
+            return list(self.lines.keys())
+
+    def current_status(self, line_id: str) -> Optional[dict]:
+        """
+        current_status(line_id) แบบเดียวกับ GAS จากข้อมูลที่จำไว้ (None = ไม่รู้จัก line นี้)
+        """
+        with self.lock:
+            ids = self.lines.get(line_id)
+            if not ids or line_id not in self.warm_lines:
+                return None
+            data = [dict(self.status[did]) for did in ids if did in self.status]
+            self.stats["warm_hits"] += 1
+        return {"success": True, "count": len(data), "data": data, "fetched_at": self.created_at}
+
+    def has_history(self, line_id: str) -> bool:
+        with self.lock:
+            ids = self.lines.get(line_id)
+            if not ids or line_id not in self.warm_lines:
+                return False
+            return any(did in self.history or did in self._lazy for did in ids)
+
+    def history_for_line(self, line_id: str) -> Optional[dict]:
+        """
+        history(line_id) (ใหม่ → เก่า) จากข้อมูลที่จำไว้ (None = ไม่รู้จัก line นี้)
+        """
+        with self.lock:
+            ids = self.lines.get(line_id)
+            if not ids or line_id not in self.warm_lines:
+                return None
+            if not any(did in self.history or did in self._lazy for did in ids):
+                return None
+            rows: List[dict] = []
+            for did in ids:
+                rows.extend(self._history_locked(did) or [])
+            self.stats["warm_hits"] += 1
+        rows = [dict(r) for r in rows]
+        rows.sort(key=lambda r: gas_ts_key(r.get("timestamp")) or 0.0, reverse=True)
+        return {"success": True, "count": len(rows), "data": rows, "fetched_at": self.created_at}
+
+    def config(self, device_id: str) -> Optional[dict]:
+        with self.lock:
+            row = self.configs.get(device_id)
+            return dict(row) if row else None
+
+    def device_ids_for(self, line_id: str) -> Optional[List[str]]:
+        with self.lock:
+            ids = self.lines.get(line_id)
+            return list(ids) if ids is not None else None
+
+    def line_ids_for(self, device_id: str) -> Optional[List[str]]:
+        with self.lock:
+            subs = self.subs.get(device_id)
+            return list(subs) if subs is not None else None
+
+    # ---------- mmap lazy history ----------
+
+    def _history_locked(self, device_id: str) -> Optional[List[dict]]:
+        if device_id in self._lazy:
+            offset, count = self._lazy.pop(device_id)
+            rows = []
+            view = memoryview(self._mm)[offset:offset + count * _RECORD.size]
+            try:
+                for raw, temp, humid, hic, code in _RECORD.iter_unpack(view):
+                    naive = bool(code & _NAIVE_BIT)
+                    idx = code & ~_NAIVE_BIT
+                    rows.append({
+                        "id": device_id,
+                        "timestamp": _raw_to_ts(raw, naive),
+                        "temp": round(temp, 2),
+                        "humid": round(humid, 2),
+                        "hic": round(hic, 2),
+                        "flag": self._flags[idx] if idx < len(self._flags) else "",
+                    })
+            finally:
+                view.release()
+            self.history[device_id] = rows
+        return self.history.get(device_id)
+
+    # ---------- save / load ----------
+
+    def save(self, path: str) -> int:
+        """
+        เขียน snapshot (atomic) คืนขนาดไฟล์ (bytes)
+        """
+        with self.lock:
+            for did in list(self._lazy):
+                self._history_locked(did)
+            if self._mm is not None:
+                self._mm.close()
+                self._mm = None
+            header = {
+                "created_at": time.time(),
+                "configs": self.configs,
+                "subs": self.subs,
+                "lines": self.lines,
+                "status": self.status,
+            }
+            flags: Dict[str, int] = {}
+            flag_list: List[str] = []
+            blobs: List[Tuple[str, bytes, int]] = []
+            for did, rows in self.history.items():
+                buf = bytearray()
+                count = 0
+                for r in rows:
+                    raw = _ts_to_raw(r.get("timestamp"))
+                    if raw is None:
+                        continue
+                    flag = str(r.get("flag") or "")
+                    code = flags.get(flag)
+                    if code is None:
+                        # ปกติมีไม่กี่ค่า (ธงสี / OK) เกิน 127 ค่าให้ไปใช้ตัวแรก
+                        code = len(flag_list) if len(flag_list) < _NAIVE_BIT else 0
+                        if code == len(flag_list):
+                            flags[flag] = code
+                            flag_list.append(flag)
+                    if raw[1]:
+                        code |= _NAIVE_BIT
+                    buf += _RECORD.pack(raw[0], _num(r.get("temp")), _num(r.get("humid")), _num(r.get("hic")), code)
+                    count += 1
+                blobs.append((did, bytes(buf), count))
+            self.dirty = False
+
+        index = {}
+        offset = 0
+        for did, blob, count in blobs:
+            index[did] = [offset, count]
+            offset += len(blob)
+        header["flags"] = flag_list
+        header["history_index"] = index
+        head = json.dumps(header, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(MAGIC)
+            f.write(_HEADER_LEN.pack(len(head)))
+            f.write(head)
+            for _, blob, _ in blobs:
+                f.write(blob)
+        os.replace(tmp, path)
+        self.saved_at = time.time()
+        self.stats["saves"] += 1
+        return len(MAGIC) + _HEADER_LEN.size + len(head) + offset
+
+    def load(self, path: str) -> bool:
+        """
+        โหลด snapshot (mmap) คืน False ถ้าไม่มีไฟล์ / ไฟล์เสีย
+        """
+        try:
+            with open(path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        try:
+            if mm[:len(MAGIC)] != MAGIC:
+                raise ValueError("bad magic")
+            pos = len(MAGIC)
+            (head_len,) = _HEADER_LEN.unpack_from(mm, pos)
+            pos += _HEADER_LEN.size
+            header = json.loads(bytes(mm[pos:pos + head_len]).decode("utf-8"))
+            base = pos + head_len
+        except (ValueError, struct.error):
+            logger.exception(f"snapshot {path} is corrupt; ignoring")
+            mm.close()
+            return False
+
+        with self.lock:
+            self.configs = header.get("configs", {})
+            self.subs = header.get("subs", {})
+            self.lines = header.get("lines", {})
+            self.status = header.get("status", {})
+            self._flags = header.get("flags", [])
+            self._lazy = {did: (base + off, count) for did, (off, count) in header.get("history_index", {}).items()}
+            self.history = {}
+            self._mm = mm
+            self.fresh = set()
+            self.warm_lines = set(self.lines)
+            self.dirty = False
+            self.loaded_at = time.time()
+            self.created_at = header.get("created_at")
+        return True
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return {
+                "devices": len(self.status),
+                "lines": len(self.lines),
+                "warm_lines": len(self.warm_lines),
+                "fresh": len(self.fresh),
+                "lazy_history": len(self._lazy),
+                "loaded_at": self.loaded_at,
+                "saved_at": self.saved_at,
+                "dirty": self.dirty,
+                **self.stats,
+            }
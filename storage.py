@@ -0,0 +1,1170 @@
+"""
+ที่เก็บ config / subscription / history (storage backend)
+
+เดิม main.py ยิง Apps Script (BASE_URL) ตรง ๆ ทุกที่ ⇒ GAS ช้าสุด + ติด quota
+ตอนนี้ทุก operation ผ่าน interface เดียว (Storage) ที่คืนรูปแบบเดียวกับ GAS
+({"success", "count", "data"}) ⇒ โค้ดที่เรียกใช้ไม่ต้องรู้ว่าข้างหลังเป็นอะไร
+
+- GasStorage    : Apps Script แบบเดิม (single-flight, stream decode, pushdown)
+- SqliteStorage : ไฟล์ SQLite ในเครื่อง (เร็ว ไม่มี quota)
+- TieredStorage : อ่าน / เขียนที่ SQLite แล้วส่งต่อไป GAS เบื้องหลัง (Sheet ยังมีข้อมูลให้คนเปิดดู)
+  ครั้งแรก ⇒ copy ของเดิมจาก GAS มาก่อน (ระหว่างนั้นอ่านจาก GAS, GAS ล่ม ⇒ ลองใหม่แบบ backoff)
+  ที่เขียนระหว่าง copy ไม่ถูกทับ: config / subs ของ device ที่มี outbox ค้าง ⇒ ข้าม, history ⇒ INSERT OR IGNORE
+  การเขียนลง outbox ใน transaction เดียวกัน (history ⇒ outbox ในไฟล์เดือนเดียวกัน) แล้ว replication.Replicator ทยอยส่ง
+
+timestamp ของ history เก็บแบบเดียวกับที่ GAS คืนมา (string) + ts = gas_ts_key ไว้เรียง / กรอง
+"""
+import heapq
+import json
+import logging
+import sqlite3
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import requests
+
+from cache import SingleFlight
+from gas_query import HistoryQuery, PushdownProbe
+from heat_index import SENSOR_ERROR
+from jsonstream import iter_object
+from replication import Replicator
+from segments import ROLLUP_SCHEMA, UPSERT_ROLLUP, SegmentSet, month_of, month_range, reading_count, rollup_rows
+from snapshot import gas_timestamp, gas_ts_key
+
+logger = logging.getLogger("uvicorn.error")
+
+HISTORY_FIELDS = ("id", "timestamp", "temp", "humid", "hic", "flag")
+
+
+def _ok(data) -> dict:
+    if isinstance(data, list):
+        return {"success": True, "count": len(data), "data": data}
+    return {"success": True, "data": data}
+
+
+def append_key(device_id: str, timestamp) -> str:
+    """
+    idempotency key ของ appendHistory (id + timestamp ที่ firmware / server ใส่)
+    Apps Script เจอ key ที่เคยเขียนแล้ว ⇒ ตอบ success ไม่เพิ่มแถว (ส่งซ้ำหลัง timeout ได้ปลอดภัย)
+    """
+    return f"{device_id}|{timestamp}"
+
+
+class Storage:
+    """
+    operation ที่ main.py ใช้ (คืน dict แบบ GAS ทั้งหมด)
+    history_by_device = เก่า → ใหม่, history_by_line = ใหม่ → เก่า (แบบ action ของ GAS)
+    """
+
+    name = "base"
+
+    def write_config(self, device_id: str, unit: str, adj_temp: float, adj_humid: float) -> dict:
+        raise NotImplementedError
+
+    def get_config(self, device_id: str) -> dict:
+        raise NotImplementedError
+
+    def list_devices(self) -> dict:
+        raise NotImplementedError
+
+    def add_subscription(self, device_id: str, line_id: str) -> dict:
+        raise NotImplementedError
+
+    def remove_subscription(self, device_id: str, line_id: str) -> dict:
+        raise NotImplementedError
+
+    def get_subscriptions(self, device_id: str) -> dict:
+        raise NotImplementedError
+
+    def append_history(self, device_id: str, temp: float, humid: float, hic: float,
+                       flag: str = "OK", timestamp: Optional[str] = None) -> dict:
+        raise NotImplementedError
+
+    def history_by_device(self, device_id: str, since: Optional[str] = None) -> dict:
+        raise NotImplementedError
+
+    def history_by_line(self, line_id: str, since: Optional[str] = None,
+                        device_ids: Optional[Sequence[str]] = None) -> dict:
+        raise NotImplementedError
+
+    def query_history(self, q: HistoryQuery) -> dict:
+        raise NotImplementedError
+
+    def update_history(self, device_id: str, rows: List[dict]) -> dict:
+        raise NotImplementedError
+
+    def current_status(self, line_id: str) -> dict:
+        raise NotImplementedError
+
+    def pushdown_supported(self) -> Optional[bool]:
+        return True
+
+    def start(self, leader: bool = True):
+        """
+        leader=False ⇒ worker อื่นเป็นคนทำงานเบื้องหลัง (uvicorn --workers N ดู shared.py)
+        เรียกซ้ำด้วย leader=True ได้ (ได้เป็น leader ทีหลัง)
+        """
+
+    def stop(self):
+        pass
+
+    def snapshot(self) -> dict:
+        return {"backend": self.name}
+
+
+# =========================================================
+# Apps Script
+# =========================================================
+
+class GasStorage(Storage):
+    name = "gas"
+
+    def __init__(self, base_url: str, stream_chunk_bytes: int = 65536, pushdown: str = "auto",
+                 timeout: Tuple[float, float] = (10.0, 60.0)):
+        self.base_url = base_url
+        # (connect, read) ทุก request: GAS ค้าง ⇒ requests.Timeout แทนการรอตลอดไป
+        # (thread ของ mirror / ingest retry ที่ยิงซ้ำได้ไม่จำกัดจะได้ไม่ติดอยู่กับ request เดียว)
+        # read = รอ byte ถัดไปนานสุด ไม่ใช่เวลารวม (stream history ยาว ๆ ไม่โดนตัด)
+        self.timeout = timeout
+        self.stream_chunk_bytes = stream_chunk_bytes
+        self.reads = SingleFlight()
+        self.probe = PushdownProbe(pushdown)
+        self.stream_lock = threading.Lock()
+        self.stream_stats = {"calls": 0, "rows_scanned": 0, "rows_kept": 0, "early_stops": 0}
+
+    # ---------- HTTP ----------
+
+    def _get_now(self, params: dict):
+        resp = requests.get(self.base_url, params=params, timeout=self.timeout)
+        resp.raise_for_status()
+        return resp.json()
+
+    def get(self, params: dict):
+        """
+        GET base_url?params แบบ single-flight: call ที่ action + params เหมือนกันและยังไม่เสร็จ
+        ใช้ผลเดียวกัน (เช่น 30 คนเปิด /history ห้องเดียวกันพร้อมกัน = ยิง GAS 1 ครั้ง)
+        ผลที่ได้ใช้ร่วมกันหลาย request ⇒ ห้ามแก้ในที่
+        """
+        key = tuple(sorted((k, str(v)) for k, v in params.items()))
+        return self.reads.do(key, lambda: self._get_now(params))
+
+    def _get_rows_now(self, params: dict, keep, stop) -> dict:
+        with requests.get(self.base_url, params=params, stream=True, timeout=self.timeout) as resp:
+            resp.raise_for_status()
+            data: dict = {}
+            rows: List[dict] = []
+            scanned = 0
+            stopped = False
+            for key, val in iter_object(resp.iter_content(self.stream_chunk_bytes), "data"):
+                if key != "data":
+                    data[key] = val
+                    continue
+                scanned += 1
+                if stop is not None and stop(val):
+                    stopped = True
+                    break  # ปิด connection ไม่อ่านส่วนที่เหลือ
+                if keep is None or keep(val):
+                    rows.append(val)
+        data["data"] = rows
+        data["count"] = len(rows)
+        with self.stream_lock:
+            self.stream_stats["calls"] += 1
+            self.stream_stats["rows_scanned"] += scanned
+            self.stream_stats["rows_kept"] += len(rows)
+            self.stream_stats["early_stops"] += int(stopped)
+        return data
+
+    def get_rows(self, params: dict, keep=None, stop=None, tag: tuple = ()):
+        """
+        เหมือน get แต่ parse "data" ทีละแถวระหว่างที่ response ยังมาไม่หมด (ดู jsonstream.py)
+        - keep(row) = False ⇒ ทิ้งแถวนั้นเลย
+        - stop(row) = True ⇒ หยุดอ่าน (แถวนั้นและที่เหลือไม่เอา) ใช้กับ response ที่เรียงเวลาอยู่แล้ว
+        memory สูงสุด ≈ แถวที่เก็บไว้ ไม่ใช่ทั้ง document
+        tag = ค่าที่ทำให้ keep / stop ต่างกัน (ใช้แยก key ของ single-flight)
+        """
+        key = tuple(sorted((k, str(v)) for k, v in params.items())) + (("rows",) + tuple(tag),)
+        return self.reads.do(key, lambda: self._get_rows_now(params, keep, stop))
+
+    def post(self, payload: dict):
+        resp = requests.post(self.base_url, json=payload, timeout=self.timeout)
+        resp.raise_for_status()
+        return resp.json()
+
+    # ---------- operations ----------
+
+    def write_config(self, device_id, unit, adj_temp, adj_humid):
+        return self.post({"action": "writeConfig", "id": device_id, "unit": unit,
+                          "adj_temp": adj_temp, "adj_humid": adj_humid})
+
+    def get_config(self, device_id):
+        return self.get({"action": "getConfigById", "id": device_id})
+
+    def list_devices(self):
+        return self.get({"action": "listDevices"})
+
+    def add_subscription(self, device_id, line_id):
+        return self.post({"action": "addSubscription", "id": device_id, "line_id": line_id})
+
+    def remove_subscription(self, device_id, line_id):
+        return self.post({"action": "removeSubscription", "id": device_id, "line_id": line_id})
+
+    def get_subscriptions(self, device_id):
+        return self.get({"action": "getSubscriptionsById", "id": device_id})
+
+    def append_history(self, device_id, temp, humid, hic, flag="OK", timestamp=None):
+        payload = {"action": "appendHistory", "id": device_id, "temp": temp, "humid": humid,
+                   "hic": hic, "flag": flag}
+        if timestamp:
+            payload["timestamp"] = timestamp
+            payload["key"] = append_key(device_id, timestamp)
+        return self.post(payload)
+
+    def history_by_device(self, device_id, since=None):
+        params = {"action": "getHistoryByIdSorted", "id": device_id}
+        keep = None
+        if since:
+            params["since"] = since
+            since_key = gas_ts_key(since)
+            # GAS ตัวเก่าไม่รู้จัก since ⇒ กรองเองระหว่าง parse
+            keep = lambda r: (gas_ts_key(r.get("timestamp")) or 0.0) > since_key
+        return self.get_rows(params, keep=keep)
+
+    def history_by_line(self, line_id, since=None, device_ids=None):
+        params = {"action": "history", "line_id": line_id}
+        bound = set(device_ids) if device_ids else None
+        keep = (lambda r: str(r.get("id", "")) in bound) if bound is not None else None
+        stop = None
+        if since:
+            params["since"] = since
+            since_key = gas_ts_key(since)
+            done = set()
+
+            def old(r) -> bool:
+                key = gas_ts_key(r.get("timestamp"))
+                return key is not None and key <= since_key
+
+            def stop(r):
+                # history(line_id) เรียงใหม่ → เก่าในแต่ละ device (แต่ละ device ไม่ได้เรียงต่อกันทั้งห้อง)
+                # ⇒ device ถึงแถวที่มีอยู่แล้ว = ที่เหลือของ device นั้นมีหมดแล้ว หยุดเมื่อครบทุก device ที่ผูก
+                # (GAS ตัวเก่าที่ไม่รู้จัก since ก็ไม่ต้อง parse / ถือทั้ง response)
+                if old(r):
+                    done.add(str(r.get("id", "")))
+                return bound is not None and bound <= done
+
+            keep_bound = keep
+            keep = lambda r: not old(r) and (keep_bound is None or keep_bound(r))
+
+        return self.get_rows(params, keep=keep, stop=stop, tag=tuple(sorted(bound or ())))
+
+    def query_history(self, q):
+        return self.reads.do(q.key(), lambda: q.run(lambda params, keep: self._get_rows_now(params, keep, None), self.probe))
+
+    def update_history(self, device_id, rows):
+        return self.post({"action": "updateHistory", "id": device_id, "rows": rows})
+
+    def current_status(self, line_id):
+        return self.get({"action": "current_status", "line_id": line_id})
+
+    def pushdown_supported(self):
+        return self.probe.supported
+
+    def snapshot(self):
+        with self.stream_lock:
+            stream = dict(self.stream_stats)
+        return {"backend": self.name, "reads": self.reads.snapshot(), "stream": stream, "pushdown": self.probe.snapshot()}
+
+
+# =========================================================
+# SQLite
+# =========================================================
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS config (
+    id TEXT PRIMARY KEY,
+    unit TEXT,
+    adj_temp REAL,
+    adj_humid REAL
+);
+CREATE TABLE IF NOT EXISTS subs (
+    id TEXT NOT NULL,
+    line_id TEXT NOT NULL,
+    created_at TEXT,
+    PRIMARY KEY (id, line_id)
+);
+CREATE INDEX IF NOT EXISTS subs_line ON subs (line_id);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# การเขียนที่รอส่งไป GAS (payload = body ของ POST เดิม) ดู replication.py
+_OUTBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    created REAL NOT NULL,
+    coalesce_key TEXT,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    last_error TEXT
+);
+CREATE INDEX IF NOT EXISTS outbox_coalesce ON outbox (coalesce_key);
+CREATE TABLE IF NOT EXISTS outbox_dead (
+    seq INTEGER PRIMARY KEY,
+    created REAL NOT NULL,
+    coalesce_key TEXT,
+    payload TEXT NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_error TEXT
+);
+"""
+
+
+_INSERT_HISTORY = ("INSERT OR REPLACE INTO {h} (id, ts, timestamp, temp, humid, hic, flag) "
+                   "VALUES (?, ?, ?, ?, ?, ?, ?)")
+_INSERT_HISTORY_KEEP = _INSERT_HISTORY.replace("OR REPLACE", "OR IGNORE")
+# การเขียนที่ bootstrap ต้องไม่ copy ทับ (ดู SqliteStorage.bootstrap_device)
+_DEVICE_ACTIONS = ("writeConfig", "addSubscription", "removeSubscription")
+_HISTORY_COLS = "h.id, h.timestamp, h.temp, h.humid, h.hic, h.flag"
+
+
+class SqliteStorage(Storage):
+    """
+    outbox=True ⇒ ทุกการเขียนบันทึก payload ของ GAS ลงตาราง outbox ด้วย (ใช้กับ TieredStorage)
+    เขียนแบบ mirror=False ⇒ ไม่ลง outbox (ข้อมูลที่ copy มาจาก GAS เอง)
+
+    history แยกไฟล์ตามเดือนใน segments_dir (ดู segments.py)
+    - raw_days > 0 ⇒ เดือนที่จบไปแล้วเกิน raw_days วัน สรุปเป็น rollup ทีละ rollup_sec แล้วลบแถวดิบ
+    - retention_days > 0 ⇒ ลบทั้งแถวดิบและ rollup ที่เก่ากว่านี้
+    ทำใน thread เบื้องหลังทุก maintain_every_sec (start / stop)
+    """
+
+    name = "sqlite"
+
+    def __init__(self, path: str, outbox: bool = False, segments_dir: Optional[str] = None,
+                 raw_days: float = 0, retention_days: float = 0, rollup_sec: int = 3600,
+                 open_max: int = 6, maintain_every_sec: float = 3600):
+        self.path = path
+        self.outbox = outbox
+        self.raw_days = raw_days
+        self.retention_days = retention_days
+        self.rollup_sec = max(1, int(rollup_sec))
+        self.maintain_every_sec = maintain_every_sec
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(_SCHEMA + ROLLUP_SCHEMA)
+        if outbox:
+            self.db.executescript(_OUTBOX_SCHEMA)
+        if segments_dir is None:
+            segments_dir = (path if path != ":memory:" else tempfile.mkdtemp(prefix="ht-")) + ".segments"
+        self.segments = SegmentSet(self.db, segments_dir, open_max=open_max)
+        self.rollup_until = float(self.get_meta("rollup_until") or 0.0)   # key < นี้อยู่ใน rollup แล้ว
+        self.stopping = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.last_maintain: dict = {}
+        self._migrate_legacy()
+        self._migrate_rollup_counts()
+        self._migrate_naive_keys()
+        if outbox:
+            self._reconcile_outbox()
+
+    def _all(self, sql: str, args: Sequence = ()) -> List[dict]:
+        with self.lock:
+            return [dict(r) for r in self.db.execute(sql, args).fetchall()]
+
+    def _write(self, statements: Sequence[tuple], payload: Optional[dict] = None,
+               coalesce: Optional[str] = None, month: Optional[int] = None, many: bool = False) -> List[int]:
+        """
+        statements [(sql, args), ...] + แถว outbox (payload) ใน transaction เดียว คืน rowcount ของแต่ละ statement
+        coalesce = key ที่ค่าล่าสุดชนะ (เช่น config ของ device) ⇒ แถวเก่าที่ยังไม่ได้ส่งถูกแทนที่
+        month = เดือนของ history ที่เขียน ({h} ใน sql = ตาราง history ของเดือนนั้น)
+                แถว outbox ลงไฟล์เดือนนั้นด้วย (WAL ไม่ atomic ข้ามไฟล์) + จดเดือนไว้ใน meta ให้ replicator รู้ว่าต้องอ่าน
+                crash ระหว่าง commit สองไฟล์ ⇒ อย่างแย่ meta ไม่มีเดือนนั้น แก้ตอนเปิดด้วย _reconcile_outbox
+        many = args เป็น list ของแถว (executemany)
+        """
+        counts = []
+        with self.lock:
+            if month is not None:
+                self._rescan()
+            h = self.segments.table(month) if month is not None else None
+            outbox = self.segments.outbox_table(month) if month is not None else "outbox"
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, args in statements:
+                    sql = sql.format(h=h) if h else sql
+                    cur = self.db.executemany(sql, args) if many else self.db.execute(sql, args)
+                    counts.append(cur.rowcount)
+                if payload is not None and self.outbox:
+                    if coalesce:
+                        self.db.execute(f"DELETE FROM {outbox} WHERE coalesce_key = ?", (coalesce,))
+                    self.db.execute(
+                        f"INSERT INTO {outbox} (created, coalesce_key, payload) VALUES (?, ?, ?)",
+                        (time.time(), coalesce, json.dumps(payload, ensure_ascii=False)),
+                    )
+                    if month is not None:
+                        self.db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES (?, '1')",
+                                        (f"outbox_month:{month}",))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return counts
+
+    def get_meta(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str):
+        self._write([("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))])
+
+    # ---------- config ----------
+
+    def write_config(self, device_id, unit, adj_temp, adj_humid, mirror: bool = True):
+        self._write(
+            [("INSERT INTO config (id, unit, adj_temp, adj_humid) VALUES (?, ?, ?, ?) "
+              "ON CONFLICT (id) DO UPDATE SET unit = excluded.unit, adj_temp = excluded.adj_temp, "
+              "adj_humid = excluded.adj_humid",
+              (device_id, unit, adj_temp, adj_humid))],
+            {"action": "writeConfig", "id": device_id, "unit": unit, "adj_temp": adj_temp, "adj_humid": adj_humid}
+            if mirror else None,
+            coalesce=f"config:{device_id}",
+        )
+        return {"success": True, "message": "config saved"}
+
+    def get_config(self, device_id):
+        return _ok(self._all("SELECT id, unit, adj_temp, adj_humid FROM config WHERE id = ?", (device_id,)))
+
+    def bootstrap_device(self, device_id: str, configs: List[dict], subs: List[dict]) -> bool:
+        """
+        config / subs ของ device จาก GAS (TieredStorage.bootstrap) ไม่ลง outbox
+        device มีการเขียนที่ยังไม่ได้ส่งไป GAS (ค่าใน GAS เก่ากว่า local) ⇒ ข้ามทั้ง device คืน False
+        เช็ก + เขียนใน transaction เดียว ⇒ worker อื่นเขียนแทรกระหว่างนั้นไม่ได้
+        """
+        marks = ", ".join("?" * len(_DEVICE_ACTIONS))
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                pending = self.db.execute(
+                    f"SELECT 1 FROM outbox WHERE json_extract(payload, '$.id') = ? "
+                    f"AND json_extract(payload, '$.action') IN ({marks}) LIMIT 1",
+                    (device_id, *_DEVICE_ACTIONS),
+                ).fetchone()
+                if pending is None:
+                    for row in configs:
+                        self.db.execute(
+                            "INSERT OR REPLACE INTO config (id, unit, adj_temp, adj_humid) VALUES (?, ?, ?, ?)",
+                            (device_id, row.get("unit", ""), row.get("adj_temp", 0.0), row.get("adj_humid", 0.0)),
+                        )
+                    for row in subs:
+                        self.db.execute("INSERT OR IGNORE INTO subs (id, line_id, created_at) VALUES (?, ?, ?)",
+                                        (device_id, str(row.get("line_id")), row.get("created_at")))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return pending is None
+
+    def list_devices(self):
+        return _ok([r["id"] for r in self._all("SELECT id FROM config ORDER BY id")])
+
+    # ---------- subscriptions ----------
+
+    def add_subscription(self, device_id, line_id, created_at: Optional[str] = None, mirror: bool = True):
+        self._write(
+            [("INSERT OR IGNORE INTO subs (id, line_id, created_at) VALUES (?, ?, ?)",
+              (device_id, line_id, created_at or gas_timestamp(time.time())))],
+            {"action": "addSubscription", "id": device_id, "line_id": line_id} if mirror else None,
+        )
+        return {"success": True, "message": "subscription added"}
+
+    def remove_subscription(self, device_id, line_id, mirror: bool = True):
+        n = self._write(
+            [("DELETE FROM subs WHERE id = ? AND line_id = ?", (device_id, line_id))],
+            {"action": "removeSubscription", "id": device_id, "line_id": line_id} if mirror else None,
+        )[0]
+        return {"success": True, "removed": n}
+
+    def get_subscriptions(self, device_id):
+        return _ok(self._all("SELECT id, line_id, created_at FROM subs WHERE id = ? ORDER BY created_at", (device_id,)))
+
+    # ---------- history ----------
+
+    @staticmethod
+    def _timestamp(timestamp: Optional[str]) -> str:
+        """
+        timestamp แบบที่ GAS เก็บ: firmware ส่ง epoch (string) / ไม่ส่ง = ตอนนี้
+        """
+        if timestamp:
+            try:
+                return gas_timestamp(float(timestamp))
+            except (TypeError, ValueError):
+                if gas_ts_key(timestamp) is not None:
+                    return str(timestamp)
+        return gas_timestamp(time.time())
+
+    def _route(self, key: float) -> Optional[int]:
+        """
+        เดือนที่แถว key ต้องอยู่ (None = เก่ากว่า rollup_until ⇒ รวมเข้า rollup)
+        """
+        return month_of(key) if key >= self.rollup_until else None
+
+    def _rollup_args(self, did: str, key: float, temp, humid, hic, flag) -> tuple:
+        bucket = float(int(key // self.rollup_sec) * self.rollup_sec)
+        return (did, bucket, gas_timestamp(bucket), temp, humid, hic, flag, 1, reading_count(temp), reading_count(humid))
+
+    def append_history(self, device_id, temp, humid, hic, flag="OK", timestamp=None, mirror: bool = True):
+        # ไม่ส่ง timestamp ⇒ ใส่เวลาตอนนี้เอง (Sheet ได้ค่าเดียวกับ local แม้ส่งไปทีหลัง)
+        timestamp = timestamp or str(time.time())
+        ts = self._timestamp(timestamp)
+        key = gas_ts_key(ts)
+        month = self._route(key)
+        if month is None:
+            statement = (UPSERT_ROLLUP, self._rollup_args(device_id, key, temp, humid, hic, flag))
+        else:
+            statement = (_INSERT_HISTORY, (device_id, key, ts, temp, humid, hic, flag))
+        self._write(
+            [statement],
+            {"action": "appendHistory", "id": device_id, "temp": temp, "humid": humid, "hic": hic,
+             "flag": flag, "timestamp": timestamp, "key": append_key(device_id, timestamp)} if mirror else None,
+            month=month,
+        )
+        return {"success": True, "message": "history appended"}
+
+    def insert_history(self, rows: List[dict], replace: bool = True) -> int:
+        """
+        เพิ่มหลายแถวทีเดียว (timestamp เดิมซ้ำ ⇒ เขียนทับ, replace=False ⇒ เก็บแถวที่มีอยู่แล้ว) ไม่ลง outbox
+        แยกเป็น transaction ละเดือน (ช่วงที่ rollup แล้วรวมเข้า bucket เสมอ แยกแถวซ้ำไม่ได้)
+        """
+        by_month: Dict[Optional[int], list] = {}
+        n = 0
+        for r in rows:
+            key = gas_ts_key(r.get("timestamp"))
+            if key is None:
+                continue
+            month = self._route(key)
+            did = str(r.get("id", ""))
+            if month is None:
+                args = self._rollup_args(did, key, r.get("temp"), r.get("humid"), r.get("hic"), r.get("flag"))
+            else:
+                args = (did, key, str(r["timestamp"]), r.get("temp"), r.get("humid"), r.get("hic"), r.get("flag"))
+            by_month.setdefault(month, []).append(args)
+            n += 1
+        for month, args in by_month.items():
+            insert = _INSERT_HISTORY if replace else _INSERT_HISTORY_KEEP
+            self._write([(UPSERT_ROLLUP if month is None else insert, args)], month=month, many=True)
+        return n
+
+    def _rescan(self):
+        """
+        process อื่น (worker อื่น) สร้าง / rollup / ลบไฟล์เดือน ⇒ อ่านรายการเดือน + rollup_until ใหม่ (เรียกภายใต้ lock)
+        """
+        if self.segments.rescan():
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'rollup_until'").fetchone()
+            self.rollup_until = max(self.rollup_until, float(row[0]) if row else 0.0)
+
+    def _sources(self, lo: Optional[float] = None, hi: Optional[float] = None, order: str = "asc") -> List[Optional[int]]:
+        """
+        ที่ที่ต้องอ่านสำหรับช่วง [lo, hi) เรียงตาม order: None = rollup, int = เดือน
+        (เดือนที่ไม่ทับช่วงไม่ถูกเปิดเลย)
+        """
+        self._rescan()
+        out: List[Optional[int]] = []
+        if self.rollup_until and (lo is None or lo < self.rollup_until):
+            out.append(None)
+        out.extend(m for m in self.segments.covering(lo, hi) if month_range(m)[1] > self.rollup_until)
+        return out if order == "asc" else out[::-1]
+
+    def _table(self, source: Optional[int]) -> str:
+        return "rollup" if source is None else self.segments.table(source)
+
+    def _scan(self, sql: str, args: Sequence, lo: Optional[float] = None, hi: Optional[float] = None,
+              order: str = "asc") -> List[dict]:
+        """
+        รัน sql ({h} = ตาราง) กับทุกที่ที่ทับช่วง แล้วต่อผลตาม order (ในแต่ละที่ต้อง ORDER BY เองด้วย)
+        """
+        rows: List[dict] = []
+        with self.lock:
+            for source in self._sources(lo, hi, order):
+                rows.extend(dict(r) for r in self.db.execute(sql.format(h=self._table(source)), args))
+        return rows
+
+    def history_by_device(self, device_id, since=None):
+        sql = f"SELECT {_HISTORY_COLS} FROM {{h}} h WHERE h.id = ?"
+        args: list = [device_id]
+        lo = None
+        if since:
+            lo = gas_ts_key(since)
+            sql += " AND h.ts > ?"
+            args.append(lo)
+        return _ok(self._scan(sql + " ORDER BY h.ts", args, lo=lo))
+
+    def history_by_line(self, line_id, since=None, device_ids=None):
+        sql = f"SELECT {_HISTORY_COLS} FROM {{h}} h JOIN subs s ON s.id = h.id WHERE s.line_id = ?"
+        args: list = [line_id]
+        lo = None
+        if since:
+            lo = gas_ts_key(since)
+            sql += " AND h.ts > ?"
+            args.append(lo)
+        if device_ids:
+            sql += f" AND h.id IN ({','.join('?' * len(device_ids))})"
+            args.extend(device_ids)
+        return _ok(self._scan(sql + " ORDER BY h.ts DESC", args, lo=lo, order="desc"))
+
+    def query_history(self, q):
+        where = "s.line_id = ?"
+        args: list = [q.line_id]
+        lo = hi = None
+        if q.device_id:
+            where += " AND h.id = ?"
+            args.append(q.device_id)
+        if q.start:
+            lo = gas_ts_key(q.start)
+            where += " AND h.ts >= ?"
+            args.append(lo)
+        if q.end:
+            hi = gas_ts_key(q.end)
+            where += " AND h.ts < ?"
+            args.append(hi)
+        cols = [c for c in (q.columns or HISTORY_FIELDS) if c in HISTORY_FIELDS]
+        base = f"FROM {{h}} h JOIN subs s ON s.id = h.id WHERE {where}"
+        select = f"SELECT {', '.join('h.' + c for c in cols)} {base} ORDER BY h.ts {q.order.upper()} LIMIT ? OFFSET ?"
+        total = 0
+        skip = q.offset
+        data: List[dict] = []
+        with self.lock:
+            # เดินทีละเดือนตาม order: นับ total ทุกที่ แต่ดึงแถวเฉพาะที่อยู่ในช่วง offset / limit
+            for source in self._sources(lo, hi, q.order):
+                table = self._table(source)
+                n = self.db.execute(f"SELECT COUNT(*) {base}".format(h=table), args).fetchone()[0]
+                total += n
+                if (q.limit is not None and len(data) >= q.limit) or n == 0:
+                    continue
+                if skip >= n:
+                    skip -= n
+                    continue
+                take = -1 if q.limit is None else q.limit - len(data)
+                data.extend(dict(r) for r in self.db.execute(select.format(h=table), args + [take, skip]))
+                skip = 0
+        return {"success": True, "total": total, "count": len(data), "data": data}
+
+    def update_history(self, device_id, rows, mirror: bool = True):
+        """
+        แถวดิบแยก transaction ตามเดือน (payload ไปกับเดือนนั้น)
+        ช่วงที่ rollup แล้ว: แถวคือ bucket (timestamp = ต้น bucket ไม่ใช่ค่าที่อ่านจริง) ⇒ แก้ที่ rollup อย่างเดียว
+        ไม่ส่งไป Sheet (ทับแถวจริงที่ timestamp ตรงต้น bucket พอดีได้) bucket ที่อ่านไม่ได้ทั้งช่วง (nt / nh = 0) คงค่าเดิม
+        """
+        by_month: Dict[Optional[int], list] = {}
+        months: List[Optional[int]] = []
+        for r in rows:
+            key = gas_ts_key(r.get("timestamp"))
+            month = self._route(key) if key is not None else None
+            months.append(month)
+            if key is None:
+                continue
+            if month is None:
+                statement = ("UPDATE rollup SET temp = CASE WHEN nt > 0 THEN ? ELSE temp END, "
+                             "humid = CASE WHEN nh > 0 THEN ? ELSE humid END, hic = ?, flag = ? WHERE id = ? AND ts = ?")
+            else:
+                statement = "UPDATE {h} SET temp = ?, humid = ?, hic = ?, flag = ? WHERE id = ? AND ts = ?"
+            by_month.setdefault(month, []).append(
+                (statement, (r.get("temp"), r.get("humid"), r.get("hic"), r.get("flag"), device_id, key)))
+        # timestamp อ่านไม่ได้ ⇒ local ไม่มีแถวนี้ ส่งให้ Sheet จัดการเอง
+        rest = [r for r in rows if gas_ts_key(r.get("timestamp")) is None]
+        updated = 0
+        for month, statements in by_month.items():
+            payload = {"action": "updateHistory", "id": device_id,
+                       "rows": [r for r, m in zip(rows, months) if m == month]} if mirror and month is not None else None
+            updated += sum(self._write(statements, payload, month=month))
+        if mirror and rest:
+            self._write([], {"action": "updateHistory", "id": device_id, "rows": rest})
+        return {"success": True, "updated": updated}
+
+    def current_status(self, line_id):
+        rows = self._all(
+            "SELECT s.id AS id, c.unit AS unit FROM subs s LEFT JOIN config c ON c.id = s.id "
+            "WHERE s.line_id = ? ORDER BY s.created_at",
+            (line_id,),
+        )
+        # แถวล่าสุดของแต่ละ device: ไล่จากเดือนล่าสุดย้อนไปจนเจอครบ (ปกติจบที่เดือนปัจจุบัน)
+        latest: Dict[str, dict] = {}
+        missing = list(dict.fromkeys(r["id"] for r in rows))
+        with self.lock:
+            for source in self._sources(order="desc"):
+                if not missing:
+                    break
+                found = self.db.execute(
+                    f"SELECT h.id, h.timestamp, h.temp, h.humid, h.hic, h.flag, MAX(h.ts) FROM {self._table(source)} h "
+                    f"WHERE h.id IN ({','.join('?' * len(missing))}) GROUP BY h.id",
+                    missing,
+                ).fetchall()
+                for r in found:
+                    latest[r["id"]] = dict(r)
+                missing = [did for did in missing if did not in latest]
+        for r in rows:
+            r["unit"] = r["unit"] or r["id"]
+            h = latest.get(r["id"])
+            if h is None:
+                r.update(lastupdate="-", temp="", humid="", hic="", flag="")
+            else:
+                r.update(lastupdate=h["timestamp"], temp=h["temp"], humid=h["humid"], hic=h["hic"], flag=h["flag"])
+            r["status"] = ""  # main.py คำนวณจาก lastupdate / liveness เอง
+        return _ok(rows)
+
+    # ---------- retention / rollup (ดู segments.py) ----------
+
+    def _migrate_legacy(self):
+        """
+        ไฟล์จากรุ่นที่ history อยู่ในตารางเดียว ⇒ ย้ายเข้าไฟล์เดือนแล้วลบตารางเดิม
+        """
+        with self.lock:
+            legacy = self.db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'history'").fetchone()
+        if not legacy:
+            return
+        rows = self._all("SELECT id, timestamp, temp, humid, hic, flag FROM main.history")
+        n = self.insert_history(rows)
+        with self.lock:
+            self.db.execute("DROP TABLE main.history")
+        logger.info(f"sqlite storage: moved {n} history rows into monthly segments")
+
+    def _migrate_rollup_counts(self):
+        """
+        rollup จากรุ่นที่ยังไม่มี nt / nh ⇒ เพิ่ม column (ถือว่าทุกแถวที่ค่าไม่ใช่ SENSOR_ERROR นับครบ n)
+        """
+        with self.lock:
+            cols = {r[1] for r in self.db.execute("PRAGMA table_info(rollup)").fetchall()}
+            if "nt" in cols:
+                return
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                for c, v in (("nt", "temp"), ("nh", "humid")):
+                    self.db.execute(f"ALTER TABLE rollup ADD COLUMN {c} INTEGER NOT NULL DEFAULT 0")
+                    self.db.execute(f"UPDATE rollup SET {c} = CASE WHEN {v} IS NULL OR {v} = ? THEN 0 ELSE n END",
+                                    (SENSOR_ERROR,))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def _migrate_naive_keys(self):
+        """
+        ไฟล์จากรุ่นที่ ts ของ timestamp ไม่มี Z = ตัวเลขเวลาไทย (เร็วไป 7 ชม.) ⇒ เขียนใหม่ด้วย gas_ts_key (epoch จริง)
+        insert ที่ key ใหม่ (ไฟล์เดือนที่ถูก) ก่อน แล้วค่อยลบแถวเดิม (ตรง timestamp ด้วย) ⇒ ดับกลางทางแล้วทำซ้ำได้
+        """
+        if self.get_meta("ts_key_utc"):
+            return
+        moved = 0
+        with self.lock:
+            self._rescan()
+            months = list(self.segments.months)
+        for month in months:
+            with self.lock:
+                rows = [dict(r) for r in self.db.execute(
+                    f"SELECT id, ts, timestamp, temp, humid, hic, flag FROM {self.segments.table(month)} "
+                    f"WHERE timestamp NOT LIKE '%Z'")]
+            rows = [r for r in rows if gas_ts_key(r["timestamp"]) not in (None, r["ts"])]
+            if not rows:
+                continue
+            self.insert_history(rows)
+            self._write([("DELETE FROM {h} WHERE id = ? AND ts = ? AND timestamp = ?",
+                          [(r["id"], r["ts"], r["timestamp"]) for r in rows])], month=month, many=True)
+            moved += len(rows)
+        self.set_meta("ts_key_utc", str(time.time()))
+        if moved:
+            logger.info(f"sqlite storage: re-keyed {moved} history rows without timezone (Thai time → epoch)")
+
+    def _rollup_month(self, month: int) -> int:
+        """
+        สรุปเดือนนี้เข้า rollup แล้วลบไฟล์ คืนจำนวนแถวดิบ
+        อ่าน / สรุปนอก lock; ถ้าระหว่างนั้นมีแถวเข้ามาเพิ่ม (จำนวนไม่ตรง) ⇒ สรุปใหม่ใน lock
+        """
+        path = self.segments.path(month)
+        agg = rollup_rows(path, self.rollup_sec)
+        with self.lock:
+            h = self.segments.table(month)
+            n = self.db.execute(f"SELECT COUNT(*) FROM {h}").fetchone()[0]
+            if n != sum(r[7] for r in agg):
+                agg = rollup_rows(path, self.rollup_sec)
+            until = max(self.rollup_until, month_range(month)[1])
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.executemany(UPSERT_ROLLUP, agg)
+                self._adopt_outbox(month)
+                self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('rollup_until', ?)", (str(until),))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.rollup_until = until
+            self.segments.drop(month)
+        return n
+
+    def maintain(self, now: Optional[float] = None) -> dict:
+        """
+        retention + rollup + VACUUM เดือนที่จบแล้ว (เรียกจาก thread เบื้องหลัง / เรียกเองก็ได้)
+        ingest เขียนเดือนปัจจุบันเท่านั้น ⇒ ไม่โดนล็อกนาน
+        """
+        now = time.time() if now is None else now
+        current = month_of(now)
+        done = {"dropped": [], "rolled_up": [], "vacuumed": [], "rollup_deleted": 0}
+        if self.retention_days > 0:
+            cutoff = now - self.retention_days * 86400
+            for m in list(self.segments.months):
+                if m != current and month_range(m)[1] <= cutoff:
+                    with self.lock:
+                        self.segments.table(m)   # ATTACH ก่อน BEGIN (ATTACH ใน transaction ไม่ได้)
+                        self.db.execute("BEGIN IMMEDIATE")
+                        try:
+                            self._adopt_outbox(m)
+                            self.db.execute("COMMIT")
+                        except BaseException:
+                            self.db.execute("ROLLBACK")
+                            raise
+                        self.segments.drop(m)
+                    done["dropped"].append(m)
+            done["rollup_deleted"] = self._write([("DELETE FROM rollup WHERE ts < ?", (cutoff,))])[0]
+        if self.raw_days > 0:
+            cutoff = now - self.raw_days * 86400
+            for m in list(self.segments.months):
+                if m == current or month_range(m)[1] > cutoff:
+                    break
+                self._rollup_month(m)
+                done["rolled_up"].append(m)
+        for m in list(self.segments.months):
+            # เดือนที่จบไปแล้วเกิน 1 วัน (เผื่อแถวที่ส่งมาช้า)
+            if month_range(m)[1] > now - 86400 or self.get_meta(f"vacuumed:{m}"):
+                continue
+            # ปิดจาก connection หลักก่อน แล้ว VACUUM ผ่าน connection แยก (ไม่ถือ lock ระหว่าง VACUUM)
+            with self.lock:
+                self.segments.detach(m)
+            db = sqlite3.connect(self.segments.path(m), timeout=30)
+            try:
+                db.execute("VACUUM")
+            finally:
+                db.close()
+            self.set_meta(f"vacuumed:{m}", str(now))
+            done["vacuumed"].append(m)
+        self.last_maintain = dict(done, at=now)
+        return done
+
+    def start(self, leader: bool = True):
+        if leader and self.thread is None and self.maintain_every_sec > 0:
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._maintain_loop, name="storage-maintain", daemon=True)
+            self.thread.start()
+
+    def _maintain_loop(self):
+        while not self.stopping.is_set():
+            try:
+                done = self.maintain()
+                if any(done[k] for k in ("dropped", "rolled_up", "vacuumed")):
+                    logger.info(f"sqlite storage maintain: {done}")
+            except Exception:
+                logger.exception("sqlite storage maintain failed")
+            self.stopping.wait(self.maintain_every_sec)
+
+    # ---------- outbox (ดู replication.py) ----------
+
+    # outbox อยู่ที่ main (config / subs / rollup) + ไฟล์เดือนที่จดไว้ใน meta outbox_month:<เดือน> (history)
+    # seq ที่ให้ Replicator = "<main|เดือน>:<seq ในตารางนั้น>"
+
+    def _outbox_months(self) -> List[int]:
+        """
+        เดือนที่อาจมีแถวค้างใน outbox (เรียกภายใต้ lock)
+        """
+        self._rescan()
+        rows = self.db.execute("SELECT key FROM meta WHERE key LIKE 'outbox_month:%'").fetchall()
+        return [m for m in sorted(int(r[0].split(":")[1]) for r in rows) if m in self.segments.months]
+
+    def _outbox_source(self, key: str):
+        """
+        seq ของ Replicator → (ตาราง outbox, เดือน หรือ None, seq) ไฟล์เดือนถูกลบไปแล้ว ⇒ ตาราง None
+        (เรียกภายใต้ lock)
+        """
+        source, seq = str(key).split(":")
+        if source == "main":
+            return "outbox", None, int(seq)
+        month = int(source)
+        self._rescan()
+        if month not in self.segments.months:
+            return None, month, int(seq)   # rollup / retention ย้ายแถวไป main แล้ว (_adopt_outbox)
+        return self.segments.outbox_table(month), month, int(seq)
+
+    def _outbox_txn(self, key: str, statements: Sequence[str], checkpoint: bool = False):
+        """
+        statements ({o} = ตาราง outbox ของ key, ? = seq) ใน transaction เดียว
+        แถวหมดจากไฟล์เดือนนั้นแล้ว ⇒ ลบเดือนออกจาก meta ใน transaction เดียวกัน
+        (BEGIN IMMEDIATE ล็อกทุกไฟล์ ⇒ ไม่ชนกับ _write ที่กำลังเพิ่มแถวเข้าเดือนนั้น)
+        """
+        with self.lock:
+            table, month, seq = self._outbox_source(key)
+            if table is None:
+                return
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                for sql in statements:
+                    self.db.execute(sql.format(o=table), (seq,))
+                if checkpoint:
+                    self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('outbox_checkpoint', ?)", (key,))
+                if month is not None and not self.db.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone():
+                    self.db.execute("DELETE FROM meta WHERE key = ?", (f"outbox_month:{month}",))
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def _adopt_outbox(self, month: int):
+        """
+        ก่อนลบไฟล์เดือน (rollup / retention): แถว outbox ที่ยังไม่ได้ส่งย้ายไป main
+        (เรียกใน transaction ของผู้เรียก ภายใต้ lock)
+        """
+        if not self.outbox:
+            return
+        table = self.segments.outbox_table(month)
+        self.db.execute(
+            f"INSERT INTO outbox (created, coalesce_key, payload, attempts, last_error) "
+            f"SELECT created, coalesce_key, payload, attempts, last_error FROM {table} ORDER BY seq"
+        )
+        self.db.execute("DELETE FROM meta WHERE key = ?", (f"outbox_month:{month}",))
+
+    def _reconcile_outbox(self):
+        """
+        ตอนเปิด: ไฟล์เดือนที่มีแถว outbox ค้างแต่ meta ไม่ได้จดไว้ (crash ระหว่าง commit) ⇒ จดใหม่
+        """
+        with self.lock:
+            for m in list(self.segments.months):
+                if self.db.execute(f"SELECT 1 FROM {self.segments.outbox_table(m)} LIMIT 1").fetchone():
+                    self.db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES (?, '1')", (f"outbox_month:{m}",))
+
+    def outbox_batch(self, limit: int) -> List[dict]:
+        """
+        แถวที่ค้างเก่าสุดก่อน (แต่ละไฟล์ตามลำดับ seq ของไฟล์นั้น แล้วรวมกันตาม created)
+        """
+        sources = []
+        with self.lock:
+            for month in [None] + self._outbox_months():
+                table = "outbox" if month is None else self.segments.outbox_table(month)
+                tag = "main" if month is None else str(month)
+                rows = self.db.execute(f"SELECT seq, created, payload, attempts FROM {table} ORDER BY seq LIMIT ?",
+                                       (limit,)).fetchall()
+                sources.append([dict(r, seq=f"{tag}:{r['seq']}") for r in rows])
+        out = []
+        for r in heapq.merge(*sources, key=lambda r: r["created"]):
+            r["payload"] = json.loads(r["payload"])
+            out.append(r)
+            if len(out) >= limit:
+                break
+        return out
+
+    def outbox_ack(self, seq: str):
+        self._outbox_txn(seq, ["DELETE FROM {o} WHERE seq = ?"], checkpoint=True)
+
+    def outbox_retry(self, seq: str, error: str) -> int:
+        with self.lock:
+            table, _, n = self._outbox_source(seq)
+            if table is None:
+                return 0
+            self.db.execute(f"UPDATE {table} SET attempts = attempts + 1, last_error = ? WHERE seq = ?", (error, n))
+            row = self.db.execute(f"SELECT attempts FROM {table} WHERE seq = ?", (n,)).fetchone()
+        return row[0] if row else 0
+
+    def outbox_bury(self, seq: str):
+        self._outbox_txn(seq, [
+            "INSERT INTO outbox_dead (created, coalesce_key, payload, attempts, last_error) "
+            "SELECT created, coalesce_key, payload, attempts, last_error FROM {o} WHERE seq = ?",
+            "DELETE FROM {o} WHERE seq = ?",
+        ])
+
+    def outbox_stats(self) -> dict:
+        with self.lock:
+            pending, oldest = self.db.execute("SELECT COUNT(*), MIN(created) FROM outbox").fetchone()
+            for m in self._outbox_months():
+                n, o = self.db.execute(f"SELECT COUNT(*), MIN(created) FROM {self.segments.outbox_table(m)}").fetchone()
+                pending += n
+                oldest = o if oldest is None or (o is not None and o < oldest) else oldest
+            dead = self.db.execute("SELECT COUNT(*) FROM outbox_dead").fetchone()[0]
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'outbox_checkpoint'").fetchone()
+        return {"pending": pending, "oldest_created": oldest, "dead_rows": dead,
+                "checkpoint": row[0] if row else None}
+
+    def snapshot(self):
+        with self.lock:
+            counts = {t: self.db.execute(f"SELECT COUNT(*) FROM {t}").fetchone()[0] for t in ("config", "subs", "rollup")}
+            months = list(self.segments.months)
+            attached = list(self.segments.attached)
+        return {
+            "backend": self.name,
+            "path": self.path,
+            "rows": counts,
+            "segments": months,
+            "segments_open": attached,
+            "segments_bytes": self.segments.size_bytes(),
+            "rollup_until": gas_timestamp(self.rollup_until) if self.rollup_until else None,
+            "last_maintain": self.last_maintain,
+        }
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout=10)
+            self.thread = None
+        with self.lock:
+            self.segments.close()
+            self.db.close()
+
+
+# =========================================================
+# SQLite + GAS mirror
+# =========================================================
+
+class TieredStorage(Storage):
+    """
+    local (SQLite + outbox) เป็นหลัก เขียนเสร็จที่ local แล้วตอบเลย ส่วน GAS ให้ replicator ทยอยส่ง
+    GAS ล่มนานแค่ไหน ingest ก็ไม่ช้าตาม และไม่มีอะไรหาย (ค้างอยู่ใน outbox บน disk)
+    """
+
+    name = "tiered"
+    WRITES = ("write_config", "add_subscription", "remove_subscription", "append_history", "update_history")
+    BOOTSTRAP_RETRY_SEC = (5.0, 300.0)   # (รอบแรก, สูงสุด) ของ backoff เมื่อ bootstrap ล้ม
+
+    def __init__(self, local: SqliteStorage, remote: GasStorage, replicator: Replicator):
+        self.local = local
+        self.remote = remote
+        self.replicator = replicator
+        self.ready = threading.Event()    # bootstrap จาก GAS เสร็จแล้ว
+        self.leader = False
+        self.stopping = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+        self.stats = {"bootstrap_rows": 0}
+        for name in self.WRITES:
+            setattr(self, name, self._write(name))
+
+    def _reader(self) -> Storage:
+        return self.local if self.ready.is_set() else self.remote
+
+    def _write(self, name: str) -> Callable[..., dict]:
+        def write(*args, **kwargs):
+            result = getattr(self.local, name)(*args, **kwargs)
+            self.replicator.wake()
+            return result
+        return write
+
+    # ---------- reads ----------
+
+    def get_config(self, device_id):
+        return self._reader().get_config(device_id)
+
+    def list_devices(self):
+        return self._reader().list_devices()
+
+    def get_subscriptions(self, device_id):
+        return self._reader().get_subscriptions(device_id)
+
+    def history_by_device(self, device_id, since=None):
+        return self._reader().history_by_device(device_id, since)
+
+    def history_by_line(self, line_id, since=None, device_ids=None):
+        return self._reader().history_by_line(line_id, since, device_ids)
+
+    def query_history(self, q):
+        return self._reader().query_history(q)
+
+    def current_status(self, line_id):
+        return self._reader().current_status(line_id)
+
+    def pushdown_supported(self):
+        return self._reader().pushdown_supported()
+
+    # ---------- background ----------
+
+    def start(self, leader: bool = True):
+        """
+        leader เท่านั้นที่ bootstrap + ส่ง outbox (outbox อยู่ในไฟล์ SQLite เดียวกันทุก worker)
+        worker อื่นรอจน leader bootstrap เสร็จแล้วค่อยอ่านจาก local
+        outbox ส่งตั้งแต่ start ไม่รอ bootstrap ⇒ GAS ได้ที่เขียนใหม่แม้ bootstrap ยังลองใหม่อยู่
+        """
+        self.leader = self.leader or leader
+        self.local.start(leader)
+        if leader:
+            self.replicator.start()
+        if self.thread is None:
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self._run, name="storage-bootstrap", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.replicator.stop()
+        self.local.stop()
+
+    def _run(self):
+        delay = self.BOOTSTRAP_RETRY_SEC[0]
+        while not self.local.get_meta("bootstrapped"):
+            if self.leader:
+                try:
+                    self.bootstrap()
+                except Exception:
+                    logger.exception(f"storage bootstrap from GAS failed (reads stay on GAS, retry in {delay:g}s)")
+                    if self.stopping.wait(delay):
+                        return
+                    delay = min(self.BOOTSTRAP_RETRY_SEC[1], delay * 2)
+                    continue
+                self.local.set_meta("bootstrapped", str(time.time()))
+                break
+            if self.stopping.wait(1.0):
+                return
+        self.ready.set()
+
+    def bootstrap(self):
+        """
+        copy config / subs / history ทั้งหมดจาก GAS ลง SQLite (ครั้งแรกที่เปิด tiered) ไม่ลง outbox
+        ที่เขียนระหว่าง copy ไม่ถูก copy ทับ:
+        - config / subs: ดึงจาก GAS + เขียน local ระหว่างพัก replicator (ส่งอะไรไป GAS แทรกไม่ได้)
+          device ที่มี outbox ค้าง ⇒ ข้าม (local ใหม่กว่า GAS อยู่แล้ว ส่งต่อไปเองทีหลัง)
+        - history: INSERT OR IGNORE ตาม (id, ts) ⇒ แถวที่ ingest / recalibrate เขียนไปแล้วไม่ถูกทับ
+        ลองใหม่ทั้งรอบได้ (ทุกขั้นเขียนซ้ำได้)
+        """
+        t0 = time.time()
+        skipped = 0
+        devices = self.remote.list_devices().get("data", [])
+        for did in devices:
+            if self.stopping.is_set():
+                raise RuntimeError("stopping")
+            did = str(did)
+            with self.replicator.paused():
+                configs = self.remote.get_config(did).get("data", [])
+                subs = self.remote.get_subscriptions(did).get("data", [])
+                skipped += not self.local.bootstrap_device(did, configs, subs)
+            n = self.local.insert_history(self.remote.history_by_device(did).get("data", []), replace=False)
+            self.stats["bootstrap_rows"] += n
+        logger.info(f"storage bootstrap: {len(devices)} devices from GAS in {time.time() - t0:.1f}s "
+                    f"({skipped} kept local config / subs)")
+
+    def snapshot(self):
+        return dict(self.stats, backend=self.name, ready=self.ready.is_set(), mirror=self.replicator.snapshot(),
+                    local=self.local.snapshot(), remote=self.remote.snapshot())
+
+
+def build_storage(kind: str, base_url: str, sqlite_path: str, stream_chunk_bytes: int = 65536,
+                  pushdown: str = "auto", mirror: Optional[dict] = None, sqlite: Optional[dict] = None,
+                  timeout: Tuple[float, float] = (10.0, 60.0)) -> Storage:
+    """
+    timeout = (connect, read) วินาทีของทุก request ไป GAS
+    mirror = option ของ Replicator (batch / backoff_max_sec / max_attempts ...) ใช้กับ tiered
+    sqlite = option ของ SqliteStorage (raw_days / retention_days / rollup_sec ...)
+    """
+    gas = GasStorage(base_url, stream_chunk_bytes=stream_chunk_bytes, pushdown=pushdown, timeout=timeout)
+    if kind == "gas":
+        return gas
+    if kind == "sqlite":
+        return SqliteStorage(sqlite_path, **(sqlite or {}))
+    if kind == "tiered":
+        local = SqliteStorage(sqlite_path, outbox=True, **(sqlite or {}))
+        return TieredStorage(local, gas, Replicator(local, gas.post, **(mirror or {})))
+    raise ValueError(f"unknown storage backend: {kind} (gas | sqlite | tiered)")